@@ -0,0 +1,43 @@
+# Import-time benchmark of the kernel module, which is on the path of every notebook start: the time to
+# import it in a fresh interpreter, the part of that which is the kernel's own (with ipykernel already
+# imported, as it is when the kernel is launched), and the transport modules that it has pulled in
+#
+#   python benchmarks/bench_import.py [--repeats 10] [--importtime]
+
+import argparse, json, statistics, subprocess, sys
+
+# run in each fresh interpreter, printing its timings as JSON
+child = """
+import sys, time, json
+t0 = time.perf_counter()
+import ipykernel.kernelbase
+t1 = time.perf_counter()
+import jupyter_micropython_kernel.kernel
+t2 = time.perf_counter()
+print(json.dumps({ "ipykernel": t1 - t0, "kernel": t2 - t1, "total": t2 - t0,
+                   "loaded": [ m  for m in ("serial", "serial.tools.list_ports", "websocket")  if m in sys.modules ] }))
+"""
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--repeats', type=int, default=10)
+    ap.add_argument('--importtime', help="also show the slowest modules under the kernel from python -X importtime", action='store_true')
+    args = ap.parse_args()
+
+    subprocess.run([sys.executable, "-c", "import jupyter_micropython_kernel.kernel"], check=True)   # bytecode compiled and files cached
+    runs = [ json.loads(subprocess.run([sys.executable, "-c", child], check=True, capture_output=True, text=True).stdout)  for i in range(args.repeats) ]
+    for name in ("ipykernel", "kernel", "total"):
+        values = [ r[name]*1000  for r in runs ]
+        print("{:10} median {:8.1f} ms  min {:8.1f} ms".format(name, statistics.median(values), min(values)))
+    print("transport modules imported: {}".format(", ".join(runs[-1]["loaded"]) or "none"))
+
+    if args.importtime:
+        stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import ipykernel.kernelbase; import jupyter_micropython_kernel.kernel"], check=True, capture_output=True, text=True).stderr
+        lines = [ l.split("|")  for l in stderr.splitlines()  if l.startswith("import time:") and "|" in l ]
+        before = [ i  for i, l in enumerate(lines)  if l[2].strip() == "ipykernel.kernelbase" ]
+        rows = [ (int(l[1]), l[2].rstrip())  for l in lines[(before[0] + 1  if before else 0):] ]
+        for cumulative, name in sorted(rows, reverse=True)[:12]:
+            print("{:8.1f} ms {}".format(cumulative/1000, name))
+
+if __name__ == '__main__':
+    main()
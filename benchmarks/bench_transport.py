@@ -0,0 +1,181 @@
+# Transport benchmarks against the simulated device in simdevice.py: cell round trip, output
+# throughput through receivestream, upload and download through sendtofile and fetchfile, listdir,
+# and the tokenizer on its own.  The results go into a JSON report, and with --baseline a previous
+# report is compared against, exiting with 1 if anything has got worse by more than --tolerance.
+#
+#   python benchmarks/bench_transport.py [--transports pty tcp websocket] [--latency 0.005] [--baud 0]
+#                                        [--oldfirmware] [--report bench_transport.json] [--baseline old.json]
+
+import argparse, io, json, os, sys, time, platform, random, tempfile
+import simdevice, bench_yieldserialchunk
+from jupyter_micropython_kernel import deviceconnector
+
+class Output:   # stands in for the kernel's sres, keeping what the device printed
+    def __init__(self):
+        self.res = [ ]
+    def sres(self, output, asciigraphicscode=None, n04count=0, clear_output=False):
+        self.res.append((output, n04count))
+    def sresSYS(self, output, clear_output=False):
+        self.res.append((output, 0))
+    def text(self, n04count=0):
+        return "".join(output  for output, n in self.res  if n == n04count)
+    def clear(self):
+        self.res.clear()
+
+def connect(transport, args, root):
+    out = Output()
+    dc = deviceconnector.DeviceConnector(out.sres, out.sresSYS)
+    kwargs = dict(root=root, latency=args.latency, baud=args.baud)
+    if args.oldfirmware:
+        kwargs["rawpastewindow"] = 0   # so the raw REPL without raw-paste is what gets used
+    if transport == "pty":
+        portname, device = simdevice.startpty(**kwargs)
+        dc.serialconnect(portname, 115200, False)
+    elif transport == "tcp":
+        ipnumber, portnumber = simdevice.starttcp(**kwargs)
+        dc.socketconnect(ipnumber, portnumber)
+    elif transport == "websocket":
+        dc.websocketconnect(simdevice.startwebsocket(password="pass", **kwargs))
+        dc.workingwebsocket.recv()   # the Password: prompt, answered as %websocketconnect does
+        dc.workingwebsocket.send("pass")
+        dc.workingwebsocket.send("\r\n")
+        dc.expect([deviceconnector.normalprompt], deviceconnector.rawrepltimeout)
+    if not dc.serialexists() or not dc.enterpastemode(verbose=False):
+        raise RuntimeError("could not connect over {}: {}".format(transport, out.text()))
+    return dc, out
+
+def runcell(dc, program):   # as MicroPythonKernel.runnormalcell does it
+    if dc.rawpastewrite(program):
+        if dc.streamsink:
+            dc.receiveframes(dc.streamsink, False, True)
+        dc.receivestream(bseekokay=False)
+    else:
+        dc.writebytes(program + b'\r\x04')
+        if dc.streamsink:
+            dc.receiveframes(dc.streamsink, True, True)
+        dc.receivestream(bseekokay=not dc.streamsink)
+
+def timeit(fn, repeats):   # best of the repeats
+    best = None
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        t = time.perf_counter() - t0
+        best = t  if best is None  else min(best, t)
+    return best
+
+def benchtransport(transport, args, results):
+    root = tempfile.mkdtemp(prefix="simdevice")
+    t0 = time.perf_counter()
+    dc, out = connect(transport, args, root)
+    def result(name, value, unit, better):
+        results.append({ "transport": transport, "name": name, "value": value, "unit": unit, "better": better })
+        print("{:10} {:22} {:14.4f} {}".format(transport, name, value, unit))
+    result("connect", time.perf_counter() - t0, "s", "lower")
+
+    out.clear()
+    result("cell_roundtrip", timeit(lambda: runcell(dc, b"x=1"), args.repeats*5), "s", "lower")
+
+    nlines = args.kbytes*1024//32
+    out.clear()
+    t = timeit(lambda: runcell(dc, b"for i in range(%d): print('%%030d' %% i)" % nlines), args.repeats)
+    assert out.text().count("\n") >= nlines, "printed lines went missing"
+    result("print_throughput", nlines*32/t, "bytes/s", "higher")
+
+    try:   # the same data as records of a %stream, in frames of 64 of them
+        streamsink = deviceconnector.StreamArray(os.path.join(root, "stream.npy"), "<Ii", nlines)
+    except ImportError:
+        streamsink = None
+    if streamsink and transport != "tcp":   # streams aren't implemented for sockets
+        dc.streamprelude()
+        dc.streamsink = streamsink
+        t = timeit(lambda: runcell(dc, b"import struct\nfor i in range(0, %d, 64): streamwrite(b''.join(struct.pack('<Ii', j, -j) for j in range(i, i+64)))" % nlines), args.repeats)
+        dc.streamsink.close()
+        assert dc.streamsink.n == nlines*args.repeats, "streamed records went missing"
+        dc.streamsink = None
+        result("stream_throughput", nlines*8/t, "bytes/s", "higher")
+
+    if transport != "tcp":   # file transfers aren't implemented for sockets
+        data = random.Random(0).randbytes(args.kbytes*1024)
+        t = timeit(lambda: dc.sendtofile("/bench.bin", False, False, True, True, data), args.repeats)
+        with open(os.path.join(root, "bench.bin"), "rb") as fin:
+            assert fin.read() == data, "uploaded file differs"
+        result("upload", len(data)/t, "bytes/s", "higher")
+
+        fout = io.BytesIO()
+        def fetch():
+            fout.seek(0)
+            fout.truncate()
+            dc.fetchfile("/bench.bin", True, True, fout)
+        t = timeit(fetch, args.repeats)
+        assert fout.getvalue() == data, "downloaded file differs"
+        result("download", len(data)/t, "bytes/s", "higher")
+
+        for i in range(args.nfiles):
+            d = os.path.join(root, "dir%d" % (i%8))
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, "f%d.py" % i), "w") as fout:
+                fout.write("x=%d\n" % i)
+        def listdir():
+            dc.invalidatefscache()
+            dc.listdir("", True)
+        result("listdir", timeit(listdir, args.repeats), "s", "lower")
+
+    dc.disconnect(raw=True)
+
+def benchtokenizer(args, results):
+    data = bench_yieldserialchunk.makestream(args.kbytes*1024)
+    tokens = [ ]
+    def tokenize():
+        tokens[:] = bench_yieldserialchunk.runtokens(deviceconnector.yieldchunktokens(bench_yieldserialchunk.streamreader(data, 4096)))
+    t = timeit(tokenize, args.repeats)
+    results.append({ "transport": "memory", "name": "tokenizer", "value": len(tokens)/t, "unit": "tokens/s", "better": "higher" })
+    print("{:10} {:22} {:14.0f} {}".format("memory", "tokenizer", len(tokens)/t, "tokens/s"))
+
+def compare(results, baseline, tolerance):   # returns the results that have got worse
+    old = dict(((r["transport"], r["name"]), r["value"])  for r in baseline["results"])
+    worse = [ ]
+    for r in results:
+        v = old.get((r["transport"], r["name"]))
+        if v:
+            change = (r["value"] - v)/v  if r["better"] == "higher"  else (v - r["value"])/v
+            if change < -tolerance:
+                worse.append((r, v, change))
+    return worse
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--transports', nargs="*", default=["pty", "tcp", "websocket"], choices=["pty", "tcp", "websocket"])
+    ap.add_argument('--latency', type=float, default=0.0, help="seconds the device waits before each reply")
+    ap.add_argument('--baud', type=int, default=0, help="simulated link speed (0 for unlimited)")
+    ap.add_argument('--oldfirmware', help="simulate firmware without raw-paste mode (before MicroPython 1.14)", action='store_true')
+    ap.add_argument('--kbytes', type=int, default=64, help="size of the transfers")
+    ap.add_argument('--nfiles', type=int, default=50, help="files in the tree listed by listdir")
+    ap.add_argument('--repeats', type=int, default=3)
+    ap.add_argument('--report', type=str, default="bench_transport.json")
+    ap.add_argument('--baseline', type=str, help="earlier report to check for regressions")
+    ap.add_argument('--tolerance', type=float, default=0.2)
+    args = ap.parse_args()
+
+    results = [ ]
+    for transport in args.transports:
+        benchtransport(transport, args, results)
+    benchtokenizer(args, results)
+
+    report = { "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "platform": platform.platform(),
+               "settings": { "latency": args.latency, "baud": args.baud, "oldfirmware": args.oldfirmware, "kbytes": args.kbytes, "nfiles": args.nfiles, "repeats": args.repeats },
+               "results": results }
+    with open(args.report, "w") as fout:
+        json.dump(report, fout, indent=1)
+    print("Report written to {}".format(args.report))
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            worse = compare(results, json.load(fin), args.tolerance)
+        for r, v, change in worse:
+            print("REGRESSION {} {}: {:.4g} -> {:.4g} {} ({:+.0f}%)".format(r["transport"], r["name"], v, r["value"], r["unit"], change*100))
+        if worse:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
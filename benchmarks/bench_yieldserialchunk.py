@@ -0,0 +1,113 @@
+# Micro-benchmark of the serial tokenizer: tokens per second of the old byte-at-a-time
+# yieldserialchunk against the bulk-read yieldchunktokens, fed from an in-memory stream.  First it 
+# checks that the noise filter gives the same tokens however the stream is split between reads.
+#
+#   python benchmarks/bench_yieldserialchunk.py [--kbytes 512] [--blocksize 4096] [--noisefilter]
+
+import argparse, time, random
+from jupyter_micropython_kernel import deviceconnector
+
+# the original implementation, kept here only so the two can be compared
+def legacyyieldchunktokens(readbyte):
+    res = [ ]
+    n = 0
+    while True:
+        b = readbyte()
+        if not b:
+            if res and (res[0] != 'O' or len(res) > 3):
+                yield b''.join(res)
+                res.clear()
+            else:
+                n += 1
+                if (n%deviceconnector.serialtimeoutcount) == 0:
+                    yield b''
+        elif b == b'K' and len(res) >= 1 and res[-1] == b'O':
+            if len(res) > 1:
+                yield b''.join(res[:-1])
+            yield b'OK'
+            res.clear()
+        elif b == b'\x04' or b == b'>':
+            if res:
+                yield b''.join(res)
+            yield b
+            res.clear()
+        else:
+            res.append(b)
+            if b == b'\n' and len(res) >= 2 and res[-2] == b'\r':
+                yield b''.join(res)
+                res.clear()
+
+def makestream(nbytes):
+    # typical device traffic: a paste-mode response wrapped round lines of printed sensor values
+    lines = [ ]
+    i = 0
+    while sum(map(len, lines)) < nbytes:
+        lines.append(b"OK")
+        for j in range(20):
+            lines.append(b"t=%d adc=%d LOOK>%d\r\n" % (i, (i*37)%4096, j))
+            i += 1
+        lines.append(b"\x04\x04>")
+    return b"".join(lines)
+
+def streamreader(data, blocksize):
+    pos = [0]
+    def readavailable(timeout=None):
+        b = data[pos[0]:pos[0]+blocksize]
+        pos[0] += blocksize
+        return b
+    return readavailable
+
+def chunkreader(chunks):
+    it = iter(chunks)
+    def readavailable(timeout=None):
+        return next(it, b'')
+    return readavailable
+
+def runtokens(gen):
+    tokens = [ ]
+    for t in gen:
+        if t == b'':
+            break   # stream exhausted (after serialtimeoutcount empty reads)
+        tokens.append(t)
+    return tokens
+
+# noise lines among the output, split at every place (including in the middle of each \r\n) and at random
+def checknoisesplits(nrandom=2000):
+    lines = [ (b"I (%d) wifi: up\r\n" % i  if i%3 == 0  else b"line %d>x\r\n" % i)  for i in range(30) ]
+    data = b"OK" + b"".join(lines) + b"\x04\x04>"
+    def tokens(chunks):
+        return runtokens(deviceconnector.yieldchunktokens(chunkreader(chunks), deviceconnector.NoiseFilter()))
+    expected = tokens([data])
+    assert b"".join(expected) == b"OK" + b"".join(l  for l in lines  if b"wifi" not in l) + b"\x04\x04>", "noise lines not dropped"
+    assert tokens([b"I (1) wifi: up\r", b"\nreal output line\r\n\x04\x04>"]) == [b"real output line\r\n", b"\x04", b"\x04", b">"], "line after a split noise line lost"
+    for i in range(1, len(data)):
+        assert tokens([data[:i], data[i:]]) == expected, "tokens differ when split at {}".format(i)
+    rnd = random.Random(0)
+    for n in range(nrandom):
+        cuts = sorted(rnd.sample(range(1, len(data)), rnd.randint(1, 40)))
+        assert tokens([ data[i:j]  for i, j in zip([0] + cuts, cuts + [len(data)]) ]) == expected, "tokens differ when split at {}".format(cuts)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--kbytes', type=int, default=512)
+    ap.add_argument('--blocksize', type=int, default=4096)
+    ap.add_argument('--noisefilter', help="run the bulk-read tokenizer with the default noise filter", action='store_true')
+    args = ap.parse_args()
+    checknoisesplits()
+    data = makestream(args.kbytes*1024)
+
+    t0 = time.perf_counter()
+    legacytokens = runtokens(legacyyieldchunktokens(streamreader(data, 1)))
+    t1 = time.perf_counter()
+    noisefilter = deviceconnector.NoiseFilter()  if args.noisefilter  else None
+    tokens = runtokens(deviceconnector.yieldchunktokens(streamreader(data, args.blocksize), noisefilter))
+    t2 = time.perf_counter()
+
+    assert tokens == legacytokens, "token streams differ"
+    print("{} bytes, {} tokens".format(len(data), len(tokens)))
+    print("byte-at-a-time:  {:10.0f} tokens/s  {:8.3f}s".format(len(legacytokens)/(t1-t0), t1-t0))
+    print("bulk-read:       {:10.0f} tokens/s  {:8.3f}s".format(len(tokens)/(t2-t1), t2-t1))
+    print("speedup:         {:10.1f}x".format((t1-t0)/(t2-t1)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+# A stand-in MicroPython device for the benchmarks.  It answers like the raw REPL (OK, output, \x04,
+# errors, \x04, > and raw-paste mode with its window flow control), prints the reboot banner on
+# machine.reset() or a soft reboot, and can be reached over a pty (as a serial port), a TCP socket or
+# a WebREPL-style websocket.  The programs it is sent run in this Python, with shims for the MicroPython
+# modules the kernel uses and a file system kept in a local directory.  Latency is added before each
+# reply and the baud rate limits how fast bytes go each way.  With noise, that fraction of the bytes 
+# programs read from sys.stdin.buffer or write to sys.stdout.buffer are garbled or lost.  With a raw-paste 
+# window of 0 it is firmware from before 1.14, which has no raw-paste mode.
+#
+#   python benchmarks/simdevice.py --pty [--latency 0.01] [--baud 115200] [--noise 0.0001] [--oldfirmware]
+#   python benchmarks/simdevice.py --tcp 9999
+#   python benchmarks/simdevice.py --websocket 8266 --password pass
+
+import argparse, os, sys, types, time, threading, socket, tempfile, traceback, random
+import binascii, hashlib, zlib, base64, struct
+
+banner = b'MicroPython v1.22.0 on 2024-01-01; simdevice with CPython\r\nType "help()" for more information.\r\n>>> '
+rawreplbanner = b'raw REPL; CTRL-B to exit\r\n>'
+
+class SimReset(Exception):
+    pass
+
+class SimStdoutBuffer:   # sys.stdout.buffer, which sends the bytes as they are
+    def __init__(self, device):
+        self.device = device
+    def write(self, b):
+        self.device.output(self.device.garble(bytes(b), False))
+        return len(b)
+
+class SimStdinBuffer:   # sys.stdin.buffer, reading what comes from the host after the program
+    def __init__(self, device):
+        self.device = device
+    def readinto(self, buf):   # fills buf, as MicroPython's stdio does, waiting for the bytes
+        mv = memoryview(buf).cast("B")
+        n = 0
+        while n < len(mv):
+            if not self.device.inbuf:
+                self.device.flush()   # what the program has written is waited on by the host
+                data = self.device.receive()  if self.device.receive  else b''
+                if not data:
+                    raise OSError("stdin closed")
+                self.device.nreceived += len(data)
+                self.device.inbuf += self.device.garble(data, True)
+                continue
+            b, self.device.inbuf = self.device.inbuf[:len(mv) - n], self.device.inbuf[len(mv) - n:]
+            if self.device.kbdintr and self.device.kbdintr in b:
+                raise KeyboardInterrupt()
+            mv[n:n+len(b)] = b
+            n += len(b)
+        return n
+    def read(self, n):
+        buf = bytearray(n)
+        self.readinto(buf)
+        return bytes(buf)
+
+class SimStdout:   # device stdout, with \n sent as \r\n like the MicroPython UART
+    def __init__(self, device):
+        self.device = device
+        self.buffer = SimStdoutBuffer(device)
+    def write(self, s):
+        b = s.encode() if type(s) == str else bytes(s)
+        self.device.output(b.replace(b'\n', b'\r\n'))
+        return len(s)
+
+class DeflateIO:   # enough of the deflate module of MicroPython 1.21+ for the kernel's programs
+    def __init__(self, stream, format=1, wbits=0, close=False):
+        self.stream = stream
+        self.wbits = wbits or 15
+        self.zin = None
+        self.zout = None
+        self.pending = b''
+    def readinto(self, buf):
+        if self.zin is None:
+            self.zin = zlib.decompressobj()
+        while len(self.pending) < len(buf) and not self.zin.eof:
+            d = self.stream.read(512)
+            if not d:
+                break
+            self.pending += self.zin.decompress(d)
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+    def read(self, n=-1):
+        res = [ ]
+        buf = bytearray(512)
+        while n < 0 or sum(map(len, res)) < n:
+            k = self.readinto(buf)
+            if not k:
+                break
+            res.append(bytes(buf[:k]))
+        b = b''.join(res)
+        if n >= 0:
+            self.pending = b[n:] + self.pending
+            b = b[:n]
+        return b
+    def write(self, b):
+        if self.zout is None:
+            self.zout = zlib.compressobj(9, zlib.DEFLATED, self.wbits)
+        self.stream.write(self.zout.compress(bytes(b)))
+        return len(b)
+    def close(self):
+        if self.zout is not None:
+            self.stream.write(self.zout.flush())
+
+
+# The raw REPL as a state machine fed with the bytes from the host.  Programs are run on the thread
+# that feeds them, so a Ctrl-C only gets seen once the running program has finished (or when it reads
+# stdin, which takes the bytes after the program and then more through receive).
+class SimDevice:
+    def __init__(self, send, root, latency=0, baud=0, memfree=100000, rawpastewindow=128, startmode="normal", noise=0):
+        self.send = send
+        self.receive = None      # more bytes from the host, for programs reading stdin, set by the transport
+        self.root = root
+        self.latency = latency
+        self.baud = baud
+        self.memfree = memfree
+        self.rawpastewindow = rawpastewindow
+        self.pastestall = False   # holding back the window increments of raw-paste mode, as a device that has stopped reading would
+        self.mode = startmode    # normal, raw, paste
+        self.inbuf = b''
+        self.rawline = b''       # program collected in the raw REPL
+        self.outbuf = [ ]
+        self.nreceived = 0
+        self.nsent = 0
+        self.noise = noise
+        self.random = random.Random(0)
+        self.modules = self.makemodules()
+        self.resetglobals()
+
+    def resetglobals(self):
+        import builtins
+        dbuiltins = dict(builtins.__dict__)
+        dbuiltins["__import__"] = self.simimport
+        dbuiltins["open"] = lambda filename, mode="r": open(self.hostpath(filename), mode)
+        dbuiltins["print"] = lambda *args, **kwargs: builtins.print(*args, **dict(kwargs, file=kwargs.get("file") or self.modules["sys"].stdout))
+        def simexec(source, g=None, l=None):   # with the device's builtins in the globals it is given
+            if g is not None:
+                g.setdefault("__builtins__", dbuiltins)
+            builtins.exec(source, self.globals  if g is None  else g, l)
+        dbuiltins["exec"] = simexec
+        self.globals = { "__builtins__": dbuiltins, "__name__": "__main__" }
+        self.devicemodules = { }   # imported from .py files in the device root, until the next reset
+        self.kbdintr = b'\x03'
+
+    def garble(self, b, bdrop):   # with noise, some bytes flipped (or when bdrop, also some lost)
+        if not self.noise:
+            return b
+        b = bytearray(b)
+        i = int(self.random.expovariate(self.noise))
+        while i < len(b):
+            if bdrop and self.random.random() < 0.5:
+                del b[i]
+            else:
+                b[i] ^= self.random.randrange(1, 256)
+            i += 1 + int(self.random.expovariate(self.noise))
+        return bytes(b)
+
+    def hostpath(self, filename):   # the device file system lives under self.root
+        return os.path.join(self.root, os.path.normpath("/" + filename).lstrip("/"))
+
+    def makemodules(self):
+        def ilistdir(d=""):
+            for name in sorted(os.listdir(self.hostpath(d))):
+                p = os.path.join(self.hostpath(d), name)
+                if os.path.isdir(p):
+                    yield (name, 0x4000, 0, 0)
+                else:
+                    yield (name, 0x8000, 0, os.path.getsize(p))
+        def stat(filename):
+            st = os.stat(self.hostpath(filename))
+            return ((0x4000 if os.path.isdir(self.hostpath(filename)) else 0x8000), 0, 0, 0, 0, 0, st.st_size, int(st.st_atime), int(st.st_mtime), int(st.st_ctime))
+        def reset():
+            raise SimReset()
+        mos = types.SimpleNamespace(ilistdir=ilistdir, stat=stat, listdir=lambda d="": sorted(os.listdir(self.hostpath(d))),
+                                    mkdir=lambda d: os.mkdir(self.hostpath(d)), rmdir=lambda d: os.rmdir(self.hostpath(d)),
+                                    remove=lambda f: os.remove(self.hostpath(f)), rename=lambda a, b: os.rename(self.hostpath(a), self.hostpath(b)),
+                                    getcwd=lambda: "/", sep="/")
+        msys = types.SimpleNamespace(stdout=SimStdout(self), stdin=types.SimpleNamespace(buffer=SimStdinBuffer(self)),
+                                     platform="simdevice", implementation=types.SimpleNamespace(name="micropython"))
+        mgc = types.SimpleNamespace(collect=lambda: None, mem_free=lambda: self.memfree)
+        mdeflate = types.SimpleNamespace(DeflateIO=DeflateIO, RAW=0, ZLIB=1, GZIP=2, AUTO=3)
+        mmachine = types.SimpleNamespace(reset=reset, soft_reset=reset)
+        muzlib = types.SimpleNamespace(decompress=zlib.decompress)
+        def kbd_intr(c):
+            self.kbdintr = bytes([c])  if c >= 0  else None
+        mmicropython = types.SimpleNamespace(kbd_intr=kbd_intr)
+        return { "micropython": mmicropython, "os": mos, "uos": mos, "sys": msys, "gc": mgc, "ubinascii": binascii, "binascii": binascii, "uhashlib": hashlib,
+                 "hashlib": hashlib, "deflate": mdeflate, "machine": mmachine, "uzlib": muzlib }
+
+    def simimport(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if name in self.modules:
+            return self.modules[name]
+        if name in self.devicemodules:
+            return self.devicemodules[name]
+        if os.path.isfile(self.hostpath(name + ".py")):
+            module = types.ModuleType(name)
+            module.__dict__["__builtins__"] = self.globals["__builtins__"]
+            with open(self.hostpath(name + ".py")) as fin:
+                exec(fin.read(), module.__dict__)
+            self.devicemodules[name] = module
+            return module
+        return __import__(name, globals, locals, fromlist, level)
+
+    def output(self, b):   # from the running program
+        self.outbuf.append(b)
+        if sum(map(len, self.outbuf)) >= 1024:
+            self.flush()
+
+    def flush(self):
+        if self.outbuf:
+            b = b''.join(self.outbuf)
+            self.outbuf.clear()
+            self.write(b)
+
+    def write(self, b):
+        if self.baud:
+            time.sleep(len(b)*10/self.baud)
+        self.nsent += len(b)
+        self.send(b)
+
+    def run(self, program):   # returns False if the program reset the device
+        if self.latency:
+            time.sleep(self.latency)
+        err = b''
+        try:
+            exec(compile(program.decode(), "<stdin>", "exec"), self.globals)
+        except SimReset:
+            self.flush()
+            self.resetglobals()
+            self.mode = "normal"
+            self.write(b'\r\n' + banner)
+            return False
+        except (Exception, KeyboardInterrupt) as e:   # a Ctrl-C read by the program ends it as on the device
+            tb = [ frame  for frame in traceback.extract_tb(e.__traceback__)  if frame.filename == "<stdin>" ]
+            lineno = tb[-1].lineno  if tb  else 0
+            err = 'Traceback (most recent call last):\r\n  File "<stdin>", line {}, in <module>\r\n{}: {}\r\n'.format(lineno, type(e).__name__, e).encode()
+        self.flush()
+        self.write(b'\x04' + err + b'\x04>')
+        return True
+
+    def feed(self, data):
+        if self.baud:
+            time.sleep(len(data)*10/self.baud)
+        self.nreceived += len(data)
+        self.inbuf += data
+        while self.inbuf:
+            if self.mode == "normal":
+                c, self.inbuf = self.inbuf[:1], self.inbuf[1:]
+                if c == b'\x01':
+                    self.mode = "raw"
+                    self.write(b'\r\n' + rawreplbanner)
+                elif c == b'\x03':
+                    self.write(b'\r\n>>> ')
+                elif c == b'\x04':
+                    self.resetglobals()
+                    self.write(b'\r\nMPY: soft reboot\r\n' + banner)
+                elif c == b'\r':
+                    self.write(b'\r\n>>> ')
+                elif c >= b' ':
+                    self.write(c)   # echo; lines typed at the normal REPL are not run
+
+            elif self.mode == "raw":
+                i = min((j  for j in map(self.inbuf.find, (b'\x01', b'\x02', b'\x03', b'\x04', b'\x05'))  if j != -1), default=-1)
+                if i == -1:
+                    self.rawline += self.inbuf
+                    self.inbuf = b''
+                    break
+                self.rawline += self.inbuf[:i]
+                c, self.inbuf = self.inbuf[i:i+1], self.inbuf[i+1:]
+                if c == b'\x05' and not self.rawpastewindow:
+                    self.rawline += c   # just another character to old firmware
+                    continue
+                if c == b'\x05':
+                    if len(self.inbuf) < 2:
+                        self.inbuf = c + self.inbuf
+                        break   # wait for the rest of the raw-paste request
+                    if self.inbuf[:2] == b'A\x01':
+                        self.inbuf = self.inbuf[2:]
+                        if self.latency:
+                            time.sleep(self.latency)
+                        self.write(b'R\x01' + struct.pack("<H", self.rawpastewindow))
+                        self.mode = "paste"
+                        self.pastebuf = b''
+                        self.pastewindowend = self.rawpastewindow
+                    continue
+                program, self.rawline = self.rawline, b''
+                if c == b'\x01':
+                    self.write(rawreplbanner)
+                elif c == b'\x02':
+                    self.mode = "normal"
+                    self.write(b'\r\n' + banner)
+                elif c == b'\x04' and not program.strip():
+                    self.resetglobals()
+                    self.write(b'OK\r\nMPY: soft reboot\r\n' + rawreplbanner)
+                elif c == b'\x04':
+                    self.write(b'OK')
+                    self.run(program)
+
+            elif self.mode == "paste":
+                i = min((j  for j in map(self.inbuf.find, (b'\x03', b'\x04'))  if j != -1), default=-1)
+                take = self.inbuf if i == -1 else self.inbuf[:i]
+                self.pastebuf += take
+                while len(self.pastebuf) >= self.pastewindowend and not self.pastestall:
+                    self.pastewindowend += self.rawpastewindow
+                    self.write(b'\x01')   # room for another window
+                if i == -1:
+                    self.inbuf = b''
+                    break
+                c, self.inbuf = self.inbuf[i:i+1], self.inbuf[i+1:]
+                self.write(b'\x04')
+                self.mode = "raw"
+                if c == b'\x03':   # the data is ended by a KeyboardInterrupt
+                    self.write(b'\x04Traceback (most recent call last):\r\n  File "<stdin>", line 1\r\nKeyboardInterrupt: \r\n\x04>')
+                else:
+                    self.run(self.pastebuf)
+
+
+def makeroot(root):
+    return root or tempfile.mkdtemp(prefix="simdevice")
+
+# returns the name of the pty to open as a serial port and the device behind it
+def startpty(root=None, **kwargs):
+    import pty, tty
+    m, s = pty.openpty()
+    tty.setraw(m)
+    tty.setraw(s)
+    device = SimDevice(lambda b: os.write(m, b), makeroot(root), **kwargs)
+    device.receive = lambda: os.read(m, 4096)
+    def run():
+        while True:
+            try:
+                data = os.read(m, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            device.feed(data)
+    threading.Thread(target=run, name="simdevice-pty", daemon=True).start()
+    device.ptyslave = s   # kept open so the pty isn't closed between connections
+    return os.ttyname(s), device
+
+# a socket REPL, which the kernel's %socketconnect expects to be already in the raw REPL
+def starttcp(port=0, root=None, **kwargs):
+    root = makeroot(root)
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(5)
+    def serve(conn):
+        device = SimDevice(conn.sendall, root, startmode="raw", **kwargs)
+        device.receive = lambda: conn.recv(4096)
+        while True:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            device.feed(data)
+        conn.close()
+    def accept():
+        while True:
+            conn, addr = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=serve, args=(conn,), name="simdevice-tcp", daemon=True).start()
+    threading.Thread(target=accept, name="simdevice-tcpaccept", daemon=True).start()
+    return server.getsockname()
+
+# just enough websocket (RFC 6455) for the WebREPL: text frames while it can, binary otherwise
+websocketguid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def websocketframe(b):
+    opcode = 0x01
+    try:
+        b.decode()
+    except UnicodeDecodeError:
+        opcode = 0x02
+    n = len(b)
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + b
+
+def readwebsocketframes(conn):   # yields (opcode, payload) of the masked frames from the client
+    buf = b''
+    while True:
+        while True:
+            if len(buf) >= 2:
+                n = buf[1] & 0x7f
+                i = 2
+                if n == 126 and len(buf) >= 4:
+                    n, i = struct.unpack("!H", buf[2:4])[0], 4
+                elif n == 127 and len(buf) >= 10:
+                    n, i = struct.unpack("!Q", buf[2:10])[0], 10
+                if n < 126 or i > 2:
+                    if len(buf) >= i + 4 + n:
+                        mask = buf[i:i+4]
+                        payload = bytes(c ^ mask[j%4]  for j, c in enumerate(buf[i+4:i+4+n]))
+                        yield buf[0] & 0x0f, payload
+                        buf = buf[i+4+n:]
+                        continue
+            break
+        data = conn.recv(65536)
+        if not data:
+            return
+        buf += data
+
+def startwebsocket(port=0, password="pass", root=None, **kwargs):
+    root = makeroot(root)
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(5)
+    def serve(conn):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            data = conn.recv(4096)
+            if not data:
+                return conn.close()
+            request += data
+        headers = dict((k.strip().lower(), v.strip())  for k, _, v in (l.partition(b":")  for l in request.split(b"\r\n")[1:])  if v)
+        accept = base64.b64encode(hashlib.sha1(headers[b"sec-websocket-key"] + websocketguid).digest())
+        conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        sendlock = threading.Lock()
+        def send(b):
+            with sendlock:
+                conn.sendall(websocketframe(b))
+        device = SimDevice(send, root, **kwargs)
+        frames = readwebsocketframes(conn)
+        device.receive = lambda: next((payload  for opcode, payload in frames  if opcode in (0x00, 0x01, 0x02)), b'')
+        send(b"Password: ")
+        passwordline = b''
+        for opcode, payload in frames:
+            if opcode == 0x08:
+                break
+            if opcode == 0x09:
+                with sendlock:
+                    conn.sendall(struct.pack("!BB", 0x8a, len(payload)) + payload)
+                continue
+            if passwordline is not None:
+                passwordline += payload
+                if b'\r' in passwordline:
+                    if passwordline.partition(b'\r')[0] != password.encode():
+                        send(b"\r\nAccess denied\r\n")
+                        break
+                    send(b"\r\nWebREPL connected\r\n>>> ")
+                    passwordline = None
+                continue
+            device.feed(payload)
+        conn.close()
+    def accept():
+        while True:
+            conn, addr = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=serve, args=(conn,), name="simdevice-websocket", daemon=True).start()
+    threading.Thread(target=accept, name="simdevice-websocketaccept", daemon=True).start()
+    return "ws://127.0.0.1:{}".format(server.getsockname()[1])
+
+def main():
+    ap = argparse.ArgumentParser(description="simulated MicroPython device")
+    ap.add_argument('--pty', action='store_true')
+    ap.add_argument('--tcp', type=int)
+    ap.add_argument('--websocket', type=int)
+    ap.add_argument('--password', type=str, default="pass")
+    ap.add_argument('--root', type=str, help="directory holding the device file system")
+    ap.add_argument('--latency', type=float, default=0)
+    ap.add_argument('--baud', type=int, default=0)
+    ap.add_argument('--memfree', type=int, default=100000)
+    ap.add_argument('--noise', type=float, default=0, help="fraction of the bytes of binary program input and output garbled")
+    ap.add_argument('--oldfirmware', help="without raw-paste mode, as before MicroPython 1.14", action='store_true')
+    args = ap.parse_args()
+    kwargs = dict(root=args.root, latency=args.latency, baud=args.baud, memfree=args.memfree, noise=args.noise)
+    if args.oldfirmware:
+        kwargs["rawpastewindow"] = 0
+    if args.pty:
+        print("%serialconnect --port={}".format(startpty(**kwargs)[0]))
+    if args.tcp is not None:
+        print("%socketconnect {} {}".format(*starttcp(args.tcp, **kwargs)))
+    if args.websocket is not None:
+        print("%websocketconnect {} --password {}".format(startwebsocket(args.websocket, args.password, **kwargs), args.password))
+    sys.stdout.flush()
+    while True:
+        time.sleep(3600)
+
+if __name__ == '__main__':
+    main()
@@ -1,132 +1,1038 @@
-import logging, sys, time, os, re, binascii, subprocess, ast
-import serial, socket, serial.tools.list_ports, select
-import websocket  # the old non async one
+import logging, sys, time, os, re, binascii, subprocess, zlib, threading, hashlib, tempfile, concurrent.futures, queue, glob, struct
+import socket, select
+
+# pyserial and websocket-client (the old non async one) are only imported by importserial and importwebsocket
+# when a connection of their kind is first wanted, which keeps them off the time it takes the kernel to start;
+# until then nothing can have raised their exceptions, which are caught through these tuples
+serial = None
+websocket = None
+serialerrors = ( )      # (serial.SerialException, )
+websocketerrors = ( )   # (websocket.WebSocketException, )
+
+def importserial():
+    global serial, serialerrors
+    if serial is None:
+        import serial.tools.list_ports
+        serialerrors = (serial.SerialException, )
+    return serial
+
+def importwebsocket():
+    global websocket, websocketerrors
+    if websocket is None:
+        import websocket
+        websocketerrors = (websocket.WebSocketException, )
+    return websocket
 
 serialtimeout = 0.5
 serialtimeoutcount = 10
+partialtimeout = 0.05   # a part line is passed on after the device has been quiet for this long
+deflatewbits = 10   # 1KB window, which small devices can afford when inflating
+ringbuffersize = 1<<20   # bytes held from the device while nothing is consuming them
+readeractivetime = 1.0   # seconds since the last read for which a full buffer waits rather than drops
+readblocksize = 65536    # most taken by the tokenizer at once, so it is back for more well within readeractivetime
+
+# what the REPL prints that the handshakes wait for, and how long for
+normalprompt = b'>>> '
+rawreplprompt = b'raw REPL; CTRL-B to exit\r\n>'
+softreboot = b'soft reboot\r\n'   # the banner after it is also printed by the Ctrl-B before it, so it isn't enough alone
+rebootbanner = b'Type "help()" for more information.\r\n>>> '
+prompttimeout = 0.3      # a Ctrl-C answered by the normal prompt (longer if the device is already in the raw REPL)
+rawrepltimeout = 1.0     # tries at getting the raw REPL prompt, as the device may still be printing its boot messages
+rawreplattempts = 3
+reboottimeout = 5.0
+
+# reconnecting after the link breaks: tries are spaced from the min to the max delay, doubling each time
+reconnecttimeout = 120.0
+reconnectmindelay = 0.5
+reconnectmaxdelay = 16.0
+
+# frames of a %stream: sync, payload length, sequence number and CRC32 of the length, sequence number and payload
+streamsync = b'\xa5Z'
+streamheader = struct.Struct("<2sHHI")
+streamflushsize = 65536   # bytes of records decoded into the array at once
+streamreporttime = 1.0
+
+# binary file transfers over serial go in frames of the same format, with the block index as the sequence
+# number, through the raw REPL's stdin and stdout (see sendframes and fetchframes)
+fileblocksize = 1024
+filewindowmax = 8          # frames sent ahead of the acknowledgements
+fileacktimeout = 1.0       # after which the frame being waited on is taken as lost
+fileretries = 3            # errors in a row (or rounds of fetching the missing blocks) before giving up
+
+# the percentage in esptool's progress lines, "Writing at 0x00010000... (12 %)" or in newer versions "... 12.3% ..."
+esptoolprogress = re.compile(r"(?:\(\s*|\s)(\d+(?:\.\d+)?)\s?%")
+esptoolprogresstime = 0.2   # least time between updates of the progress line
+
+# compiled .mpy files kept by MpyCrossCache
+mpycrosscachedir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "jupyter_micropython_kernel", "mpy")
+mpycrossnotcompiled = ("boot.py", "main.py")   # run by name at startup, so they must stay as source
+
+# The helper that ensurehelper puts on the device once per connection as O_, so that the file commands are 
+# one-line calls to it rather than programs that are sent and compiled every time.  It is kept in RAM, or 
+# with %helper --flash it is also saved as the module devicehelpermodule, which the probe imports if it is 
+# there.  devicehelperversion is to be bumped with any change to it, so the old one gets replaced.
+devicehelperversion = 2
+devicehelpermodule = "jupyterhelper"
+devicehelper = """import os,sys,gc
+try:
+ from binascii import a2b_base64,b2a_base64,hexlify
+except ImportError:
+ from ubinascii import a2b_base64,b2a_base64,hexlify
+try:
+ from binascii import crc32
+ import micropython,struct
+ F=hasattr(sys.stdin,'buffer') and hasattr(micropython,'kbd_intr')
+except ImportError:
+ F=False
+V=%d
+f=None
+def md(p):
+ l=[x for x in p.split('/')[:-1] if x]
+ for i in range(len(l)):
+  try:
+   os.mkdir(('/' if p[:1]=='/' else '')+'/'.join(l[:i+1]))
+  except OSError:
+   pass
+def put(p,m,d=0):
+ global f
+ if d:
+  md(p)
+ f=open(p,m)
+def w(s):
+ f.write(a2b_base64(s))
+def t(s):
+ f.write(s)
+def seek(n):
+ f.seek(n)
+def close():
+ global f
+ f.close()
+ f=None
+def mem():
+ gc.collect()
+ print(gc.mem_free())
+def stat(p):
+ print(os.stat(p)[6])
+def get(p,n):
+ o=open(p,'rb')
+ b=bytearray(n)
+ sys.stdout.write(b2a_base64(o.read(os.stat(p)[6]%%n)))
+ while o.readinto(b):
+  sys.stdout.write(b2a_base64(b))
+ o.close()
+def ls(d,r):
+ l=list(os.ilistdir(d))
+ print('D',d)
+ for x in l:
+  print(-1 if x[1]==0x4000 else (x[3] if len(x)>3 else 0),x[0])
+ if r:
+  for x in l:
+   if x[1]==0x4000:
+    ls(d+'/'+x[0],r)
+def hashdir(d,hl,b):
+ try:
+  l=list(os.ilistdir(d) if d else os.ilistdir())
+ except OSError:
+  return
+ for x in l:
+  p=d.rstrip('/')+'/'+x[0] if d else x[0]
+  if x[1]==0x4000:
+   hashdir(p,hl,b)
+   continue
+  h=hl.sha256()
+  o=open(p,'rb')
+  while True:
+   n=o.readinto(b)
+   if not n:
+    break
+   h.update(memoryview(b)[:n])
+  o.close()
+  print(hexlify(h.digest()).decode(),p)
+def hashes(d):
+ try:
+  import hashlib as hl
+ except ImportError:
+  import uhashlib as hl
+ hashdir(d,hl,bytearray(512))
+def rm(l):
+ for x in l:
+  os.remove(x)
+def rx(n,b):
+ i=sys.stdin.buffer
+ o=sys.stdout.buffer
+ a=lambda x,j:o.write(x+struct.pack('<HH',j&0xffff,~j&0xffff))
+ h=bytearray(10)
+ m=memoryview(h)
+ d=bytearray(b)
+ v=memoryview(d)
+ j=0
+ micropython.kbd_intr(-1)
+ try:
+  a(b'A',0)
+  while True:
+   i.readinto(m)
+   while h[0]!=0xa5 or h[1]!=0x5a:
+    h[:9]=h[1:]
+    i.readinto(m[9:])
+   k,q,c=struct.unpack_from('<HHI',h,2)
+   if k<=b:
+    i.readinto(v[:k])
+   if k>b or crc32(v[:k],crc32(m[2:6]))!=c:
+    a(b'N',j)
+   elif k==0:
+    break
+   elif q==j&0xffff and j*b<n:
+    f.write(v[:k])
+    j+=1
+    a(b'A',j)
+ finally:
+  micropython.kbd_intr(3)
+def tx(p,b,l=None):
+ o=sys.stdout.buffer
+ d=bytearray(b)
+ v=memoryview(d)
+ def s(k,j):
+  h=struct.pack('<HH',k,j&0xffff)
+  o.write(b'\\xa5Z'+h+struct.pack('<I',crc32(v[:k],crc32(h))))
+  o.write(v[:k])
+ g=open(p,'rb')
+ for j in (range((os.stat(p)[6]+b-1)//b) if l is None else l):
+  g.seek(j*b)
+  s(g.readinto(d),j)
+ g.close()
+ s(0,0)
+""" % devicehelperversion
+# prints the version of the helper there is (0 for none) and whether it can transfer files in frames, 
+# importing it from flash if it has been saved there
+devicehelperprobe = """try:
+ O_.V
+except (NameError,AttributeError):
+ try:
+  import %s as O_
+ except ImportError:
+  O_=None
+print(getattr(O_,'V',0),int(getattr(O_,'F',0)))
+""" % devicehelpermodule
+# defines it in RAM, as a class whose attributes are what the helper's code defines
+devicehelperinstall = """class O_:
+ pass
+O9={}
+exec(%s,O9)
+for O in O9:
+ setattr(O_,O,O9[O])
+del O,O9
+""" % repr(devicehelper)
+devicehelperinstalled = "print(O_.V,int(O_.F))\n"
+
+# the serial ports are enumerated again when the entries here change (as udev adds and removes them on a
+# hotplug), or where there is no such directory when they were enumerated more than portrescantime ago
+sysclasstty = "/sys/class/tty"
+portrescantime = 2.0
 
 wifimessageignore = re.compile("(\x1b\[[\d;]*m)?[WI] \(\d+\) (wifi|system_api|modsocket|phy|event|cpu_start|heap_init|network|wpa): ")
+defaultnoiserules = [ ("esp-idf", wifimessageignore.pattern) ]
+
+# Keeps the serial ports from one enumeration until they change, so that connecting and reconnecting don't
+# wait on a scan of every USB device.  The ports are ordered by the USB serial number of the board and then
+# the physical USB socket it is plugged into, rather than by port name, so that an index picks the same
+# board when the names are handed out in a different order after replugging.
+class PortRegistry:
+    def __init__(self):
+        self.portinfos = None   # the ListPortInfo of each port
+        self.signature = None
+        self.tscan = 0
+        self.nscans = 0
+
+    def getsignature(self):   # None where ports can't be watched through sysfs
+        try:
+            with os.scandir(sysclasstty) as entries:
+                return frozenset((entry.name, entry.inode(), entry.stat(follow_symlinks=False).st_ctime_ns)  for entry in entries)   # a port plugged in again comes back as a new entry
+        except OSError:
+            return None
+
+    def ports(self, brescan=False):
+        signature = self.getsignature()
+        if brescan or self.portinfos is None or (signature != self.signature  if signature is not None  else time.monotonic() - self.tscan > portrescantime):
+            lp = list(importserial().tools.list_ports.comports())
+            lp.sort(key=lambda x: (x.hwid == "n/a", x.vid is None, x.serial_number or "", x.location or "", x.device))  # n/a could be good evidence that the port is non-existent
+            self.portinfos = lp
+            self.signature = signature
+            self.tscan = time.monotonic()
+            self.nscans += 1
+        return self.portinfos
+
+    def identity(self, portname):   # (VID, PID, serial number) of a USB serial port, which stays the same when it comes back under another name
+        for x in self.ports():
+            if x.device == portname and x.vid is not None:
+                return (x.vid, x.pid, x.serial_number)
+        return None
+
+    def find(self, usbid):
+        for x in self.ports():
+            if x.vid is not None and (x.vid, x.pid, x.serial_number) == usbid:
+                return x.device
+        return None
+
+    def findserialnumber(self, serialnumber):   # so that a board can be asked for by its serial number as --port
+        for x in self.ports():
+            if x.serial_number and x.serial_number == serialnumber:
+                return x.device
+        return None
+
+portregistry = PortRegistry()
 
-# this should take account of the operating system
 def guessserialport():  
-    lp = list(serial.tools.list_ports.grep(""))
-    lp.sort(key=lambda X: (X.hwid == "n/a", X.device))  # n/a could be good evidence that the port is non-existent
-    return [x.device  for x in lp]
+    return [x.device  for x in portregistry.ports()]
 
-# merge uncoming serial stream and break at OK, \x04, >, \r\n, and long delays 
+# the port name given, a board by its USB serial number, or else by its index in the list of %ports (None if 
+# there is no such index); serial numbers come before indexes as some (eg CP210x ones) are all digits, like "0001"
+def resolveport(portname):
+    if os.path.exists(portname):
+        return portname
+    serialportname = portregistry.findserialnumber(portname)
+    if serialportname:
+        return serialportname
+    if portname.isdigit():
+        possibleports = guessserialport()
+        return possibleports[int(portname)]  if int(portname) < len(possibleports)  else None
+    return portname
+
+def expandports(portspec):   # port names, indexes, serial numbers and globs (eg /dev/ttyUSB*) separated by commas
+    portnames = [ ]
+    for p in portspec.split(","):
+        if glob.has_magic(p):
+            portnames.extend(sorted(glob.glob(p)))
+        elif p:
+            portnames.append(resolveport(p) or p)
+    return portnames
+
+# Runs the commands at the same time, with both pipes of each read by threads of their own so that none 
+# of them can block on a full pipe.  online(index, text, bstderr) is called from the caller's thread with 
+# each piece of output as it ends with \n or \r (progress lines often only end with \r), and onidle() when 
+# there's been nothing for a moment.  Returns the exit codes; the processes are killed on an interrupt.
+def runprocesses(pargslist, online, onidle):
+    processes = [ subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)  for pargs in pargslist ]
+    outqueue = queue.Queue()
+    def readpipe(index, pipe, bstderr):
+        part = b''
+        while True:
+            b = pipe.read1(4096)
+            if not b:
+                break
+            ls = re.split(b'(?<=[\r\n])', part + b)
+            part = ls.pop()
+            for l in ls:
+                outqueue.put((index, l, bstderr))
+        if part:
+            outqueue.put((index, part, bstderr))
+        outqueue.put((index, None, bstderr))
+    for index, process in enumerate(processes):
+        for pipe, bstderr in ((process.stdout, False), (process.stderr, True)):
+            threading.Thread(target=readpipe, args=(index, pipe, bstderr), name="processpipe", daemon=True).start()
+    nopen = 2*len(processes)
+    try:
+        while nopen:
+            try:
+                index, l, bstderr = outqueue.get(timeout=partialtimeout)
+            except queue.Empty:
+                onidle()
+                continue
+            if l is None:
+                nopen -= 1
+            else:
+                online(index, l.decode(errors="replace"), bstderr)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.kill()
+        raise
+    return [ process.wait()  for process in processes ]
+
+# read whatever is available on the connection in one go, returning b'' after timeout with no data
 # (must make this a member function so does not have to switch on the type of s)
+def serialreadfunction(s):
+    if serial and type(s) == serial.Serial:
+        def readavailable(timeout=serialtimeout):
+            n = s.in_waiting
+            return s.read(n or 1)   # blocks up to serialtimeout (set on the port) for the first byte when nothing is waiting
+
+    elif websocket and isinstance(s, websocket.WebSocket):
+        def readavailable(timeout=serialtimeout):
+            r,w,e = select.select([s], [], [], timeout)
+            if not r:
+                return b''
+            b = s.recv()   # whole frames come back, sometimes as strings
+            if type(b) == str:
+                b = b.encode("utf8")   # handle fact that strings come back from this interface
+            return b
+
+    else:  # socket (made with makefile, so the real socket is underneath)
+        sock = getattr(s, "_sock", s)
+        def readavailable(timeout=serialtimeout):
+            r,w,e = select.select([sock], [], [], timeout)
+            if not r:
+                return b''
+            return sock.recv(4096)
+
+    return readavailable
+
+# Drains the connection all the time on a background thread, so the device never stalls on a full 
+# transmit buffer between cells.  What arrives waits in a buffer of at most maxsize bytes, from which 
+# the oldest bytes are dropped (and counted) if nothing takes them.  While something is reading (as 
+# during a cell) a full buffer instead holds off reading more, so a burst of output is slowed down 
+# rather than lost.  An exception on the connection stops the thread and is raised again on every read.
+class DeviceReader:
+    def __init__(self, readavailable, maxsize=ringbuffersize):
+        self.readavailable = readavailable
+        self.maxsize = maxsize
+        self.buf = bytearray()
+        self.nreceived = 0
+        self.ndropped = 0
+        self.exception = None
+        self.running = True
+        self.tlastread = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="devicereader", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                b = self.readavailable()
+            except Exception as e:
+                with self.cond:
+                    self.exception = e
+                    self.cond.notify_all()
+                break
+            if b:
+                with self.cond:
+                    while self.buf and len(self.buf) + len(b) > self.maxsize and self.running and time.monotonic() - self.tlastread < readeractivetime:
+                        self.cond.wait(serialtimeout)   # the reader is busy, so wait for it to make room
+                    self.buf.extend(b)
+                    self.nreceived += len(b)
+                    if len(self.buf) > self.maxsize:
+                        ndrop = len(self.buf) - self.maxsize
+                        del self.buf[:ndrop]
+                        self.ndropped += ndrop
+                    self.cond.notify_all()
+
+    def read(self, timeout, nmax=0):   # what is buffered (up to nmax bytes), waiting up to timeout for the first bytes
+        with self.cond:
+            if not self.buf and self.exception is None and timeout:
+                self.cond.wait(timeout)
+            if not self.buf and self.exception is not None:
+                raise self.exception
+            if nmax and len(self.buf) > nmax:
+                b = bytes(self.buf[:nmax])
+                del self.buf[:nmax]
+            else:
+                b = bytes(self.buf)
+                self.buf.clear()
+            self.tlastread = time.monotonic()
+            self.cond.notify_all()
+            return b
+
+    def pending(self):
+        return len(self.buf)
+
+    def stop(self):   # the thread leaves after its current read, or when the connection is closed under it
+        self.running = False
+
+# merge uncoming serial stream and break at OK, \x04, >, \r\n, and long delays 
 def yieldserialchunk(s):
-    res = [ ]
+    return yieldchunktokens(serialreadfunction(s))
+
+chunkdelimiters = (b'OK', b'\x04', b'>', b'\r\n')
+
+# the tokenizer on its own, fed by any function returning the next block of bytes (or b'' on a timeout)
+# A part line is passed on after partialtimeout, unless it ends in what could be the start of OK or \r\n
+# Lines of noise (from a NoiseFilter) are dropped whole as soon as their start is seen, before decoding.
+# An error from the connection goes up to the caller, so the kernel can reconnect (and rerun the cell).
+def yieldchunktokens(readavailable, noisefilter=None):
+    buf = bytearray()
     n = 0
-    wsresbuffer = b""
-    wsresbufferI = 0
+    bwaitfull = False
+    batlinestart = True    # where the next token begins, which only isn't so after a part line
+    bdroppingline = False
     while True:
-        try:
-            if type(s) == serial.Serial:
-                b = s.read()
-            elif type(s) == socket.socket:
-                r,w,e = select.select([s], [], [], serialtimeout)
-                if r:
-                    b = s._sock.recv(1)
-                else:
-                    b = b''
-                    
-            else:  # websocket (break down to individual bytes)
-                if wsresbufferI >= len(wsresbuffer):
-                    r,w,e = select.select([s], [], [], serialtimeout)
-                    if r:
-                        wsresbuffer = s.recv()  # this comes as batches of strings, which beed to be broken to characters
-                        if type(wsresbuffer) == str:
-                            wsresbuffer = wsresbuffer.encode("utf8")   # handle fact that strings come back from this interface
-                    else:
-                        wsresbuffer = b''
-                    wsresbufferI = 0
-                    
-                if len(wsresbuffer) > 0:
-                    b = wsresbuffer[wsresbufferI:wsresbufferI+1]
-                    wsresbufferI += 1
-                else:
-                    b = b''
-
-                    
-        except serial.SerialException as e:
-            yield b"\r\n**[ys] "
-            yield str(type(e)).encode("utf8")
-            yield b"\r\n**[ys] "
-            yield str(e).encode("utf8")
-            yield b"\r\n\r\n"
-            break
-            
+        b = readavailable(serialtimeout  if (bwaitfull or not buf)  else partialtimeout)
         if not b:
-            if res and (res[0] != 'O' or len(res) > 3):
-                yield b''.join(res)
-                res.clear()
+            if buf and not bwaitfull and buf[-1:] in (b'O', b'\r'):
+                bwaitfull = True
+                continue
+            bwaitfull = False
+            if buf and bdroppingline:
+                buf.clear()   # the \r of a dropped line, whose \n hasn't come, so it is taken as the end
+                bdroppingline = False
+            elif buf:
+                batlinestart = (buf[-1:] == b'\n')
+                yield bytes(buf)
+                buf.clear()
             else:
                 n += 1
                 if (n%serialtimeoutcount) == 0:
                     yield b''   # yield a blank line every (serialtimeout*serialtimeoutcount) seconds
-                
-        elif b == b'K' and len(res) >= 1 and res[-1] == b'O':
-            if len(res) > 1:
-                yield b''.join(res[:-1])
-            yield b'OK'
-            res.clear()
-        elif b == b'\x04' or b == b'>':
-            if res:
-                yield b''.join(res)
-            yield b
-            res.clear()
+            continue
+
+        bwaitfull = False
+        buf.extend(b)
+        nbuf = len(buf)
+        nextdelims = [ buf.find(d)  for d in chunkdelimiters ]
+        pos = 0
+        while True:
+            if noisefilter is not None and (bdroppingline or (batlinestart and noisefilter.match(buf, pos))):
+                e = buf.find(b'\r\n', pos)
+                e4 = buf.find(b'\x04', pos)   # never swallow the end of the program's output
+                if e == -1 and e4 == -1:
+                    bdroppingline = True
+                    pos = max(pos, nbuf - 1)  if buf[-1:] == b'\r'  else nbuf   # a \r is kept, as its \n could be in the next read
+                    break
+                bdroppingline = False
+                pos = e4  if (e4 != -1 and (e == -1 or e4 < e))  else e + 2
+                for j in range(4):
+                    if 0 <= nextdelims[j] < pos:
+                        nextdelims[j] = buf.find(chunkdelimiters[j], pos)
+                continue
+
+            k, kpos = -1, nbuf
+            for j in range(4):
+                if 0 <= nextdelims[j] < kpos:
+                    k, kpos = j, nextdelims[j]
+            if k == -1:
+                break
+            if k == 3:   # \r\n stays on the end of its line
+                yield bytes(buf[pos:kpos+2])
+                pos = kpos + 2
+            else:
+                if kpos > pos:
+                    yield bytes(buf[pos:kpos])
+                yield chunkdelimiters[k]
+                pos = kpos + len(chunkdelimiters[k])
+            batlinestart = True
+            for j in range(4):
+                if 0 <= nextdelims[j] < pos:
+                    nextdelims[j] = buf.find(chunkdelimiters[j], pos)
+        del buf[:pos]
+
+# Lines of device output to drop, as named regexes of the start of a line compiled into one pattern 
+# on bytes, so each line costs one match before anything is decoded.  It counts what each rule drops.
+class NoiseFilter:
+    def __init__(self, rules=defaultnoiserules):
+        self.rules = [ ]     # [(name, regex)] in the order they were added
+        self.counts = { }
+        self.enabled = True
+        self.pattern = None
+        for name, regex in rules:
+            self.add(name, regex)
+
+    def add(self, name, regex):   # raises re.error on a bad regex
+        re.compile(regex.encode())
+        self.rules = [ rule  for rule in self.rules  if rule[0] != name ] + [ (name, regex) ]
+        self.counts.setdefault(name, 0)
+        self.compile()
+
+    def remove(self, name):
+        nrules = len(self.rules)
+        self.rules = [ rule  for rule in self.rules  if rule[0] != name ]
+        self.counts.pop(name, None)
+        self.compile()
+        return len(self.rules) != nrules
+
+    def compile(self):
+        self.pattern = None
+        if self.rules:
+            self.pattern = re.compile(b"|".join(b"(?P<r%d>%s)" % (i, regex.encode())  for i, (name, regex) in enumerate(self.rules)))
+
+    def match(self, buf, pos=0):   # True if the line starting at pos is noise
+        if not self.enabled or self.pattern is None:
+            return False
+        m = self.pattern.match(buf, pos)
+        if m is None:
+            return False
+        self.counts[self.rules[int(m.lastgroup[1:])][0]] += 1
+        return True
+
+
+# decodes the base64 lines of a fetchfile as they arrive (split anywhere by the tokenizer on OK) and 
+# writes them to fout through a buffer of bounded size, so memory does not grow with the file
+class FetchFileSink:
+    def __init__(self, fout, nbytes, sres, bquiet, bufsize=65536):
+        self.fout = fout
+        self.nbytes = nbytes
+        self.sres = sres
+        self.bquiet = bquiet
+        self.bufsize = bufsize
+        self.linebuf = bytearray()
+        self.outbuf = bytearray()
+        self.nfetched = 0
+        self.nextreport = 0
+
+    def write(self, rline):
+        self.linebuf.extend(rline)
+        i = self.linebuf.rfind(b"\n")
+        if i != -1:
+            for line in self.linebuf[:i].split(b"\n"):
+                self.decodeline(line.strip())
+            del self.linebuf[:i+1]
+
+    def decodeline(self, line):
+        if not line:
+            return
+        if b" " in line and wifimessageignore.match(line.decode(errors="replace")):
+            return   # base64 has no spaces, but a2b_base64 would quietly decode this junk
+        try:
+            self.outbuf.extend(binascii.a2b_base64(line))
+        except binascii.Error as e:
+            self.sres(str(e))
+            self.sres(str([bytes(line)]))
+            return
+        if len(self.outbuf) >= self.bufsize:
+            self.flush()
+        if not self.bquiet and self.nfetched + len(self.outbuf) >= self.nextreport:
+            self.sres("%d%% fetched, %d of %d bytes\n" % (int((self.nfetched + len(self.outbuf))/max(self.nbytes, 1)*100 + 0.5), self.nfetched + len(self.outbuf), self.nbytes), clear_output=True)
+            self.nextreport += max(self.nbytes//20, 4096)
+
+    def flush(self):
+        self.fout.write(self.outbuf)
+        self.nfetched += len(self.outbuf)
+        self.outbuf.clear()
+
+    def close(self):
+        self.decodeline(self.linebuf.strip())
+        self.linebuf.clear()
+        self.flush()
+
+
+# Puts the blocks of a fetchframes in order into fout as they come from receiveframes, holding on to any 
+# that arrive after a gap until the blocks missing from it have been sent again.  Blocks whose length is 
+# wrong for their place in the file are dropped, so they are asked for again too.
+class FileFrameSink:
+    def __init__(self, fout, nbytes, blocksize, sres, bquiet):
+        self.fout = fout
+        self.nbytes = nbytes
+        self.blocksize = blocksize
+        self.nblocks = (nbytes + blocksize - 1)//blocksize
+        self.sres = sres
+        self.bquiet = bquiet
+        self.nextblock = 0   # the next to go to fout
+        self.held = { }      # blocks after a gap, by index
+        self.nfetched = 0
+        self.nextreport = 0
+
+    def add(self, payload, seq):
+        i = self.nextblock + ((seq - self.nextblock) & 0xffff)   # the index nearest at or after the next wanted
+        if i >= self.nblocks or len(payload) != min(self.blocksize, self.nbytes - i*self.blocksize):
+            return
+        self.held[i] = payload
+        while self.nextblock in self.held:
+            payload = self.held.pop(self.nextblock)
+            self.fout.write(payload)
+            self.nfetched += len(payload)
+            self.nextblock += 1
+        if not self.bquiet and self.nfetched >= self.nextreport:
+            self.sres("%d%% fetched, %d of %d bytes\n" % (int(self.nfetched/max(self.nbytes, 1)*100 + 0.5), self.nfetched, self.nbytes), clear_output=True)
+            self.nextreport += max(self.nbytes//20, 4096)
+
+    def missing(self):   # the indexes of the blocks still wanted
+        return [ i  for i in range(self.nextblock, self.nblocks)  if i not in self.held ]
+
+    def close(self):
+        self.held.clear()
+
+
+# inflates a compressed fetchfile on its way to fout
+class InflateWriter:
+    def __init__(self, fout):
+        self.fout = fout
+        self.zobj = zlib.decompressobj(deflatewbits)
+        self.ninflated = 0
+
+    def write(self, b):
+        b = self.zobj.decompress(b)
+        self.ninflated += len(b)
+        self.fout.write(b)
+
+    def finish(self):
+        b = self.zobj.flush()
+        self.ninflated += len(b)
+        self.fout.write(b)
+        return self.zobj.eof
+
+
+# Writes the device output of a %capture to file through a large buffer, counting the lines with 
+# bytes.count so nothing is decoded unless it is also to be shown.  Text mode writes the lines ending 
+# in \n, binary mode keeps exactly the bytes that came.  With maxbytes or maxlines the output moves 
+# on to name.1.ext, name.2.ext, ... at the end of the line that reaches the limit.
+class CaptureWriter:
+    def __init__(self, filename, bbinary=False, bshow=True, maxbytes=0, maxlines=0, bufsize=1<<20):
+        self.filename = filename
+        self.bbinary = bbinary
+        self.bshow = bshow
+        self.maxbytes = maxbytes
+        self.maxlines = maxlines
+        self.bufsize = bufsize
+        self.filenames = [ ]
+        self.nbytes = 0
+        self.nlines = 0
+        self.batlinestart = True
+        self.tflush = time.monotonic()
+        self.treport = self.tflush
+        self.onlines = None   # given the count of lines captured at most once a second, eg by %capture --quiet
+        self.openfile()
+
+    def openfile(self):
+        fname = self.filename
+        if self.filenames:
+            base, ext = os.path.splitext(self.filename)
+            fname = "{}.{}{}".format(base, len(self.filenames), ext)
+        self.fout = open(fname, "wb", buffering=self.bufsize)
+        self.filenames.append(fname)
+        self.filebytes = 0
+        self.filelines = 0
+
+    def write(self, rline):   # returns True if it is not to be shown as well
+        if not self.bbinary:
+            rline = rline.replace(b"\r\n", b"\n")
+        self.fout.write(rline)
+        n = rline.count(b"\n")
+        self.nbytes += len(rline)
+        self.nlines += n
+        self.filebytes += len(rline)
+        self.filelines += n
+        self.batlinestart = (rline[-1:] == b"\n")
+        if self.batlinestart and ((self.maxbytes and self.filebytes >= self.maxbytes) or (self.maxlines and self.filelines >= self.maxlines)):
+            self.fout.close()
+            self.openfile()
+        if self.onlines:
+            self.report(time.monotonic())
+        return not self.bshow
+
+    def report(self, t):
+        if self.onlines and t - self.treport >= 1:
+            self.onlines(self.nlines)
+            self.treport = t
+
+    def idle(self):   # flushes to disk at most once a second while the device is quiet, returning True when it did
+        t = time.monotonic()
+        if t - self.tflush < 1:
+            return False
+        self.fout.flush()
+        self.tflush = t
+        self.report(t)
+        return True
+
+    def close(self):
+        self.fout.close()
+
+
+structnumpycodes = { "c": "S1", "b": "i1", "B": "u1", "?": "?", "h": "i2", "H": "u2", "i": "i4", "I": "u4", "l": "i4", "L": "u4", 
+                     "q": "i8", "Q": "u8", "e": "f2", "f": "f4", "d": "f8" }   # with the standard sizes of a format with a byte order
+
+# numpy dtype of a record packed with a struct format (which must give the byte order, so there is no 
+# padding to differ between the device and the PC); a format of one type is a plain array of it
+def structdtype(fmt, numpy):
+    if fmt[:1] not in ("<", ">", "!"):
+        raise ValueError("the format {} needs a byte order such as < so that it packs the same everywhere".format(fmt))
+    byteorder = "<"  if fmt[0] == "<"  else ">"
+    fields = [ ]
+    offset = 0
+    for count, code in re.findall(r"\s*(\d*)([xcbB?hHiIlLqQefds])", fmt[1:]):
+        count = int(count or 1)
+        if code != "x":
+            dt = numpy.dtype("S{}".format(count)  if code == "s"  else byteorder + structnumpycodes[code])
+            fields.append(("f{}".format(len(fields)), dt  if count == 1 or code == "s"  else (dt, (count,)), offset))
+        offset += struct.calcsize("<{}{}".format(count, code))
+    if offset != struct.calcsize(fmt):
+        raise ValueError("cannot understand the format {}".format(fmt))
+    if len(fields) == 1 and fields[0][2] == 0 and offset == numpy.dtype(fields[0][1]).itemsize:
+        return numpy.dtype(fields[0][1])
+    return numpy.dtype({ "names": [ f[0]  for f in fields ], "formats": [ f[1]  for f in fields ], "offsets": [ f[2]  for f in fields ], "itemsize": offset })
+
+# Records from a %stream decoded in bulk into a numpy array which is saved as a .npy file at the end and 
+# doubles in size when it is full, or with bmmap goes straight into a memory-mapped .npy file of the 
+# given capacity (records beyond which are counted and dropped).  numpy is only needed for this.
+class StreamArray:
+    def __init__(self, filename, fmt, capacity, bmmap=False):
+        import numpy   # raises ImportError, numpy not being a requirement of the kernel
+        self.numpy = numpy
+        self.filename = filename
+        self.dtype = structdtype(fmt, numpy)
+        self.recordsize = struct.calcsize(fmt)
+        self.bmmap = bmmap
+        if bmmap:
+            self.array = numpy.lib.format.open_memmap(filename, mode="w+", dtype=self.dtype, shape=(capacity,))
         else:
-            res.append(b)
-            if b == b'\n' and len(res) >= 2 and res[-2] == b'\r':
-                yield b''.join(res)
-                res.clear()
+            self.array = numpy.empty(capacity, self.dtype)
+        self.n = 0
+        self.noverflow = 0
+        self.pending = bytearray()
+        self.onrecords = None   # given each block of records as it is decoded, eg by a %plot
+
+    def add(self, payload, seq=None):
+        self.pending += payload
+        if len(self.pending) >= streamflushsize:
+            self.flush()
+
+    def flush(self):
+        k = len(self.pending)//self.recordsize
+        if not k:
+            return
+        records = self.numpy.frombuffer(self.pending, self.dtype, k)
+        if self.n + k > len(self.array):
+            if self.bmmap:
+                self.noverflow += self.n + k - len(self.array)
+                records = records[:len(self.array) - self.n]
+            else:
+                array = self.numpy.empty(max(2*len(self.array), self.n + k), self.dtype)
+                array[:self.n] = self.array[:self.n]
+                self.array = array
+        self.array[self.n:self.n+len(records)] = records
+        self.n += len(records)
+        if self.onrecords:
+            self.onrecords(records)
+        del records
+        del self.pending[:k*self.recordsize]
+
+    def close(self):   # returns the number of bytes left over that don't make a whole record
+        self.flush()
+        if self.bmmap:
+            capacity = len(self.array)
+            self.array.flush()
+            self.array = None
+            if self.n < capacity:
+                self.shrinknpy(capacity)
+        else:
+            self.numpy.save(self.filename, self.array[:self.n])
+            self.array = None
+        return len(self.pending)
+
+    def shrinknpy(self, capacity):   # rewrites the shape in the header in place (padding it to the same length) and cuts off the rest
+        with open(self.filename, "r+b") as f:
+            version = self.numpy.lib.format.read_magic(f)
+            headerstart = f.tell() + (2 if version == (1, 0) else 4)
+            self.numpy.lib.format.read_array_header_1_0(f)  if version == (1, 0)  else self.numpy.lib.format.read_array_header_2_0(f)
+            dataoffset = f.tell()
+            f.seek(headerstart)
+            header = f.read(dataoffset - headerstart).decode("latin1")
+            header = header.replace("'shape': ({},".format(capacity), "'shape': ({},".format(self.n)).rstrip("\n ")
+            f.seek(headerstart)
+            f.write(header.ljust(dataoffset - headerstart - 1).encode("latin1") + b"\n")
+            f.truncate(dataoffset + self.n*self.recordsize)
+
+
+# Compiles .py files with mpy-cross, keeping each .mpy in cachedir under a hash of the source, the name 
+# embedded in it, the mpy-cross version and its flags (eg -march=xtensawin), so unchanged code is never 
+# compiled twice.  What isn't in the cache is compiled in parallel, each file by an mpy-cross process.
+class MpyCrossCache:
+    def __init__(self, mpycrossexe, flags=(), cachedir=mpycrosscachedir):
+        self.mpycrossexe = mpycrossexe
+        self.flags = list(flags)
+        self.cachedir = cachedir
+        self.version = None
+        self.nfromcache = 0
+        self.ncompiled = 0
+
+    def getversion(self):   # raises OSError or CalledProcessError if the executable doesn't work
+        if self.version is None:
+            self.version = subprocess.run([self.mpycrossexe, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True).stdout.decode(errors="replace").strip()
+        return self.version
+
+    def cachefile(self, source, sourcename):
+        h = hashlib.sha256()
+        for x in (self.getversion(), " ".join(self.flags), sourcename):
+            h.update(x.encode() + b"\0")
+        h.update(source)
+        return os.path.join(self.cachedir, h.hexdigest() + ".mpy")
+
+    def compileone(self, pyfile, sourcename, cachefile):   # returns what mpy-cross printed if it failed
+        fd, tmpfile = tempfile.mkstemp(suffix=".tmp", dir=self.cachedir)
+        os.close(fd)
+        try:
+            p = subprocess.run([self.mpycrossexe] + self.flags + ["-o", tmpfile, "-s", sourcename, pyfile], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if p.returncode != 0:
+                return p.stdout.decode(errors="replace") or "mpy-cross exit code {}".format(p.returncode)
+            os.replace(tmpfile, cachefile)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        return None
+
+    # files is a list of (pyfile, sourcename) and for each of them (mpy bytes, None) or (None, error message) comes back
+    def compile(self, files, nworkers=None):
+        res = [ None ]*len(files)
+        stale = [ ]
+        for i, (pyfile, sourcename) in enumerate(files):
+            with open(pyfile, "rb") as fin:
+                cachefile = self.cachefile(fin.read(), sourcename)
+            if os.path.isfile(cachefile):
+                res[i] = (cachefile, None)   # (cache file, error message) until the end
+                self.nfromcache += 1
+            else:
+                stale.append((i, pyfile, sourcename, cachefile))
+        if stale:
+            os.makedirs(self.cachedir, exist_ok=True)
+            with concurrent.futures.ThreadPoolExecutor(nworkers or os.cpu_count() or 1) as pool:   # the threads only wait on the processes
+                errors = pool.map(lambda x: self.compileone(*x[1:]), stale)
+                for (i, pyfile, sourcename, cachefile), error in zip(stale, errors):
+                    res[i] = (cachefile, error)
+            self.ncompiled += len(stale)
+        def readmpy(cachefile):
+            with open(cachefile, "rb") as fin:
+                return fin.read()
+        return [ ((readmpy(cachefile), None)  if error is None  else (None, error))  for cachefile, error in res ]
 
 
 class DeviceConnector:
-    def __init__(self, sres, sresSYS):
+    def __init__(self, sres, sresSYS, sresidle=None, noisefilter=None):
         self.workingserial = None
         self.workingsocket = None
         self.workingwebsocket = None
+        self.workingsocketaddress = None
         self.workingserialchunk = None
+        self.workingreader = None     # DeviceReader thread, started on the first read
+        self.pendingbytes = b''       # read ahead of the tokenizer (eg during raw-paste flow control) and handed back to it
+        self.rawpastewindowsize = 0   # non-zero when the device has accepted raw-paste mode
+        self.fscache = { }            # directory listings of the device filesystem, see fetchlistdir
+        self.deflatesupport = None    # found once per connection by probedeflate
+        self.helperversion = 0        # of the helper known to be on the device, set by ensurehelper and cleared when it could be gone
+        self.helperflash = False      # whether ensurehelper also saves the helper in the device's flash when it installs it
+        self.helperframes = False     # whether the helper can send and receive files in frames over stdin and stdout
+        self.timing = None            # the kernel's CellTiming for the cell being run, if any
+        self.capturesink = None       # CaptureWriter of a %capture
+        self.streamsink = None        # StreamArray of a %stream, see receiveframes
+        self.plotsink = None          # the kernel's LivePlot of a %plot, which is written to as a CaptureWriter is
+        self.streamstats = None
+        self.noisefilter = noisefilter or NoiseFilter()   # shared between the kernel's sessions
+        self.reconnectinfo = None     # how the connection was made, for reconnect, see rememberconnection
         self.sres = sres   # two output functions borrowed across
         self.sresSYS = sresSYS
+        self.sresidle = sresidle or (lambda: None)   # flushes output that has been held back to coalesce it
         self._esptool_command = None
 
-    def workingserialreadall(self):  # usually used to clear the incoming buffer, results are printed out rather than used
-        if self.workingserial:
-            return self.workingserial.read_all()
+    def getdevicereader(self):
+        if self.workingreader is None:
+            self.workingreader = DeviceReader(serialreadfunction(self.workingserial or self.workingsocket or self.workingwebsocket))
+        return self.workingreader
 
+    def workingserialreadall(self):  # usually used to clear the incoming buffer, results are printed out rather than used
+        pending, self.pendingbytes = self.pendingbytes, b''
+        reader = self.getdevicereader()
         if self.workingwebsocket:
-            res = [ ]
+            res = [ pending ]
             while True:
-                r,w,e = select.select([self.workingwebsocket],[],[],0.2)  # add a timeout to the webrepl, which can be slow
-                if not r:
+                b = reader.read(0.2)  # add a timeout to the webrepl, which can be slow
+                if not b:
                     break
-                res.append(self.workingwebsocket.recv())
-            return "".join(res) # this is returning a text array, not bytes
-                                # though a binary frame can be stipulated according to websocket.ABNF.OPCODE_MAP
-                                # fix this when we see it
+                res.append(b)
+            return b"".join(res).decode(errors="replace") # this is returning text, as the webrepl sends strings
+        return pending + reader.read(0)
 
-        # socket case, get it all down
-        res = [ ]
-        while True:
-            r,w,e = select.select([self.workingsocket._sock],[],[],0)
-            if not r:
+    # the source of bytes for the tokenizer; the wait is on a condition the reader thread signals, 
+    # so it returns as soon as anything arrives and a KeyboardInterrupt (the notebook's interrupt) gets in at once
+    def readavailable(self, timeout=serialtimeout):
+        if self.pendingbytes:
+            b, self.pendingbytes = self.pendingbytes, b''
+            return b
+        reader = self.getdevicereader()
+        if not reader.pending():
+            self.sresidle()   # about to wait, so let held back output go to the frontend
+        return reader.read(timeout, readblocksize)
+
+    def readerpending(self):
+        return len(self.pendingbytes) + (self.workingreader.pending() if self.workingreader else 0)
+
+    def readrawbytes(self, n, timeout=serialtimeout):  # exactly n bytes from below the tokenizer, or fewer on a timeout
+        res = b''
+        while len(res) < n:
+            b = self.readavailable(timeout)
+            if not b:
                 break
-            res.append(self.workingsocket._sock.recv(1000))
-            self.sres("Selected socket {}  {}\n".format(len(res), len(res[-1])))
-        return b"".join(res)
+            res += b
+        self.pendingbytes = res[n:] + self.pendingbytes
+        return res[:n]
+
+    def connectiondescription(self):   # for the %session listing
+        if self.workingserial is not None:
+            return "serial {}".format(self.workingserial.port)
+        if self.workingsocket is not None:
+            return "socket {}".format(self.workingsocketaddress)
+        if self.workingwebsocket is not None:
+            return "websocket {}".format(self.workingsocketaddress)
+        return "not connected"
+
+    def linkbroken(self):   # the reader thread has stopped on an exception from the connection
+        return self.workingreader is not None and self.workingreader.exception is not None
+
+    def rememberconnection(self, password=None):   # once a connection is working, keep what reconnect needs to make it again
+        if self.workingserial is not None:
+            self.reconnectinfo = ("serial", self.workingserial.port, self.workingserial.baudrate, portregistry.identity(self.workingserial.port))
+        elif self.workingwebsocket is not None:
+            self.reconnectinfo = ("websocket", self.workingsocketaddress, password)
+
+    # Makes the remembered connection again after it has broken, trying at growing intervals until timeout 
+    # seconds have gone by, and returns the number of tries it took (0 if it failed).  A USB serial device 
+    # is looked for by its VID, PID and serial number, as it often comes back under a different port name.
+    def reconnect(self, timeout):
+        tend = time.monotonic() + timeout
+        delay = reconnectmindelay
+        ntries = 0
+        while True:
+            ntries += 1
+            self.disconnect(raw=True)
+            if self.reconnectonce():
+                return ntries
+            t = tend - time.monotonic()
+            if t <= 0:
+                return 0
+            time.sleep(min(delay, t))
+            delay = min(delay*2, reconnectmaxdelay)
+
+    def reconnectonce(self):
+        if self.reconnectinfo[0] == "serial":
+            kind, portname, baudrate, usbid = self.reconnectinfo
+            if usbid is not None:
+                portname = portregistry.find(usbid) or portname
+            try:
+                self.workingserial = importserial().Serial(portname, baudrate, timeout=serialtimeout)
+            except serialerrors:
+                return False
+            self.reconnectinfo = (kind, portname, baudrate, usbid)
+        else:
+            kind, websocketurl, password = self.reconnectinfo
+            try:
+                self.workingwebsocket = importwebsocket().create_connection(websocketurl, 5)
+                self.workingwebsocket.settimeout(serialtimeout)
+                self.workingsocketaddress = websocketurl
+                self.websocketlogin(password)
+            except (OSError, ) + websocketerrors:
+                self.disconnect(raw=True)
+                return False
+        try:
+            if self.enterpastemode(verbose=False):
+                return True
+        except (OSError, ) + websocketerrors:
+            pass
+        self.disconnect(raw=True)
+        return False
 
     def disconnect(self, raw=False, verbose=False):
         if not raw:
             self.exitpastemode(verbose)   # this doesn't seem to do any good (paste mode is left on disconnect anyway)
 
         self.workingserialchunk = None
+        if self.workingreader is not None:
+            self.workingreader.stop()
+        self.pendingbytes = b''
+        self.rawpastewindowsize = 0
+        self.deflatesupport = None
+        self.helperversion = 0
+        self.invalidatefscache()
         if self.workingserial is not None:
             if verbose:
                 self.sresSYS("\nClosing serial {}\n".format(str(self.workingserial)))
-            self.workingserial.close()
+            try:
+                self.workingserial.close()
+            except OSError:   # the device has gone
+                pass
             self.workingserial = None
         if self.workingsocket is not None:
             self.sresSYS("\nClosing socket {}\n".format(str(self.workingsocket)))
@@ -136,12 +1042,16 @@ class DeviceConnector:
             self.sresSYS("\nClosing websocket {}\n".format(str(self.workingwebsocket)))
             self.workingwebsocket.close()
             self.workingwebsocket = None
+        if self.workingreader is not None:
+            self.workingreader.thread.join(serialtimeout*2)
+            self.workingreader = None
 
-    def serialconnect(self, portname, baudrate, verbose):
+    def serialconnect(self, portname, baudrate, verbose, busyports=()):
         assert not  self.workingserial
-        if type(portname) is int:
+        self.reconnectinfo = None
+        if type(portname) is int:   # the default, which is the first port not held by another session
             portindex = portname
-            possibleports = guessserialport()
+            possibleports = [ port  for port in guessserialport()  if port not in busyports ]
             if possibleports:
                 portname = possibleports[portindex]
                 if len(possibleports) > 1:
@@ -149,11 +1059,20 @@ class DeviceConnector:
             else:
                 self.sresSYS("No possible ports found")
                 portname = ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
+        else:
+            portname = resolveport(portname)
+            if portname is None:
+                self.sres("There is no port with that index, see %ports\n", 31)
+                return
+
+        if portname in busyports:
+            self.sres("Port {} is already connected in another session\n".format(portname), 31)
+            return
 
         self.sresSYS("Connecting to --port={} --baud={} ".format(portname, baudrate))
         try:
-            self.workingserial = serial.Serial(portname, baudrate, timeout=serialtimeout)
-        except serial.SerialException as e:
+            self.workingserial = importserial().Serial(portname, baudrate, timeout=serialtimeout)
+        except serialerrors as e:
             self.sres(e.strerror)
             self.sres("\n")
             possibleports = guessserialport()
@@ -163,10 +1082,6 @@ class DeviceConnector:
                 self.sresSYS("\nAre you sure your ESP-device is plugged in?")
             return
 
-        for i in range(5001):
-            if self.workingserial.isOpen():
-                break
-            time.sleep(0.01)
         if verbose:
             self.sresSYS(" [connected]")
         self.sres("\n")
@@ -174,13 +1089,11 @@ class DeviceConnector:
             self.sres(str(self.workingserial))
             self.sres("\n")
 
-        if i != 0 and verbose:
-            self.sres("Waited {} seconds for isOpen()\n".format(i*0.01))
-
 
 
     def socketconnect(self, ipnumber, portnumber):
         self.disconnect(verbose=True)
+        self.reconnectinfo = None
 
         self.sresSYS("Connecting to socket ({} {})\n".format(ipnumber, portnumber))
         s = socket.socket()
@@ -189,6 +1102,7 @@ class DeviceConnector:
             s.connect(socket.getaddrinfo(ipnumber, portnumber)[0][-1])
             self.sres("Doing makefile\n")
             self.workingsocket = s.makefile('rwb', 0)
+            self.workingsocketaddress = "{}:{}".format(ipnumber, portnumber)
         except OSError as e:
             self.sres("Socket OSError {}".format(str(e)))
         except ConnectionRefusedError as e:
@@ -197,9 +1111,11 @@ class DeviceConnector:
 
     def websocketconnect(self, websocketurl):
         self.disconnect(verbose=True)
+        self.reconnectinfo = None
         try:
-            self.workingwebsocket = websocket.create_connection(websocketurl, 5)
+            self.workingwebsocket = importwebsocket().create_connection(websocketurl, 5)
             self.workingwebsocket.settimeout(serialtimeout)
+            self.workingsocketaddress = websocketurl
         except socket.timeout:
             self.sres("Websocket Timeout after 5 seconds {}\n".format(websocketurl))
         except ValueError as e:
@@ -208,10 +1124,22 @@ class DeviceConnector:
             self.sres("WebSocket ConnectionError {}\n".format(str(e)))
         except OSError as e:
             self.sres("WebSocket OSError {}\n".format(str(e)))
-        except websocket.WebSocketException as e:
+        except websocketerrors as e:
             self.sres("WebSocketException {}\n".format(str(e)))
 
 
+    # answers the WebREPL's password prompt, returning what it printed and whether it asked for the password
+    def websocketlogin(self, password):
+        pline = self.workingwebsocket.recv()
+        if pline != 'Password: ' or password is None:
+            return pline, False
+        self.workingwebsocket.send(password)
+        self.workingwebsocket.send("\r\n")
+        i, res = self.expect([normalprompt], rawrepltimeout)
+        return pline + (res.decode(errors="replace")  if i == 0  else self.workingserialreadall()), True   # 'Password: \r\nWebREPL connected\r\n>>> '
+
+    # flashes the device on one port, or those on several ports (portname can list them, or be a glob) 
+    # all at once, with the progress of each in one line that is updated in place
     def esptool(self, espcommand, portname, binfile):
         self.disconnect(verbose=True)
         if type(portname) is int:
@@ -223,6 +1151,10 @@ class DeviceConnector:
             else:
                 self.sres("No possible ports found")
                 portname = ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
+        portnames = expandports(portname)
+        if not portnames:
+            self.sres("No ports match {}\n".format(portname), 31)
+            return
 
         if self._esptool_command is None:  # this section for finding what the name of the command function is; may print junk into the jupyter logs
             for command in ("esptool.py", "esptool"):  
@@ -236,51 +1168,90 @@ class DeviceConnector:
                 self.sres("esptool not found on path\n")
                 return
 
-        pargs = [self._esptool_command, "--port", portname]
-        if espcommand == "erase":
-            pargs.append("erase_flash")
-        if espcommand == "esp32":
-            pargs.extend(["--chip", "esp32", "write_flash", "-z", "0x1000"])
-            pargs.append(binfile)
-        if espcommand == "esp8266":
-            pargs.extend(["--baud", "460800", "write_flash", "--flash_size=detect", "-fm", "dio", "0"])
-            pargs.append(binfile)
-        self.sresSYS("Executing:\n  {}\n\n".format(" ".join(pargs)))
-        process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for line in process.stdout:
-            x = line.decode()
-            self.sres(x)
-            if x[:12] == "Connecting..":
-                self.sresSYS("[Press the PRG button now if required]\n")
-        for line in process.stderr:
-            self.sres(line.decode(), n04count=1)
-
-    def mpycross(self, mpycrossexe, pyfile):
-        pargs = [mpycrossexe, pyfile]
-        self.sresSYS("Executing:  {}\n".format(" ".join(pargs)))
-        process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for line in process.stdout:
-            self.sres(line.decode())
-        for line in process.stderr:
-            self.sres(line.decode(), n04count=1)
-
-    def receivestream(self, bseekokay, bwarnokaypriors=True, b5secondtimeout=False, bfetchfilecapture_nchunks=0):
+        pargslist = [ ]
+        for portname in portnames:
+            pargs = [self._esptool_command, "--port", portname]
+            if espcommand == "erase":
+                pargs.append("erase_flash")
+            if espcommand == "esp32":
+                pargs.extend(["--chip", "esp32", "write_flash", "-z", "0x1000"])
+                pargs.append(binfile)
+            if espcommand == "esp8266":
+                pargs.extend(["--baud", "460800", "write_flash", "--flash_size=detect", "-fm", "dio", "0"])
+                pargs.append(binfile)
+            pargslist.append(pargs)
+            self.sresSYS("Executing:\n  {}\n".format(" ".join(pargs)))
+        self.sres("\n")
+
+        bparallel = len(portnames) > 1   # then the output of each port is kept for its summary instead of being printed
+        logs = [ [ ]  for portname in portnames ]
+        progress = [ None ]*len(portnames)
+        tlastoutput = [ None ]*len(portnames)   # near enough when each finished
+        progressline = [ "", 0 ]   # what is showing at the end of the output, and when it was put there
+        def showprogress(bfinal):
+            line = "  ".join("[{}] {}%".format(os.path.basename(portname), ("--" if p is None else int(p)))  for portname, p in zip(portnames, progress))  if bparallel  else "{}%".format(int(progress[0]))
+            if line != progressline[0] and (bfinal or time.monotonic() - progressline[1] >= esptoolprogresstime):
+                self.sres("\r" + line + " "*max(0, len(progressline[0]) - len(line)))
+                progressline[:] = [ line, time.monotonic() ]
+
+        bprompted = [ False ]
+        def online(index, text, bstderr):
+            tlastoutput[index] = time.monotonic()
+            line = text.rstrip("\r\n")
+            mprogress = esptoolprogress.search(line)
+            if mprogress and not bstderr:
+                progress[index] = float(mprogress.group(1))
+                showprogress(progress[index] >= 100)
+                return
+            if line[:12] == "Connecting.." and not bprompted[0]:
+                bprompted[0] = True
+                line += "\n[Press the PRG button now if required]"
+            logs[index].append(line)
+            if not bparallel and line:
+                if progressline[0]:
+                    self.sres("\n")
+                    progressline[0] = ""
+                self.sres(line + "\n", n04count=(1 if bstderr else 0))
+
+        t0 = time.monotonic()
+        returncodes = runprocesses(pargslist, online, self.sresidle)
+        if progressline[0]:   # the progress line is still the last thing printed
+            showprogress(True)
+            self.sres("\n")
+        if bparallel:
+            for portname, returncode, log, t in zip(portnames, returncodes, logs, tlastoutput):
+                if returncode == 0:
+                    self.sres("{}: done in {:.1f}s\n".format(portname, (t or t0) - t0), 32)
+                else:
+                    self.sres("{}: failed with exit code {} after {:.1f}s\n".format(portname, returncode, (t or t0) - t0), 31)
+                    for line in log[-5:]:
+                        self.sres("    {}\n".format(line))
+            self.sresSYS("{} of {} ports flashed in {:.1f}s\n".format(returncodes.count(0), len(portnames), time.monotonic() - t0))
+
+    def receivestream(self, bseekokay, bwarnokaypriors=True, b5secondtimeout=False, bfetchfilecapture_nchunks=0, fetchfilesink=None):
         n04count = 0
         brebootdetected = False
         res = [ ]
         for j in range(2):  # for restarting the chunking when interrupted
             if self.workingserialchunk is None:
-                self.workingserialchunk = yieldserialchunk(self.workingserial or self.workingsocket or self.workingwebsocket)
+                self.workingserialchunk = yieldchunktokens(self.readavailable, self.noisefilter)
 
             indexprevgreaterthansign = -1
             index04line = -1
             for i, rline in enumerate(self.workingserialchunk):
                 assert rline is not None
 
+                # the device has answered, so the time spent waiting on it is over
+                if rline and self.timing and self.timing.phase == "wait":
+                    self.timing.enter("execute")
+
                 # warning message when we are waiting on an OK
                 if bseekokay and bwarnokaypriors and (rline != b'OK') and (rline != b'>') and rline.strip():
                     self.sres("\n[missing-OK]")
 
+                if rline == b'>':
+                    indexprevgreaterthansign = i
+
                 # the main interpreting loop
                 if rline == b'OK' and bseekokay:
                     if i != 0 and bwarnokaypriors:
@@ -306,10 +1277,11 @@ class DeviceConnector:
 
                 elif rline == b'Type "help()" for more information.\r\n':
                     brebootdetected = True
+                    self.helperversion = 0
                     self.sres(rline.decode(), n04count=n04count)
 
-                elif rline == b'>':
-                    indexprevgreaterthansign = i
+                # a prompt ahead of the OK, where any other > is output and goes on below to where the rest goes
+                elif rline == b'>' and bseekokay:
                     self.sres('>', n04count=n04count)
 
                 # looks for ">>> "
@@ -319,22 +1291,33 @@ class DeviceConnector:
                     self.sres(' ', n04count=n04count)
                     break
 
+                # raw bytes of a file being fetched go straight through
+                elif fetchfilesink:
+                    fetchfilesink.write(rline)
+
+                # output of a %capture goes to its file as bytes, and falls through to be decoded only if it is shown too
+                elif self.capturesink and n04count == 0 and not bfetchfilecapture_nchunks and self.capturesink.write(rline):
+                    pass
+
+                # and then to the samples of a %plot
+                elif self.plotsink and n04count == 0 and not bfetchfilecapture_nchunks and self.plotsink.write(rline):
+                    pass
+
                 # normal processing of the string of bytes that have come in
                 else:
                     try:
                         ur = rline.decode()
                     except UnicodeDecodeError:
                         ur = str(rline)
-                    if not wifimessageignore.match(ur):
-                        if bfetchfilecapture_nchunks:
-                            if res and res[-1][-2:] != "\r\n":
-                                res[-1] = res[-1] + ur   # need to rejoin strings that have been split on the b"OK" string by the lexical parser
-                            else:
-                                res.append(ur)
-                            if (i%10) == 0 and bfetchfilecapture_nchunks > 0:
-                                self.sres("%d%% fetched\n" % int(len(res)/bfetchfilecapture_nchunks*100 + 0.5), clear_output=True)
+                    if bfetchfilecapture_nchunks:
+                        if res and res[-1][-2:] != "\r\n":
+                            res[-1] = res[-1] + ur   # need to rejoin strings that have been split on the b"OK" string by the lexical parser
                         else:
-                            self.sres(ur, n04count=n04count)
+                            res.append(ur)
+                        if (i%10) == 0 and bfetchfilecapture_nchunks > 0:
+                            self.sres("%d%% fetched\n" % int(len(res)/bfetchfilecapture_nchunks*100 + 0.5), clear_output=True)
+                    else:
+                        self.sres(ur, n04count=n04count)
 
             # else on the for-loop, means the generator has ended at a stop iteration
             # this happens with Keyboard interrupt, and generator needs to be rebuilt
@@ -346,137 +1329,641 @@ class DeviceConnector:
         return res if bfetchfilecapture_nchunks else True
 
 
-    def sendtofile(self, destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents):
+    # Makes sure this version of the helper is on the device, once per connection (or after a reboot), 
+    # installing it if the probe finds none or an older one (or binstall), and with helperflash saving it to flash too
+    def ensurehelper(self, binstall=False):
+        if self.helperversion == devicehelperversion and not binstall:
+            return True
+        def parseprobe(res):   # the version and frames flag, or None
+            try:
+                version, frames = map(int, "".join(res).split())
+            except ValueError:
+                self.sres("".join(res), 31)
+                return None
+            self.helperframes = (frames == 1)
+            return version
+
+        version = 0
+        if not binstall:
+            version = parseprobe(self.runbatch(devicehelperprobe.encode()))
+            if version is None:
+                return False
+        if version != devicehelperversion:
+            program = devicehelperinstall
+            if self.helperflash:
+                program += "O_.put('{}.py','w')\nO_.t({})\nO_.close()\n".format(devicehelpermodule, repr(devicehelper))
+            res = self.runbatch((program + devicehelperinstalled).encode())
+            if self.helperflash:
+                self.invalidatefscache()
+            if parseprobe(res) != devicehelperversion:
+                self.sres("Could not install the helper on the device\n", 31)
+                return False
+        self.helperversion = devicehelperversion
+        return True
+
+    # runs a line of calls on the helper, returning the lines they print (None if there is no helper), 
+    # and installs it again and retries if it has gone (as it does when the device is reset by the user).  
+    # The line is short enough to be written straight into the raw REPL, without the round trip of raw-paste.
+    def callhelper(self, call):
+        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        for i in range(2):
+            if not self.ensurehelper():
+                return None
+            sswrite(call.encode() + b'\r\x04')
+            res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+            if not (i == 0 and any("NameError" in l and "'O_'" in l  for l in res)):
+                return res
+            self.helperversion = 0
+
+    def removehelpermodule(self):   # from the device's flash, so the helper is sent again on each connection
+        self.helperversion = 0
+        self.helperflash = False
+        self.invalidatefscache()
+        self.runbatch("try:\n import os\n os.remove('{}.py')\nexcept OSError:\n pass\n".format(devicehelpermodule).encode())
+
+    # letters for what the firmware can do: d = inflate a stream with deflate.DeflateIO, 
+    # c = deflate a stream (needs MICROPY_PY_DEFLATE_COMPRESS), z = only [u]zlib.decompress of a whole buffer
+    def probedeflate(self):
+        if self.deflatesupport is None:
+            sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+            sswrite(b"import io\r\n")
+            sswrite(b"try:\r\n import deflate\r\n")
+            sswrite(b" deflate.DeflateIO(io.BytesIO(b'x\\x9c\\x03\\x00\\x00\\x00\\x00\\x01'),deflate.ZLIB).read()\r\n")
+            sswrite(b" print('d')\r\n")
+            sswrite(b" try:\r\n  O=deflate.DeflateIO(io.BytesIO(),deflate.ZLIB);O.write(b'x');O.close();print('c')\r\n")
+            sswrite(b" except Exception:\r\n  pass\r\n")
+            sswrite(b"except ImportError:\r\n try:\r\n  import uzlib\r\n  print('z')\r\n")
+            sswrite(b" except ImportError:\r\n  pass\r\n")
+            sswrite(b'\r\x04')
+            res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+            if type(res) != list or any(l.strip() not in ("", "d", "c", "z")  for l in res):   # (eg a MemoryError) asked again next time
+                self.sres("".join(res)  if type(res) == list  else "No answer to the deflate probe\n", 31)
+                return ""
+            self.deflatesupport = "".join(l.strip()  for l in res)
+        return self.deflatesupport
+
+    # uploads zlib data to a temporary file and inflates it into place on the device, returning True 
+    # or False as sendtofile does, or None if the device can't inflate it so it is to be sent as it is
+    def sendcompressed(self, destinationfilename, bmkdir, bappend, bquiet, filecontents):
+        support = self.probedeflate()
+        bfilecontents = filecontents.encode()  if type(filecontents) == str  else filecontents
+        if not ("d" in support or ("z" in support and len(bfilecontents) < 16384)):
+            self.sres("Device cannot inflate this, sending uncompressed\n", 31)
+            return None
+        zobj = zlib.compressobj(9, zlib.DEFLATED, deflatewbits)
+        zcontents = zobj.compress(bfilecontents) + zobj.flush()
+        tmpfilename = destinationfilename + ".z~"
+        if not self.sendtofile(tmpfilename, bmkdir, False, True, bquiet, zcontents):
+            self.callhelper("O_.rm([{}])".format(repr(tmpfilename)))   # whatever got there (or an error if nothing did)
+            self.sres("Compressed upload to {} failed, {} has not been changed\n".format(tmpfilename, destinationfilename), 31)
+            return False
+
+        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        sswrite("O=open({},'rb')\r\n".format(repr(tmpfilename)).encode())
+        sswrite("O1=open({},'{}')\r\n".format(repr(destinationfilename), ("ab" if bappend else "wb")).encode())
+        if "d" in support:
+            sswrite(b"import deflate\r\n")
+            sswrite(b"O2=deflate.DeflateIO(O,deflate.ZLIB)\r\n")
+            sswrite(b"O9=bytearray(512)\r\n")
+            sswrite(b"while True:\r\n n=O2.readinto(O9)\r\n if not n: break\r\n O1.write(memoryview(O9)[:n])\r\n")
+            sswrite(b"del O2,O9\r\n")
+        else:
+            sswrite(b"import uzlib\r\n")
+            sswrite(b"O1.write(uzlib.decompress(O.read()))\r\n")
+        sswrite(b"O.close(); O1.close()\r\n")
+        sswrite("O_.rm([{}])\r\n".format(repr(tmpfilename)).encode())
+        sswrite(b"del O,O1\r\n")
+        sswrite(b'\r\x04')
+        res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+        if res != [ ]:   # (eg a MemoryError) part way through inflating
+            self.sres("".join(res or [ ]), 31)
+            self.callhelper("O_.rm([{}])".format(repr(tmpfilename)))
+            return False
+        self.sres("Compressed {} to {} bytes ({:.1f}x)\n".format(len(bfilecontents), len(zcontents), len(bfilecontents)/max(len(zcontents), 1)))
+        return True
+
+    # returns True once the whole of filecontents is in the file on the device
+    def sendtofile(self, destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents, bcompress=False):
         if not (self.workingserial or self.workingwebsocket):
             self.sres("File transfers not implemented for sockets\n", 31)
-            return
+            return False
+
+        if bcompress:
+            bsent = self.sendcompressed(destinationfilename, bmkdir, bappend, bquiet, filecontents)
+            if bsent is not None:   # (None when it can't be compressed, and is sent as it is)
+                return bsent
 
         if not bbinary:
             lines = filecontents.splitlines(True)
             maxlinelength = max(map(len, lines), default=0)
             if maxlinelength > 250:
                 self.sres("Line length {} exceeds maximum for line ascii files, try --binary\n".format(maxlinelength), 31)
-                return
+                return False
 
         sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
         #def sswrite(x):  self.sres(str(x)); lsswrite(x)
-
-        if bmkdir:
-            dseq = [ d  for d in destinationfilename.split("/")[:-1]  if d]
-            if dseq:
-                sswrite(b'import os\r\n')
-                for i in range(len(dseq)):
-                    sswrite('try:  os.mkdir({})\r\n'.format(repr("/".join(dseq[:i+1]))).encode())
-                    sswrite(b'except OSError:  pass\r\n')
+        self.invalidatefscache()
+        if not self.ensurehelper():
+            return False
 
         fmodifier = ("a" if bappend else "w")+("b" if bbinary else "")
-        if bbinary:
-            sswrite(b"import ubinascii; O6 = ubinascii.a2b_base64\r\n")
-        sswrite("O=open({}, '{}')\r\n".format(repr(destinationfilename), fmodifier).encode())
-        sswrite(b'\r\x04')  # intermediate execution
-        self.receivestream(bseekokay=True)
+        openfile = "O_.put({},'{}',{})".format(repr(destinationfilename), fmodifier, int(bool(bmkdir)))
         clear_output = True  # set this to False to help with debugging
         if bbinary:
             if type(filecontents) == str:
                 filecontents = filecontents.encode()
-                
-            chunksize = 30
-            nchunks = int(len(filecontents)/chunksize)
-
-            for i in range(nchunks+1):
-                bchunk = filecontents[i*chunksize:(i+1)*chunksize]
-                sswrite(b'O.write(O6("')
-                sswrite(binascii.b2a_base64(bchunk)[:-1])
-                sswrite(b'"))\r\n')
-                if (i%10) == 9:
-                    sswrite(b'\r\x04')  # intermediate executions
-                    self.receivestream(bseekokay=True)
-                    if not bquiet:
-                        self.sres("{}%, chunk {}".format(int((i+1)/(nchunks+1)*100), i+1), clear_output=clear_output)
-            self.sres("Sent {} bytes in {} chunks to {}.\n".format(len(filecontents), i+1, destinationfilename), clear_output=not bquiet)
-            
+
+            rtt = time.time()   # timed to get the round trip
+            memres = self.callhelper(openfile + ";O_.mem()")
+            rtt = time.time() - rtt
+            try:
+                memfree = int(memres[-1])
+            except (ValueError, IndexError, TypeError):
+                self.sres("".join(memres or [ ]), 31)
+                return False
+
+            if self.workingserial and self.helperframes:
+                nsent, nchunks, tsent = self.sendframes(filecontents, bquiet, memfree)
+            else:
+                nsent, nchunks, tsent = self.sendbinarychunks(filecontents, bappend, bquiet, memfree, rtt)
+            bsent = (nsent == len(filecontents))
+            if bsent:
+                self.sres("Sent {} bytes in {} chunks to {} at {:.0f} bytes/s.\n".format(nsent, nchunks, destinationfilename, nsent/max(tsent, 0.001)), clear_output=not bquiet)
+
         else:
+            res = self.callhelper(openfile)
+            if res != [ ]:
+                self.sres("".join(res or [ ]), 31)
+                return False
             i = -1
             linechunksize = 5
 
             if bappend:
-                sswrite("O.write('\\n')\r\n".encode())   # avoid line concattenation on appends
+                sswrite("O_.t('\\n')\r\n".encode())   # avoid line concattenation on appends
             for i, line in enumerate(lines):
-                sswrite("O.write({})\r\n".format(repr(line)).encode())
+                sswrite("O_.t({})\r\n".format(repr(line)).encode())
                 if (i%linechunksize) == linechunksize-1:
                     sswrite(b'\r\x04')  # intermediate executions
                     self.receivestream(bseekokay=True)
                     if not bquiet:
                         self.sres("{}%, line {}\n".format(int((i+1)/(len(lines)+1)*100), i+1), clear_output=clear_output)
             self.sres("Sent {} lines ({} bytes) to {}.\n".format(i+1, len(filecontents), destinationfilename), clear_output=(clear_output and not bquiet))
+            bsent = True
+
+        res = self.callhelper("O_.close()")
+        if res != [ ]:
+            self.sres("".join(res or [ ]), 31)
+            return False
+        return bsent
+
+    # Sends filecontents over serial to the file opened by the helper's put, in frames of the streamheader 
+    # format whose sequence number is the block index, which the helper's rx writes out in order and answers 
+    # with A and the index of the block it wants next, or N and that index after a bad frame (each followed 
+    # by the index's complement, as a check).  Frames are sent ahead up to a window that grows by a frame with 
+    # each acknowledgement and halves on an error, going back to the block the device wants.  A frame the 
+    # device is stuck on, having lost some of its bytes, is completed with zeros (which its search for the 
+    # next sync skips) once fileacktimeout has passed.  rx only returns on a frame with no payload, sent 
+    # after the last acknowledgement (or to give up), so nothing sent is left over for the raw REPL.
+    def sendframes(self, filecontents, bquiet, memfree):
+        sswrite = self.workingserial.write
+        blocksize = max(64, min(fileblocksize, memfree//16))
+        nbytes = len(filecontents)
+        nblocks = (nbytes + blocksize - 1)//blocksize
+        def frame(i):
+            payload = filecontents[i*blocksize:(i+1)*blocksize]
+            h = struct.pack("<HH", len(payload), i & 0xffff)
+            return streamsync + h + struct.pack("<I", zlib.crc32(payload, zlib.crc32(h))) + payload
+        endframe = frame(nblocks)
+        filler = bytes(streamheader.size + blocksize)
+
+        rbuf = bytearray()
+        def readack(acked):   # A or N and the block index, E at the end of the program, or None on a timeout
+            while True:
+                if len(rbuf) >= 5 and rbuf[:1] in (b'A', b'N'):
+                    i, ni = struct.unpack_from("<HH", rbuf, 1)
+                    if i ^ ni == 0xffff:
+                        x = bytes(rbuf[:1])
+                        del rbuf[:5]
+                        return x, acked + ((i - acked) & 0xffff)
+                if rbuf[:1] == b'\x04':   # the end, if the rest of what the raw REPL ends with follows
+                    if rbuf.find(b'\x04>', 1) == -1:
+                        k, l = self.expect([b'\x04>'], fileacktimeout)
+                        rbuf.extend(l)
+                    if rbuf.find(b'\x04>', 1) != -1:
+                        self.pendingbytes = bytes(rbuf) + self.pendingbytes
+                        rbuf.clear()
+                        return b'E', acked
+                if rbuf and not (rbuf[:1] in (b'A', b'N') and len(rbuf) < 5):
+                    del rbuf[:1]   # garbled
+                    continue
+                b = self.readavailable(fileacktimeout)
+                if not b:
+                    return None, acked
+                rbuf.extend(b)
+
+        t0 = time.time()
+        sswrite("O_.rx({},{})\r\x04".format(nbytes, blocksize).encode())
+        k, l = self.expect([b'OK'], fileacktimeout)
+        x, i = readack(0)  if k == 0  else (None, 0)
+        if x != b'A':   # no ready from the helper
+            if x is None:
+                self.sres("No answer from the device\n", 31)
+            self.receivestream(bseekokay=(k != 0))   # shows the error
+            return 0, 0, time.time() - t0
+
+        acked, nextsent, window = 0, 0, 1
+        nresent, nframes = 0, 0
+        tprogress = time.time()   # given up on when nothing has been acknowledged for as long as the retries of a block would take
+        nackedat = None   # where the last N went back to, so the Ns of the frames that were in flight behind it are ignored
+        bended = False
+        try:
+            while acked < nblocks:
+                while nextsent < nblocks and nextsent - acked < window:
+                    sswrite(frame(nextsent))
+                    nextsent += 1
+                    nframes += 1
+                x, i = readack(acked)
+                if x == b'A':
+                    if i > acked:
+                        acked = i
+                        window = min(window + 1, filewindowmax)
+                        tprogress = time.time()
+                        nackedat = None
+                        if not bquiet:
+                            self.sres("{}%, {} bytes, {} frames of {} in flight".format(int(acked/nblocks*100), min(acked*blocksize, nbytes), window, blocksize), clear_output=True)
+                    continue
+                if x == b'E':   # the program has ended, with an error
+                    bended = True
+                    break
+                if x == b'N':
+                    if i == nackedat:
+                        continue
+                    nackedat = i
+                    nresent += nextsent - i
+                    nextsent = i
+                else:   # anything lost is resent after the filler has completed any frame the device is part way through, which Ns it
+                    sswrite(filler)
+                    nackedat = acked
+                    nresent += nextsent - acked
+                    nextsent = acked
+                window = max(1, window//2)
+                if time.time() - tprogress > (fileretries + 1)*fileacktimeout:
+                    break
+
+            for k in range(fileretries + 1):
+                if bended:
+                    break
+                sswrite((filler  if k  else b'') + endframe)
+                while True:
+                    x, i = readack(acked)
+                    if x in (b'E', None):
+                        bended = (x == b'E')
+                        break
+        except KeyboardInterrupt:
+            sswrite(filler + endframe)
+            raise
+        finally:
+            if bended:
+                self.receivestream(bseekokay=False)
+        if not bended:
+            self.sres("The device did not finish receiving the file, it may need to be reset\n", 31)
+        nsent = min(acked*blocksize, nbytes)
+        if nsent != nbytes:
+            self.sres("Transfer failed at byte {} of {}\n".format(nsent, nbytes), 31)
+        elif nresent:
+            self.sres("{} frames sent again after errors\n".format(nresent), 31)
+        return nsent, nframes, time.time() - t0
 
-        sswrite("O.close()\r\n".encode())
-        sswrite("del O\r\n".encode())
+    # Batches of O_.w("<base64>") calls are streamed to the file opened by the helper, acknowledged once per batch.
+    # The chunk size comes from the device's free memory, and the window (chunks per batch) is set so a batch 
+    # takes several round trips to send at the link rate measured from the previous batch, capped by memory.  
+    # A batch that produces any output has failed (eg MemoryError) and is resent smaller from its offset.
+    def sendbinarychunks(self, filecontents, bappend, bquiet, memfree, rtt):
+        chunksize = max(30, min(1536, memfree//64//3*3))
+        maxbatchbytes = max(chunksize, memfree//6)
+        targetbatchtime = max(4*rtt, 0.1)
+        window = 4
+        nbytes = len(filecontents)
+        i, nchunks, nretries = 0, 0, 0
+        t0 = time.time()
+        while i < nbytes:
+            window = max(1, min(window, maxbatchbytes//chunksize))
+            j = min(nbytes, i + window*chunksize)
+            batch = [ b'O_.seek(%d)\r\n' % i ]  if nretries  else [ ]
+            for k in range(i, j, chunksize):
+                batch.append(b'O_.w("' + binascii.b2a_base64(filecontents[k:k+chunksize])[:-1] + b'")\r\n')
+            bbatch = b''.join(batch)
+
+            tbatch = time.time()
+            errres = self.runbatch(bbatch)
+            tbatch = time.time() - tbatch
+            if errres:
+                self.sres("".join(errres), 31)
+                if bappend or nretries == 3:
+                    self.sres("Transfer failed at byte {} of {}\n".format(i, nbytes), 31)
+                    return i, nchunks, time.time() - t0
+                nretries += 1
+                window = max(1, window//2)
+                chunksize = max(30, chunksize//2//3*3)
+                continue
+
+            nbatchchunks = (j - i + chunksize - 1)//chunksize
+            nchunks += nbatchchunks
+            nretries = 0
+            i = j
+            linkrate = len(bbatch)/max(tbatch - rtt, 0.001)
+            idealwindow = int(targetbatchtime*linkrate/(len(bbatch)/nbatchchunks))
+            window = max(1, min(window*2, idealwindow))   # grow at most by doubling, shrink straight away
+            if not bquiet:
+                self.sres("{}%, {} bytes, {} chunks of {} in flight".format(int(i/nbytes*100), i, window, chunksize), clear_output=True)
+        return i, nchunks, time.time() - t0
+
+    def runbatch(self, bprogram):   # executes in the raw REPL, returning any output 
+        if self.rawpastewrite(bprogram):
+            return self.receivestream(bseekokay=False, bfetchfilecapture_nchunks=-1)
+        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        sswrite(bprogram)
         sswrite(b'\r\x04')
-        self.receivestream(bseekokay=True)
+        return self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
 
-    def fetchfile(self, sourcefilename, bbinary, bquiet):
+    # returns the number of bytes written to fout, or None if the file could not be fetched whole
+    def fetchfile(self, sourcefilename, bbinary, bquiet, fout, bcompress=False):
         if not (self.workingserial or self.workingwebsocket):
             self.sres("File transfers not implemented for sockets\n", 31)
             return None
         sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+
+        if bcompress:
+            if "c" in self.probedeflate():
+                return self.fetchcompressed(sourcefilename, bquiet, fout)
+            self.sres("Device cannot deflate, fetching uncompressed\n", 31)
         
         if not bbinary:
             self.sres("non-binary mode not implemented, switching to binary")
         if True:
             chunksize = 30
-            sswrite(b"import sys,os;O7=sys.stdout.write\r\n")
-            sswrite(b"import ubinascii;O8=ubinascii.b2a_base64\r\n")
-            sswrite("O=open({},'rb')\r\n".format(repr(sourcefilename)).encode())
-            sswrite(b"O9=bytearray(%d)\r\n" % chunksize)
-            sswrite("O4=os.stat({})[6]\r\n".format(repr(sourcefilename)).encode())
-            sswrite(b"print(O4)\r\n")
-            sswrite(b'\r\x04')   # intermediate execution to get chunk size
-            chunkres = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+            chunkres = self.callhelper("O_.stat({})".format(repr(sourcefilename)))   # the size, for the progress
             try:
                 nbytes = int("".join(chunkres))
-            except ValueError:
+            except (ValueError, TypeError):
                 self.sres(str(chunkres))
                 return None
-                
-            sswrite(b"O7(O8(O.read(O4%%%d)))\r\n" % chunksize)  # get sub-block
-            sswrite(b"while O.readinto(O9): O7(O8(O9))\r\n")
-            sswrite(b"O.close(); del O,O7,O8,O9,O4\r\n")
+
+            if self.workingserial and self.helperframes:
+                return self.fetchframes(sourcefilename, nbytes, bquiet, fout)
+            sswrite("O_.get({},{})\r\n".format(repr(sourcefilename), chunksize).encode())
             sswrite(b'\r\x04')
-            chunks = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=nbytes//chunksize+1)
-            rres = [ ]
-            for ch in chunks:
-                try:
-                    rres.append(binascii.a2b_base64(ch))
-                except binascii.Error as e:
-                    self.sres(str(e))
-                    self.sres(str([ch]))
-            res = b"".join(rres)
+            fsink = FetchFileSink(fout, nbytes, self.sres, bquiet)
+            self.receivestream(bseekokay=True, fetchfilesink=fsink)
+            fsink.close()
+            if fsink.nfetched != nbytes:
+                self.sres("Fetched {} of {} bytes from {}\n".format(fsink.nfetched, nbytes, sourcefilename), 31)
+                return None
             if not bquiet:
-                self.sres("Fetched {}={} bytes from {}.\n".format(len(res), nbytes, sourcefilename), clear_output=True)
-            return res
+                self.sres("Fetched {}={} bytes from {}.\n".format(fsink.nfetched, nbytes, sourcefilename), clear_output=True)
+            return fsink.nfetched
         return None
 
-    def listdir(self, dirname, recurse):
-        self.sres("Listing directory '%s'.\n" % (dirname or '/'))
+    # The helper's tx sends the blocks of the file over serial in frames of the streamheader format (the 
+    # sequence number being the block index) to a FileFrameSink, and then sends again any that were lost 
+    # or had a bad CRC, as many times as it takes to get them up to fileretries rounds without progress
+    def fetchframes(self, sourcefilename, nbytes, bquiet, fout):
+        blocksize = fileblocksize
+        fsink = FileFrameSink(fout, nbytes, blocksize, self.sres, bquiet)
+        missing = None
+        nrounds, nresent = 0, 0
+        while nrounds <= fileretries:
+            nmissing = len(fsink.missing())
+            self.workingserial.write("O_.tx({},{},{})\r\x04".format(repr(sourcefilename), blocksize, missing).encode())
+            self.receiveframes(fsink, True, bquiet=True, bdroptext=True, bendframe=True)   # anything between the frames is garbled ones
+            self.receivestream(bseekokay=False)
+            missing = fsink.missing()
+            if not missing:
+                break
+            nrounds = (nrounds + 1  if len(missing) == nmissing  else 0)
+            missing = (missing[:256//(nrounds + 1)])*(nrounds + 1)   # copies of each after rounds that got none of them, in a call line that stays short
+            nresent += len(missing)
+        fsink.close()
+        if fsink.nfetched != nbytes:
+            self.sres("Fetched {} of {} bytes from {}, {} blocks missing\n".format(fsink.nfetched, nbytes, sourcefilename, len(fsink.missing())), 31)
+            return None
+        if not bquiet:
+            self.sres("Fetched {}={} bytes from {}{}.\n".format(fsink.nfetched, nbytes, sourcefilename, 
+                      (", {} blocks sent again".format(nresent)  if nresent  else "")), clear_output=True)
+        return fsink.nfetched
+
+    # deflates into a temporary file on the device, fetches that and inflates it on the way to fout
+    def fetchcompressed(self, sourcefilename, bquiet, fout):
         sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
-        
-        def ssldir(d):
-            sswrite(b"import os,sys\r\n")
-            sswrite(("for O in os.ilistdir(%s):\r\n" % repr(d)).encode())
-            sswrite(b"  sys.stdout.write(repr(O))\r\n")
-            sswrite(b"  sys.stdout.write('\\n')\r\n")
-            sswrite(b"del O\r\n")
-            sswrite(b'\r\x04')
-            k = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
-            ll = list(map(ast.literal_eval, k))
+        tmpfilename = sourcefilename + ".z~"
+        sswrite(b"import deflate\r\n")
+        sswrite("O=open({},'rb')\r\n".format(repr(sourcefilename)).encode())
+        sswrite("O1=open({},'wb')\r\n".format(repr(tmpfilename)).encode())
+        sswrite(b"O2=deflate.DeflateIO(O1,deflate.ZLIB,%d)\r\n" % deflatewbits)
+        sswrite(b"O9=bytearray(512)\r\n")
+        sswrite(b"while True:\r\n n=O.readinto(O9)\r\n if not n: break\r\n O2.write(memoryview(O9)[:n])\r\n")
+        sswrite(b"O2.close(); O1.close(); O.close()\r\n")
+        sswrite(b"del O,O1,O2,O9\r\n")
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+
+        inflatewriter = InflateWriter(fout)
+        nfetched = self.fetchfile(tmpfilename, True, bquiet, inflatewriter)
+        sswrite("O_.rm([{}])\r\n".format(repr(tmpfilename)).encode())
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        if nfetched is None:
+            return None
+        if not inflatewriter.finish():
+            self.sres("Compressed data from {} was incomplete\n".format(sourcefilename), 31)
+            return None
+        self.sres("Fetched {} bytes as {} compressed ({:.1f}x)\n".format(inflatewriter.ninflated, nfetched, inflatewriter.ninflated/max(nfetched, 1)))
+        return inflatewriter.ninflated
+
+    # the helper walks the device directory and prints the sha256 of every file in it
+    def hashfiles(self, dirname):
+        if not (self.workingserial or self.workingwebsocket):
+            self.sres("File transfers not implemented for sockets\n", 31)
+            return None
+        res = self.callhelper("O_.hashes({})".format(repr(dirname.rstrip("/") or dirname)))
+        if res is None:
+            return None
+        filehashes = { }
+        for l in res:
+            h, _, p = l.strip().partition(" ")
+            if len(h) != 64 or not p:
+                self.sres(l, 31)
+                return None
+            filehashes[p] = h
+        return filehashes
+
+    # defines streamwrite(bytes) on the device, which sends the bytes in a frame for receiveframes
+    def streamprelude(self):
+        if not (self.workingserial or self.workingwebsocket):
+            self.sres("Streams not implemented for sockets\n", 31)
+            return False
+        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        sswrite(b"import sys,struct\r\n")
+        sswrite(b"try:\r\n from binascii import crc32 as O7\r\nexcept ImportError:\r\n")
+        sswrite(b" def O7(b,c=0):\r\n  c^=0xffffffff\r\n  for x in b:\r\n   c^=x\r\n")
+        sswrite(b"   for i in range(8):\r\n    c=(c>>1)^(0xedb88320&-(c&1))\r\n  return c^0xffffffff\r\n")
+        sswrite(b"O8=getattr(sys.stdout,'buffer',sys.stdout).write\r\n")
+        sswrite(b"O6=[0]\r\n")
+        sswrite(b"def streamwrite(b):\r\n")
+        sswrite(b" h=struct.pack('<HH',len(b),O6[0])\r\n")
+        sswrite(("".join((" O8({}+h+struct.pack('<I',O7(b,O7(h))))\r\n".format(repr(streamsync)), " O8(b)\r\n"))).encode())
+        sswrite(b" O6[0]=(O6[0]+1)&0xffff\r\n")
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        return True
+
+    # Reads the frames sent by streamwrite straight from the connection (the tokenizer would split them 
+    # at any \x04 or OK in the data), giving the payloads with a good CRC and their sequence numbers to 
+    # sink.add.  Frames missing from the sequence numbers are counted as dropped.  Text printed between 
+    # the frames is shown (unless bdroptext), and the \x04 that ends the program's output is left for receivestream.
+    # With bendframe the program sends a frame with no payload after the others, only after which can a \x04 
+    # (which might otherwise be in a garbled frame) be the end, unless the device has gone quiet after it.
+    def receiveframes(self, sink, bseekokay, bquiet=False, bdroptext=False, bendframe=False):
+        hsize = streamheader.size
+        buf = bytearray()
+        bended = not bendframe   # the frames have ended with one of no payload
+        bidle = False            # nothing came with the last read
+        nframes, ndropped, ncrcerrors, nbytes = 0, 0, 0, 0
+        seq = None
+        t0 = treport = time.monotonic()
+        def report(end):
+            t = max(time.monotonic() - t0, 1e-6)
+            self.sres("\r{} frames, {:.0f} frames/s, {:.0f} bytes/s, {} dropped, {} CRC errors{}".format(nframes, nframes/t, nbytes/t, ndropped, ncrcerrors, end))
+        while True:
+            if bseekokay:
+                k = buf.find(b'OK')
+                if k != -1:
+                    del buf[:k+2]
+                    bseekokay = False
+                    continue
+            else:
+                # the end of the program's output is \x04, any error and \x04> before another frame (so a 
+                # \x04 in a garbled frame isn't taken for it), and text is held back from a \x04 until it is known
+                i = buf.find(streamsync)
+                e = buf.find(b'\x04>', 1, (len(buf) if i == -1 else i))
+                if not bended and not (bidle and e == len(buf) - 2):
+                    e = -1   # until the end frame (if it wasn't garbled, when the \x04> must be the last thing sent)
+                j = buf.rfind(b'\x04', 0, e)  if e != -1  else -1
+                if j != -1:
+                    if j and not bdroptext:
+                        self.sres(buf[:j].decode(errors="replace"))
+                    self.pendingbytes = bytes(buf[j:]) + self.pendingbytes
+                    break
+                j = buf.find(b'\x04')
+                ntext = i  if i != -1  else (j  if j != -1  else len(buf) - (1 if buf[-1:] == streamsync[:1] else 0))
+                if ntext:
+                    if not bdroptext:
+                        self.sres(buf[:ntext].decode(errors="replace"))
+                    del buf[:ntext]
+                if i != -1 and len(buf) >= hsize:
+                    sync, n, fseq, crc = streamheader.unpack_from(buf)
+                    if len(buf) >= hsize + n:
+                        payload = bytes(buf[hsize:hsize+n])
+                        if zlib.crc32(payload, zlib.crc32(buf[2:6])) == crc and n == 0 and bendframe:
+                            bended = True
+                            del buf[:hsize]
+                        elif zlib.crc32(payload, zlib.crc32(buf[2:6])) == crc:
+                            sink.add(payload, fseq)
+                            nframes += 1
+                            nbytes += n
+                            if seq is not None:
+                                ndropped += (fseq - seq - 1) & 0xffff
+                            seq = fseq
+                            del buf[:hsize+n]
+                        else:
+                            ncrcerrors += 1
+                            del buf[:len(streamsync)]   # look for the next frame
+                        continue
+
+            b = self.readavailable()
+            bidle = not b
+            if b and self.timing and self.timing.phase == "wait":
+                self.timing.enter("execute")
+            if not b and buf[:len(streamsync)] == streamsync and b'\x04' in buf[hsize:]:
+                ncrcerrors += 1   # a garbled length waiting for bytes that will never come
+                del buf[:len(streamsync)]
+            buf += b
+            if not bquiet and time.monotonic() - treport >= streamreporttime:
+                report("")
+                treport = time.monotonic()
+        self.streamstats = { "frames": nframes, "dropped": ndropped, "crcerrors": ncrcerrors, "bytes": nbytes, "seconds": time.monotonic() - t0 }
+        if not bquiet:
+            report("\n")
+
+    def removefiles(self, filenames):
+        self.invalidatefscache()
+        res = self.callhelper("O_.rm({})".format(repr(list(filenames))))
+        if res:
+            self.sres("".join(res), 31)
+
+    # Fetches the listing of dirname (and everything below it with recurse) in one call of the helper into 
+    # fscache, which maps each directory to its sorted [(name, size)] with size -1 for subdirectories.  
+    # The cache is cleared by anything that could change the files on the device.
+    def fetchlistdir(self, dirname, recurse):
+        k = self.callhelper("O_.ls(%s,%d)" % (repr(dirname), recurse))
+        if k is None:
+            return False
+
+        listing = { }
+        d = None
+        for l in k:
+            l = l.rstrip("\r\n")
+            if l[:2] == "D ":
+                d = l[2:]
+                listing[d] = [ ]
+                continue
+            size, _, name = l.partition(" ")
+            try:
+                listing[d].append((name, int(size)))
+            except (KeyError, ValueError):
+                self.sres("".join(k), 31)
+                return False
+        for d, ll in listing.items():
             ll.sort()
-            for l in ll:
-                if l[1] == 0x4000:
-                    self.sres("             %s/\n"%(d+'/'+l[0]).lstrip("/"))
+            self.fscache[d] = ll
+        return True
+
+    def cachedlistdir(self, dirname, recurse=False):   # returns cached listing, fetching anything missing
+        dirname = dirname.rstrip("/") or dirname
+        if dirname not in self.fscache or (recurse and not self.fscachecomplete(dirname)):
+            if not self.fetchlistdir(dirname, recurse):
+                return None
+        return self.fscache.get(dirname)
+
+    def cachedlisting(self, dirname):   # only what is in the cache (or None), under any of the names of the directory from the root
+        for d in (dirname.rstrip("/") or dirname, "/" + dirname.strip("/"), dirname.strip("/")):
+            if d in self.fscache:
+                return self.fscache[d]
+        return None
+
+    def fscachecomplete(self, dirname):
+        ll = self.fscache.get(dirname)
+        return ll is not None and all(self.fscachecomplete(dirname+'/'+name)  for name, size in ll  if size == -1)
+
+    def invalidatefscache(self):
+        self.fscache.clear()
+
+    def listdir(self, dirname, recurse, brefresh=False):
+        self.sres("Listing directory '%s'.\n" % (dirname or '/'))
+        if brefresh:
+            self.invalidatefscache()
+        dirname = dirname.rstrip("/") or dirname
+        if self.cachedlistdir(dirname, recurse) is None:
+            return None
+
+        def ssldir(d):
+            ll = self.fscache.get(d, [ ])
+            for name, size in ll:
+                if size == -1:
+                    self.sres("             %s/\n"%(d+'/'+name).lstrip("/"))
                 else:
-                    self.sres("%9d    %s\n" % (l[3], (d+'/'+l[0]).lstrip("/")))
-            return [ d+"/"+l[0]  for l in ll  if l[1] == 0x4000 ]
+                    self.sres("%9d    %s\n" % (size, (d+'/'+name).lstrip("/")))
+            return [ d+"/"+name  for name, size in ll  if size == -1 ]
             
         ld = ssldir(dirname)
         if recurse:
@@ -488,16 +1975,32 @@ class DeviceConnector:
         return None
         
         
+    # Waits for the first of patterns to come from the device, returning its index (or -1 after timeout 
+    # seconds) and everything up to the end of it.  What comes after is left for the next read.
+    def expect(self, patterns, timeout):
+        res = b''
+        tend = time.monotonic() + timeout
+        while True:
+            found = [ (k, i)  for k, i in ((res.find(pattern), i)  for i, pattern in enumerate(patterns))  if k != -1 ]
+            if found:
+                k, i = min(found)
+                kend = k + len(patterns[i])
+                self.pendingbytes = res[kend:] + self.pendingbytes
+                return i, res[:kend]
+            t = tend - time.monotonic()
+            if t <= 0:
+                self.pendingbytes = res + self.pendingbytes
+                return -1, b''
+            res += self.readavailable(t)
+
     def enterpastemode(self, verbose=True):         # I don't think we ever make a connection and it's still in paste mode (this is revoked on connection break, but I am trying to use exitpastemode to make it better)
         # now sort out connection situation
         if self.workingserial or self.workingwebsocket:
             sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
             
-            time.sleep(0.2)   # try to give a moment to connect before issuing the Ctrl-C
             sswrite(b'\x03')    # ctrl-C: kill off running programs
-            time.sleep(0.1)
-            l = self.workingserialreadall()
-            if l[-6:] == b'\r\n>>> ':
+            i, l = self.expect([normalprompt], prompttimeout)
+            if i == 0:
                 if verbose:
                     self.sres('repl is in normal command mode\n')
                     self.sres('[\\r\\x03\\x03] ')
@@ -505,22 +2008,88 @@ class DeviceConnector:
             else:
                 if verbose:
                     self.sres('normal repl mode not detected ')
-                    self.sres(str(l))
                     self.sres('\nnot command mode\n')
                     
                 
             #self.workingserial.write(b'\r\x02')        # ctrl-B: leave paste mode if still in it <-- doesn't work as when not in paste mode it reboots the device
-            sswrite(b'\r\x01')        # ctrl-A: enter raw REPL
-            time.sleep(0.1)
-            l = self.workingserialreadall()
+            for j in range(rawreplattempts):
+                sswrite(b'\r\x01')        # ctrl-A: enter raw REPL
+                i, l = self.expect([rawreplprompt], rawrepltimeout)
+                if i == 0:
+                    break
+                sswrite(b'\x03')
+            for k in range(j if i == 0 else 0):
+                self.expect([rawreplprompt], prompttimeout)   # prompts from the earlier tries, which the tokenizer mustn't see
             if verbose and l:
                 self.sres('\n[\\r\\x01] ')
                 self.sres(str(l))
+            if self.rawpastewrite(b'1', bprobe=True):   # single character program also detects raw-paste mode
+                if verbose:
+                    self.sres('\n[raw-paste window {}]\n'.format(self.rawpastewindowsize))
+                return self.receivestream(bseekokay=False, b5secondtimeout=True)
             sswrite(b'1\x04')         # single character program to run so receivestream works
         else:
             self.workingsocket.write(b'1\x04')         # single character program "1" to run so receivestream works
             
         return self.receivestream(bseekokay=True, bwarnokaypriors=False, b5secondtimeout=True)
+
+    # raw-paste mode (MicroPython 1.14+) streams a whole program against a window of bytes the device 
+    # has room for, so there is no echo and no round trip per line.  The device answers with R\x01 and 
+    # the window increment, sends \x01 each time it frees another window, and a \x04 to acknowledge 
+    # the end of data, after which it executes and replies with the usual ...\x04...\x04> 
+    def rawpastewrite(self, bprogram, bprobe=False):
+        if not (self.rawpastewindowsize or bprobe) or not (self.workingserial or self.workingwebsocket):
+            return False
+        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+
+        sswrite(b'\x05A\x01')
+        r = self.readrawbytes(2)
+        if r != b'R\x01':
+            if r != b'R\x00':   # older firmware takes the \x01 as a fresh Ctrl-A and reprints the raw REPL banner, which r is the start of
+                self.pendingbytes = r + self.pendingbytes
+                self.expect([rawreplprompt], prompttimeout)
+            self.rawpastewindowsize = 0
+            return False
+
+        r = self.readrawbytes(2)
+        if len(r) != 2:
+            self.rawpastewindowsize = 0
+            return False
+        self.rawpastewindowsize = r[0] | (r[1] << 8)
+        windowremaining = self.rawpastewindowsize
+
+        i = 0
+        other = bytearray()   # anything else that comes meanwhile (eg a log line), which goes on to the output
+        bend = b'\x04'
+        while i < len(bprogram):
+            if windowremaining == 0 or self.readerpending():
+                b = self.readrawbytes(1)
+                if b == b'\x01':
+                    windowremaining += self.rawpastewindowsize
+                elif b == b'\x04':
+                    break   # device has asked to end the data early
+                elif b:
+                    other += b
+                elif windowremaining == 0:
+                    self.sres("[raw-paste window timed out, the cell was not run]\n", 31)
+                    bend = b'\x03'   # ends the data, which the device then answers with a KeyboardInterrupt rather than running a part of it
+                    break
+                continue
+            n = min(windowremaining, len(bprogram) - i)
+            sswrite(bprogram[i:i+n])
+            windowremaining -= n
+            i += n
+
+        sswrite(bend)
+        for j in range(serialtimeoutcount):   # wait for the acknowledging \x04, skipping any window increments
+            b = self.readrawbytes(1)
+            if b == b'\x04':
+                break
+            if b and b != b'\x01':
+                self.pendingbytes = b + self.pendingbytes
+                break
+        self.pendingbytes = bytes(other) + self.pendingbytes
+        return True
         
 
         
@@ -529,9 +2098,8 @@ class DeviceConnector:
             sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
             try:
                 sswrite(b'\r\x03\x02')    # ctrl-C; ctrl-B to exit paste mode
-                time.sleep(0.1)
-                l = self.workingserialreadall()
-            except serial.SerialException as e:
+                i, l = self.expect([normalprompt], prompttimeout)
+            except serialerrors as e:
                 self.sres("serial exception on close {}\n".format(str(e)))
                 return
             
@@ -553,6 +2121,7 @@ class DeviceConnector:
             return ("serial.write {} bytes to {}\n".format(nbyteswritten, str(self.workingsocket)))
 
     def sendrebootmessage(self):
+        self.helperversion = 0
         if self.workingserial:
             self.workingserial.write(b"\x03\r")  # quit any running program
             self.workingserial.write(b"\x02\r")  # exit the paste mode with ctrl-B
@@ -1,10 +1,8 @@
 from ipykernel.kernelbase import Kernel
-import IPython
+from traitlets import Dict
 
-import logging, sys, time, os, re
-import serial, socket, serial.tools.list_ports, select
-import websocket  # only for WebSocketConnectionClosedException
-from . import deviceconnector
+import logging, sys, time, os, re, io, hashlib, collections, threading, queue, json, shutil, subprocess
+from . import deviceconnector   # which imports serial and websocket only when they are first used
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -12,79 +10,244 @@ logger.setLevel(logging.INFO)
 serialtimeout = 0.5
 serialtimeoutcount = 10
 
+# output to the frontend is coalesced into iopub messages of up to this size, held for no longer than this time
+sresflushsize = 8192
+sresflushtime = 0.05
+
+# lines of device output that arrived between cells kept for %idle, and how many are shown as [leftinbuffer]
+idleoutputlines = 2000
+idleoutputshown = 10
+
+# per-cell timings kept for %timing
+celltimingcount = 200
+cellphases = ["preread", "upload", "wait", "execute", "transfer", "frontend", "other"]
+transfermagics = ["%sendtofile", "%fetchfile", "%ls"]
+
+# numbers in the lines of device output plotted by %plot, and the colours of its series
+plotnumber = re.compile(rb"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+plotcolours = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f"]
+
 # use of argparse for handling the %commands in the cells
 import argparse, shlex
 
-ap_serialconnect = argparse.ArgumentParser(prog="%serialconnect", add_help=False)
-ap_serialconnect.add_argument('--raw', help='Just open connection', action='store_true')
-ap_serialconnect.add_argument('--port', type=str, default=0)
-ap_serialconnect.add_argument('--baud', type=int, default=115200)
-ap_serialconnect.add_argument('--verbose', action='store_true')
-
-ap_socketconnect = argparse.ArgumentParser(prog="%socketconnect", add_help=False)
-ap_socketconnect.add_argument('--raw', help='Just open connection', action='store_true')
-ap_socketconnect.add_argument('ipnumber', type=str)
-ap_socketconnect.add_argument('portnumber', type=int)
-
-ap_disconnect = argparse.ArgumentParser(prog="%disconnect", add_help=False)
-ap_disconnect.add_argument('--raw', help='Close connection without exiting paste mode', action='store_true')
-
-ap_websocketconnect = argparse.ArgumentParser(prog="%websocketconnect", add_help=False)
-ap_websocketconnect.add_argument('--raw', help='Just open connection', action='store_true')
-ap_websocketconnect.add_argument('websocketurl', type=str, default="ws://192.168.4.1:8266", nargs="?")
-ap_websocketconnect.add_argument("--password", type=str)
-ap_websocketconnect.add_argument('--verbose', action='store_true')
-
-ap_writebytes = argparse.ArgumentParser(prog="%writebytes", add_help=False)
-ap_writebytes.add_argument('--binary', '-b', action='store_true')
-ap_writebytes.add_argument('--verbose', '-v', action='store_true')
-ap_writebytes.add_argument('stringtosend', type=str)
-
-ap_readbytes = argparse.ArgumentParser(prog="%readbytes", add_help=False)
-ap_readbytes.add_argument('--binary', '-b', action='store_true')
-
-ap_sendtofile = argparse.ArgumentParser(prog="%sendtofile", description="send a file to the microcontroller's file system", add_help=False)
-ap_sendtofile.add_argument('--append', '-a', action='store_true')
-ap_sendtofile.add_argument('--mkdir', '-d', action='store_true')
-ap_sendtofile.add_argument('--binary', '-b', action='store_true')
-ap_sendtofile.add_argument('--execute', '-x', action='store_true')
-ap_sendtofile.add_argument('--source', help="source file", type=str, default="<<cellcontents>>", nargs="?")
-ap_sendtofile.add_argument('--quiet', '-q', action='store_true')
-ap_sendtofile.add_argument('--QUIET', '-Q', action='store_true')
-ap_sendtofile.add_argument('destinationfilename', type=str, nargs="?")
-
-ap_ls = argparse.ArgumentParser(prog="%ls", description="list directory of the microcontroller's file system", add_help=False)
-ap_ls.add_argument('--recurse', '-r', action='store_true')
-ap_ls.add_argument('dirname', type=str, nargs="?")
-
-ap_fetchfile = argparse.ArgumentParser(prog="%fetchfile", description="fetch a file from the microcontroller's file system", add_help=False)
-ap_fetchfile.add_argument('--binary', '-b', action='store_true')
-ap_fetchfile.add_argument('--print', '-p', action="store_true")
-ap_fetchfile.add_argument('--load', '-l', action="store_true")
-ap_fetchfile.add_argument('--quiet', '-q', action='store_true')
-ap_fetchfile.add_argument('--QUIET', '-Q', action='store_true')
-ap_fetchfile.add_argument('sourcefilename', type=str)
-ap_fetchfile.add_argument('destinationfilename', type=str, nargs="?")
-
-ap_mpycross = argparse.ArgumentParser(prog="%mpy-cross", add_help=False)
-ap_mpycross.add_argument('--set-exe', type=str)
-ap_mpycross.add_argument('pyfile', type=str, nargs="?")
-
-ap_esptool = argparse.ArgumentParser(prog="%esptool", add_help=False)
-ap_esptool.add_argument('--port', type=str, default=0)
-ap_esptool.add_argument('espcommand', choices=['erase', 'esp32', 'esp8266'])
-ap_esptool.add_argument('binfile', type=str, nargs="?")
-
-ap_capture = argparse.ArgumentParser(prog="%capture", description="capture output printed by device and save to a file", add_help=False)
-ap_capture.add_argument('--quiet', '-q', action='store_true')
-ap_capture.add_argument('--QUIET', '-Q', action='store_true')
-ap_capture.add_argument('outputfilename', type=str)
-
-ap_writefilepc = argparse.ArgumentParser(prog="%%writefile", description="write contents of cell to file on PC", add_help=False)
-ap_writefilepc.add_argument('--append', '-a', action='store_true')
-ap_writefilepc.add_argument('--execute', '-x', action='store_true')
-ap_writefilepc.add_argument('destinationfilename', type=str)
- 
+def ap_serialconnect():
+    ap = argparse.ArgumentParser(prog="%serialconnect", add_help=False)
+    ap.add_argument('--raw', help='Just open connection', action='store_true')
+    ap.add_argument('--port', type=str, default=0, help="port name, index in the list of %%ports or USB serial number of the board")
+    ap.add_argument('--baud', type=int, default=115200)
+    ap.add_argument('--verbose', action='store_true')
+    ap.add_argument('--session', type=str, help="name of the session to hold this connection")
+    return ap
+
+def ap_ports():
+    ap = argparse.ArgumentParser(prog="%ports", description="list the serial ports, ordered by the boards' USB serial numbers and sockets", add_help=False)
+    ap.add_argument('--rescan', help="enumerate them again even though nothing has been plugged in or out", action='store_true')
+    return ap
+
+def ap_socketconnect():
+    ap = argparse.ArgumentParser(prog="%socketconnect", add_help=False)
+    ap.add_argument('--raw', help='Just open connection', action='store_true')
+    ap.add_argument('ipnumber', type=str)
+    ap.add_argument('portnumber', type=int)
+    ap.add_argument('--session', type=str, help="name of the session to hold this connection")
+    return ap
+
+def ap_disconnect():
+    ap = argparse.ArgumentParser(prog="%disconnect", add_help=False)
+    ap.add_argument('--raw', help='Close connection without exiting paste mode', action='store_true')
+    return ap
+
+def ap_websocketconnect():
+    ap = argparse.ArgumentParser(prog="%websocketconnect", add_help=False)
+    ap.add_argument('--raw', help='Just open connection', action='store_true')
+    ap.add_argument('websocketurl', type=str, default="ws://192.168.4.1:8266", nargs="?")
+    ap.add_argument("--password", type=str)
+    ap.add_argument('--verbose', action='store_true')
+    ap.add_argument('--session', type=str, help="name of the session to hold this connection")
+    return ap
+
+def ap_reconnect():
+    ap = argparse.ArgumentParser(prog="%reconnect", description="make the connection of the session again, or set how it is done when the link breaks", add_help=False)
+    ap.add_argument('--timeout', type=float, help="seconds to keep trying after the link breaks (0 for never)")
+    ap.add_argument('--rerun', type=int, help="times a cell broken off partway through is run again")
+    return ap
+
+def ap_session():
+    ap = argparse.ArgumentParser(prog="%session", description="list the device sessions or make one of them active", add_help=False)
+    ap.add_argument('--close', '-c', help="disconnect and forget the session", action='store_true')
+    ap.add_argument('name', type=str, nargs="?")
+    return ap
+
+def ap_broadcast():
+    ap = argparse.ArgumentParser(prog="%broadcast", description="run the cell on several device sessions in parallel", add_help=False)
+    ap.add_argument('names', type=str, nargs="*", help="sessions to run on (default all connected)")
+    return ap
+
+def ap_writebytes():
+    ap = argparse.ArgumentParser(prog="%writebytes", add_help=False)
+    ap.add_argument('--binary', '-b', action='store_true')
+    ap.add_argument('--verbose', '-v', action='store_true')
+    ap.add_argument('stringtosend', type=str)
+    return ap
+
+def ap_readbytes():
+    ap = argparse.ArgumentParser(prog="%readbytes", add_help=False)
+    ap.add_argument('--binary', '-b', action='store_true')
+    return ap
+
+def ap_sendtofile():
+    ap = argparse.ArgumentParser(prog="%sendtofile", description="send a file to the microcontroller's file system", add_help=False)
+    ap.add_argument('--append', '-a', action='store_true')
+    ap.add_argument('--mkdir', '-d', action='store_true')
+    ap.add_argument('--binary', '-b', action='store_true')
+    ap.add_argument('--execute', '-x', action='store_true')
+    ap.add_argument('--source', help="source file", type=str, default="<<cellcontents>>", nargs="?")
+    ap.add_argument('--quiet', '-q', action='store_true')
+    ap.add_argument('--QUIET', '-Q', action='store_true')
+    ap.add_argument('--sync', '-s', help="only send files in a source directory whose hashes differ on the device", action='store_true')
+    ap.add_argument('--compress', '-z', help="deflate on the PC and inflate on the device", action='store_true')
+    ap.add_argument('--delete', help="with --sync, remove device files not in the source directory", action='store_true')
+    ap.add_argument('--mpy', help="cross-compile the .py files of the source (except boot.py and main.py) and send the .mpy", action='store_true')
+    ap.add_argument('destinationfilename', type=str, nargs="?")
+    return ap
+
+def ap_helper():
+    ap = argparse.ArgumentParser(prog="%helper", description="show the helper on the device that the file commands call, or choose where it is kept", add_help=False)
+    ap.add_argument('--flash', help="save it as a module on the device so it is imported rather than sent on each connection", action='store_true')
+    ap.add_argument('--remove', help="delete the saved module, so it is kept in RAM only", action='store_true')
+    return ap
+
+def ap_ls():
+    ap = argparse.ArgumentParser(prog="%ls", description="list directory of the microcontroller's file system", add_help=False)
+    ap.add_argument('--recurse', '-r', action='store_true')
+    ap.add_argument('--refresh', '-f', help="ignore the cached listing", action='store_true')
+    ap.add_argument('dirname', type=str, nargs="?")
+    return ap
+
+def ap_fetchfile():
+    ap = argparse.ArgumentParser(prog="%fetchfile", description="fetch a file from the microcontroller's file system", add_help=False)
+    ap.add_argument('--binary', '-b', action='store_true')
+    ap.add_argument('--print', '-p', action="store_true")
+    ap.add_argument('--load', '-l', action="store_true")
+    ap.add_argument('--quiet', '-q', action='store_true')
+    ap.add_argument('--QUIET', '-Q', action='store_true')
+    ap.add_argument('--compress', '-z', help="deflate on the device and inflate on the PC", action='store_true')
+    ap.add_argument('sourcefilename', type=str)
+    ap.add_argument('destinationfilename', type=str, nargs="?")
+    return ap
+
+def ap_mpycross():
+    ap = argparse.ArgumentParser(prog="%mpy-cross", add_help=False)
+    ap.add_argument('--set-exe', type=str)
+    ap.add_argument('--set-flags', type=str, help="options for mpy-cross, eg --set-flags=\"-march=xtensawin -O2\"")
+    ap.add_argument('pyfile', type=str, nargs="*")
+    return ap
+
+def ap_esptool():
+    ap = argparse.ArgumentParser(prog="%esptool", add_help=False)
+    ap.add_argument('--port', type=str, default=0, help="port, or several separated by commas or as a glob (eg /dev/ttyUSB*) to flash at once")
+    ap.add_argument('espcommand', choices=['erase', 'esp32', 'esp8266'])
+    ap.add_argument('binfile', type=str, nargs="?")
+    return ap
+
+def ap_capture():
+    ap = argparse.ArgumentParser(prog="%capture", description="capture output printed by device and save to a file", add_help=False)
+    ap.add_argument('--quiet', '-q', action='store_true')
+    ap.add_argument('--QUIET', '-Q', action='store_true')
+    ap.add_argument('--binary', '-b', help="write the bytes exactly as they come from the device", action='store_true')
+    ap.add_argument('--maxbytes', type=int, default=0, help="start a new file after this many bytes")
+    ap.add_argument('--maxlines', type=int, default=0, help="start a new file after this many lines")
+    ap.add_argument('outputfilename', type=str)
+    return ap
+
+def ap_stream():
+    ap = argparse.ArgumentParser(prog="%stream", description="run the cell, whose streamwrite(bytes) sends records packed with struct into a .npy file (needs numpy)", add_help=False)
+    ap.add_argument('--format', '-f', type=str, required=True, help="struct format of a record with its byte order, eg \"<Hh\"")
+    ap.add_argument('--records', '-n', type=int, default=65536, help="records to make room for (the limit with --mmap)")
+    ap.add_argument('--mmap', help="write straight into a memory-mapped file", action='store_true')
+    ap.add_argument('--quiet', '-q', action='store_true')
+    ap.add_argument('outputfilename', type=str)
+    return ap
+
+def ap_plot():
+    ap = argparse.ArgumentParser(prog="%plot", description="plot the numbers in the lines the cell prints (or the records of a %stream) as they come", add_help=False)
+    ap.add_argument('--points', '-n', type=int, default=2000, help="most recent samples shown")
+    ap.add_argument('--rate', type=float, default=4, help="most updates of the plot a second")
+    ap.add_argument('--width', type=int, default=800)
+    ap.add_argument('--height', type=int, default=250)
+    ap.add_argument('--show', help="print the lines that are plotted too", action='store_true')
+    return ap
+
+def ap_idle():
+    ap = argparse.ArgumentParser(prog="%idle", description="show device output that arrived between cells", add_help=False)
+    ap.add_argument('--tail', '-n', type=int, default=20)
+    ap.add_argument('--clear', '-c', action='store_true')
+    return ap
+
+def ap_noisefilter():
+    ap = argparse.ArgumentParser(prog="%noisefilter", description="drop lines of device output that start with one of a set of regexes", add_help=False)
+    ap.add_argument('--add', nargs=2, metavar=("NAME", "REGEX"), help="add or replace a rule matching the start of lines")
+    ap.add_argument('--tag', type=str, help="add a rule dropping the ESP-IDF log lines of this tag")
+    ap.add_argument('--remove', type=str, metavar="NAME")
+    ap.add_argument('--off', action='store_true')
+    ap.add_argument('--on', action='store_true')
+    ap.add_argument('--reset', help="zero the counts", action='store_true')
+    return ap
+
+def ap_timing():
+    ap = argparse.ArgumentParser(prog="%timing", description="show where the time went in recent cells", add_help=False)
+    ap.add_argument('--last', '-n', type=int, default=10)
+    ap.add_argument('--log', choices=["on", "off"], help="also log each cell's timing as a JSON record")
+    ap.add_argument('--clear', '-c', action='store_true')
+    return ap
+
+def ap_writefilepc():
+    ap = argparse.ArgumentParser(prog="%%writefile", description="write contents of cell to file on PC", add_help=False)
+    ap.add_argument('--append', '-a', action='store_true')
+    ap.add_argument('--execute', '-x', action='store_true')
+    ap.add_argument('destinationfilename', type=str)
+    return ap
+
+# The %commands: the function making the argparse parser (or None if it takes no arguments), the method of
+# MicroPythonKernel that runs it, and whether it needs a connection.  The parsers are only made by apparser
+# the first time they are wanted, rather than all of them at import while the kernel is starting up.
+magics = { "%serialconnect":    (ap_serialconnect, "magicserialconnect", False),
+           "%websocketconnect": (ap_websocketconnect, "magicwebsocketconnect", False),
+           "%socketconnect":    (ap_socketconnect, "magicsocketconnect", False),
+           "%ports":            (ap_ports, "magicports", False),
+           "%esptool":          (ap_esptool, "magicesptool", False),
+           "%%writefile":       (ap_writefilepc, "magicwritefilepc", False),
+           "%mpy-cross":        (ap_mpycross, "magicmpycross", False),
+           "%comment":          (None, "magiccomment", False),
+           "%lsmagic":          (None, "magiclsmagic", False),
+           "%idle":             (ap_idle, "magicidle", False),
+           "%noisefilter":      (ap_noisefilter, "magicnoisefilter", False),
+           "%timing":           (ap_timing, "magictiming", False),
+           "%disconnect":       (ap_disconnect, "magicdisconnect", False),
+           "%reconnect":        (ap_reconnect, "magicreconnect", False),
+           "%session":          (ap_session, "magicsession", False),
+           "%broadcast":        (ap_broadcast, "magicbroadcast", False),
+           "%capture":          (ap_capture, "magiccapture", True),
+           "%plot":             (ap_plot, "magicplot", True),
+           "%stream":           (ap_stream, "magicstream", True),
+           "%writebytes":       (ap_writebytes, "magicwritebytes", True),
+           "%readbytes":        (ap_readbytes, "magicreadbytes", True),
+           "%rebootdevice":     (None, "magicrebootdevice", True),
+           "%fetchfile":        (ap_fetchfile, "magicfetchfile", True),
+           "%ls":               (ap_ls, "magicls", True),
+           "%helper":           (ap_helper, "magichelper", True),
+           "%sendtofile":       (ap_sendtofile, "magicsendtofile", True) }
+
+magicmisspellings = { "%reboot": "%rebootdevice", "%%writetofile": "%%writefile", "%writefile": "%%writefile",
+                      "%serialdisconnect": "%disconnect", "%sendbytes": "%writebytes",
+                      "%savetofile": "%sendtofile", "%savefile": "%sendtofile", "%sendfile": "%sendtofile",
+                      "%readfile": "%fetchfile", "%fetchfromfile": "%fetchfile" }
+
+apparsers = { }
+def apparser(percentcommand):
+    if percentcommand not in apparsers:
+        apparsers[percentcommand] = magics[percentcommand][0]()
+    return apparsers[percentcommand]
 
 def parseap(ap, percentstringargs1):
     try:
@@ -120,6 +283,164 @@ def parseap(ap, percentstringargs1):
 # to the web-browser
 
 
+# Splits the wall time of a cell into phases with one monotonic clock reading per switch, so the phases 
+# never overlap and add up to the total: preread (clearing output left from before), upload (writing the 
+# cell), wait (until the device answers), execute (the device running and its output coming back), 
+# transfer (file commands), frontend (sending output to the notebook) and other
+class CellTiming:
+    def __init__(self, execution_count, code):
+        self.execution_count = execution_count
+        self.code = code.strip().split("\n", 1)[0][:40]
+        self.seconds = dict.fromkeys(cellphases, 0.0)
+        self.nbytes = dict.fromkeys(cellphases, 0)
+        self.phase = "other"
+        self.tstart = self.tphase = time.monotonic()
+        self.total = 0.0
+        self.link = None
+
+    def enter(self, phase):   # returns the phase it left, to go back to
+        t = time.monotonic()
+        self.seconds[self.phase] += t - self.tphase
+        self.tphase = t
+        prevphase, self.phase = self.phase, phase
+        return prevphase
+
+    def count(self, phase, nbytes):
+        self.nbytes[phase] += nbytes
+
+    def finish(self, link):
+        self.enter("other")
+        self.total = self.tphase - self.tstart
+        self.link = link
+
+    def record(self):
+        return { "cell": self.execution_count, "code": self.code, "link": self.link, "total": round(self.total, 6),
+                 "seconds": dict((phase, round(t, 6))  for phase, t in self.seconds.items()), "bytes": self.nbytes }
+
+
+# collects the output of one session in a broadcast into whole lines labelled with the session name, 
+# so that lines from devices running in parallel don't get spliced together
+class SessionLineWriter:
+    def __init__(self, name, outqueue):
+        self.name = name
+        self.outqueue = outqueue
+        self.partline = ""
+        self.partn04count = 0
+
+    def sresSYS(self, output, clear_output=False):
+        self.sres(output, asciigraphicscode=34)
+
+    def sres(self, output, asciigraphicscode=None, n04count=0, clear_output=False):   # clear_output is dropped as it would clear every session's output
+        if asciigraphicscode or n04count != self.partn04count:
+            self.close()
+        self.partn04count = n04count
+        if asciigraphicscode:
+            self.putlines(output, asciigraphicscode, n04count)
+            return
+        self.partline += output
+        i = self.partline.rfind("\n")
+        if i != -1:
+            self.putlines(self.partline[:i+1], None, n04count)
+            self.partline = self.partline[i+1:]
+
+    def putlines(self, text, asciigraphicscode, n04count):
+        labelled = "".join("[{}] {}".format(self.name, line)  for line in text.splitlines(True))
+        if labelled:
+            self.outqueue.put((self.name, labelled, asciigraphicscode, n04count))
+
+    def close(self):
+        if self.partline:
+            self.putlines(self.partline + "\n", None, self.partn04count)
+            self.partline = ""
+
+
+# Keeps the numbers of each line of output (or each record of a %stream) in a ring buffer of the last
+# npoints samples and draws them as an SVG of at most one min and max per pixel column, which is sent
+# to the frontend no more than rate times a second and updated in place through its display_id.  Lines
+# without numbers are passed to showtext.  write and idle have the interface of a CaptureWriter.
+class LivePlot:
+    def __init__(self, npoints, rate, width, height, bshow, showtext, display):
+        self.samples = collections.deque(maxlen=npoints)
+        self.mininterval = 1/max(rate, 0.01)
+        self.width = width
+        self.height = height
+        self.bshow = bshow
+        self.showtext = showtext
+        self.display = display   # display(data, bupdate)
+        self.partline = b''
+        self.nsamples = 0
+        self.nupdates = 0
+        self.tupdate = 0
+        self.bchanged = False
+
+    def write(self, rline):   # takes everything, showing what isn't plotted through showtext
+        lines = (self.partline + rline).split(b"\n")
+        self.partline = lines.pop()
+        for line in lines:
+            values = plotnumber.findall(line)
+            if values:
+                self.samples.append(tuple(map(float, values[:len(plotcolours)])))
+                self.nsamples += 1
+                self.bchanged = True
+            if self.bshow or not values:
+                self.showtext(line.decode(errors="replace") + "\n")
+        self.idle()
+        return True
+
+    def addrecords(self, records):   # from a StreamArray, with numpy
+        for r in records.tolist():
+            values = r  if isinstance(r, (tuple, list))  else (r,)
+            self.samples.append(tuple(float(x)  for x in values  if isinstance(x, (int, float)))[:len(plotcolours)])
+        self.nsamples += len(records)
+        self.bchanged = True
+
+    def idle(self, bfinal=False):
+        t = time.monotonic()
+        if self.bchanged and (bfinal or t - self.tupdate >= self.mininterval):
+            self.display({ "image/svg+xml": self.svg(), "text/plain": "{} samples".format(self.nsamples) }, self.nupdates != 0)
+            self.nupdates += 1
+            self.tupdate = t
+            self.bchanged = False
+        return False
+
+    def close(self):
+        if self.partline:
+            self.write(b"\n")
+        self.idle(bfinal=True)
+
+    def svg(self):
+        samples = list(self.samples)
+        values = [ v  for sample in samples  for v in sample ]
+        ymin, ymax = (min(values), max(values))  if values  else (0.0, 1.0)
+        if ymax == ymin:
+            ymin, ymax = ymin - 1, ymax + 1
+        margin = 50
+        w, h = self.width - margin, self.height - 20
+        def py(v):
+            return "{:.1f}".format(10 + (ymax - v)/(ymax - ymin)*(h - 10))
+        n0 = self.nsamples - len(samples)
+        res = [ '<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" font-family="sans-serif" font-size="11">'.format(self.width, self.height),
+                '<rect x="{}" y="10" width="{}" height="{}" fill="none" stroke="#999"/>'.format(margin, w, h - 10),
+                '<text x="{}" y="14" text-anchor="end">{:.4g}</text>'.format(margin - 4, ymax),
+                '<text x="{}" y="{}" text-anchor="end">{:.4g}</text>'.format(margin - 4, h, ymin),
+                '<text x="{}" y="{}">{}</text>'.format(margin, h + 14, n0),
+                '<text x="{}" y="{}" text-anchor="end">{}</text>'.format(self.width, h + 14, self.nsamples) ]
+        nseries = max(map(len, samples), default=0)
+        ncolumns = min(w, len(samples))
+        for k in range(nseries):
+            points = [ ]
+            for c in range(ncolumns):   # the min and max of the samples under each pixel column, so no peak is lost
+                column = [ sample[k]  for sample in samples[c*len(samples)//ncolumns:(c+1)*len(samples)//ncolumns]  if len(sample) > k ]
+                if column:
+                    x = "{:.1f}".format(margin + (c + 0.5)*w/ncolumns)
+                    points.append(x + "," + py(min(column)))
+                    if len(column) > 1:
+                        points.append(x + "," + py(max(column)))
+            res.append('<polyline fill="none" stroke="{}" stroke-width="1" points="{}"/>'.format(plotcolours[k], " ".join(points)))
+        res.append('</svg>')
+        return "".join(res)
+
+
 class MicroPythonKernel(Kernel):
     implementation = 'micropython_kernel'
     implementation_version = "v3"
@@ -131,16 +452,48 @@ class MicroPythonKernel(Kernel):
                      'mimetype': 'text/python',
                      'file_extension': '.py'}
 
+    # eg c.MicroPythonKernel.noisefilters = {"mytag": r"\[mytag\] "} in ipython_kernel_config.py
+    noisefilters = Dict(help="rules added to the noise filter, name: regex of the start of the lines to drop").tag(config=True)
+
     def __init__(self, **kwargs):
         Kernel.__init__(self, **kwargs)
         self.silent = False
-        self.dc = deviceconnector.DeviceConnector(self.sres, self.sresSYS)
+        self.noisefilter = deviceconnector.NoiseFilter()
+        for name, regex in self.noisefilters.items():
+            try:
+                self.noisefilter.add(name, regex)
+            except re.error as e:
+                logger.warning("noisefilters rule %s ignored: %s", name, e)
+        self.dc = deviceconnector.DeviceConnector(self.sres, self.sresSYS, self.sresidle, self.noisefilter)
+        self.sessionname = "default"        # self.dc is the active one of these
+        self.sessions = { self.sessionname: self.dc }
+        self.broadcastthreads = { }         # session name -> thread of an interrupted %broadcast that hasn't finished
+        self.broadcastinterrupted = False
         self.mpycrossexe = None
+        self.mpycrossflags = [ ]
+        self.mpycrosscache = None           # MpyCrossCache, made on first use, with counts that are reset for each command
+        self.reconnecttimeout = deviceconnector.reconnecttimeout   # 0 to not reconnect when the link breaks
+        self.reconnectreruns = 0            # times a cell broken off partway through is run again after reconnecting
 
         self.srescapturemode = 0            # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
-        self.srescapturedoutputfile = None  # used by %capture command
-        self.srescapturedlinecount = 0
-        self.srescapturedlasttime = 0       # to control the frequency of capturing reported
+        self.srescapture = None             # CaptureWriter of the %capture command, which the DeviceConnector writes to
+        self.srescapturenoisefilter = True  # whether the noise filter was on before a --binary capture
+        self.streamsink = None              # StreamArray of the %stream command, which the DeviceConnector gives the frames to
+        self.plot = None                    # LivePlot of the %plot command, fed the output or the records of a %stream
+        self.plotdisplayid = 0
+        self.streamquiet = False
+
+        self.sresbuffered = [ ]             # output held back to go out in one stream message
+        self.sresbufferedname = "stdout"
+        self.sresbufferedsize = 0
+        self.sresbufferedtime = 0
+        self.idleoutput = collections.deque(maxlen=idleoutputlines)
+        self.celltiming = None              # CellTiming of the cell being run, also given to the DeviceConnector
+        self.celltimings = collections.deque(maxlen=celltimingcount)
+        self.celltiminglog = False
+        self.sresncalls = 0                 # counts for the cell, to measure the coalescing
+        self.sresnmessages = 0
+        self.sresnbytes = 0
         
         
     def interpretpercentline(self, percentline, cellcontents):
@@ -152,350 +505,747 @@ class MicroPythonKernel(Kernel):
             return None
 
         percentcommand = percentstringargs[0]
-
-        if percentcommand == ap_serialconnect.prog:
-            apargs = parseap(ap_serialconnect, percentstringargs[1:])
-            
-            self.dc.disconnect(apargs.verbose)
-            self.dc.serialconnect(apargs.port, apargs.baud, apargs.verbose)
-            if self.dc.workingserial:
-                if not apargs.raw:
-                    if self.dc.enterpastemode(verbose=apargs.verbose):
-                        self.sresSYS("Ready.\n")
-                    else:
-                        self.sres("Disconnecting [paste mode not working]\n", 31)
-                        self.dc.disconnect(verbose=apargs.verbose)
-                        self.sresSYS("  (You may need to reset the device)")
-                        cellcontents = ""
-            else:
-                cellcontents = ""
-            return cellcontents.strip() and cellcontents or None
-
-        if percentcommand == ap_websocketconnect.prog:
-            apargs = parseap(ap_websocketconnect, percentstringargs[1:])
-            if apargs.password is None and not apargs.raw:
-                self.sres(ap_websocketconnect.format_help())
-                return None
-            self.dc.websocketconnect(apargs.websocketurl)
-            if self.dc.workingwebsocket: 
-                self.sresSYS("** WebSocket connected **\n", 32)
-                if not apargs.raw:
-                    pline = self.dc.workingwebsocket.recv()
-                    self.sres(pline)
-                    if pline == 'Password: ' and apargs.password is not None:
-                        self.dc.workingwebsocket.send(apargs.password)
-                        self.dc.workingwebsocket.send("\r\n")
-                        res = self.dc.workingserialreadall()
-                        self.sres(res)  # '\r\nWebREPL connected\r\n>>> '
-                        if not apargs.raw:
-                            if self.dc.enterpastemode(apargs.verbose):
-                                self.sresSYS("Ready.\n")
-                            else:
-                                self.sres("Disconnecting [paste mode not working]\n", 31)
-                                self.dc.disconnect(verbose=apargs.verbose)
-                                self.sres("  (You may need to reset the device)")
-                                cellcontents = ""
-            else:
-                cellcontents = ""
-            return cellcontents.strip() and cellcontents or None
-
-        # this is the direct socket kind, not attached to a webrepl
-        if percentcommand == ap_socketconnect.prog:   
-            apargs = parseap(ap_socketconnect, percentstringargs[1:])
-            self.dc.socketconnect(apargs.ipnumber, apargs.portnumber)
-            if self.dc.workingsocket:
-                self.sres("\n ** Socket connected **\n\n", 32)
-                if apargs.verbose:
-                    self.sres(str(self.dc.workingsocket))
-                self.sres("\n")
-                #if not apargs.raw:
-                #    self.dc.enterpastemode()
-            return cellcontents.strip() and cellcontents or None
-
-        if percentcommand == ap_esptool.prog:
-            apargs = parseap(ap_esptool, percentstringargs[1:])
-            if apargs and (apargs.espcommand == "erase" or apargs.binfile):
-                self.dc.esptool(apargs.espcommand, apargs.port, apargs.binfile)
-            else:
-                self.sres(ap_esptool.format_help())
-                self.sres("Please download the bin file from https://micropython.org/download/#{}".format(apargs.espcommand if apargs else ""))
-            return cellcontents.strip() and cellcontents or None
-
-        if percentcommand == ap_writefilepc.prog:
-            apargs = parseap(ap_writefilepc, percentstringargs[1:])
-            if apargs:
-                if apargs.append:
-                    self.sres("Appending to {}\n\n".format(apargs.destinationfilename), asciigraphicscode=32)
-                    fout = open(apargs.destinationfilename, ("a"))
-                    fout.write("\n")
-                else:
-                    self.sres("Writing {}\n\n".format(apargs.destinationfilename), asciigraphicscode=32)
-                    fout = open(apargs.destinationfilename, ("w"))
-                    
-                fout.write(cellcontents)
-                fout.close()
-            else:
-                self.sres(ap_writefilepc.format_help())
-            if not apargs.execute:
-                return None
-            return cellcontents # should add in some blank lines at top to get errors right
-
-        if percentcommand == "%mpy-cross":
-            apargs = parseap(ap_mpycross, percentstringargs[1:])
-            if apargs and apargs.set_exe:
-                self.mpycrossexe = apargs.set_exe
-            elif apargs.pyfile:
-                if self.mpycrossexe:
-                    self.dc.mpycross(self.mpycrossexe, apargs.pyfile)
+        if percentcommand in magicmisspellings:
+            self.sres("Did you mean {}?\n".format(magicmisspellings[percentcommand]), 31)
+            return None
+        makeap, handler, bconnected = magics.get(percentcommand, (None, None, False))
+        if handler is None or (bconnected and not self.dc.serialexists()):
+            if self.dc.serialexists():
+                self.sres("Unrecognized percentline {}\n".format([percentline]), 31)
+            return cellcontents   # left to sendcommand to say there is no connection
+
+        apargs = parseap(apparser(percentcommand), percentstringargs[1:])  if makeap  else None
+        return getattr(self, handler)(apargs, percentstringargs, cellcontents)
+
+    def magicserialconnect(self, apargs, percentstringargs, cellcontents):
+        self.selectsession(apargs.session)
+        self.dc.disconnect(apargs.verbose)
+        tconnect = time.monotonic()
+        busyports = [ dc.workingserial.port  for dc in self.sessions.values()  if dc is not self.dc and dc.workingserial ]
+        self.dc.serialconnect(apargs.port, apargs.baud, apargs.verbose, busyports)
+        if self.dc.workingserial:
+            if not apargs.raw:
+                if self.dc.enterpastemode(verbose=apargs.verbose):
+                    self.dc.rememberconnection()
+                    self.sresSYS("Ready in {:.0f} ms.\n".format((time.monotonic() - tconnect)*1000))
                 else:
-                    self.sres("Cross compiler executable not yet set\n", 31)
-                    self.sres("try: %mpy-cross --set-exe /home/julian/extrepositories/micropython/mpy-cross/mpy-cross\n")
-                if self.mpycrossexe:
-                    self.mpycrossexe = "/home/julian/extrepositories/micropython/mpy-cross/mpy-cross"
+                    self.sres("Disconnecting [paste mode not working]\n", 31)
+                    self.dc.disconnect(verbose=apargs.verbose)
+                    self.sresSYS("  (You may need to reset the device)")
+                    cellcontents = ""
+        else:
+            cellcontents = ""
+        return cellcontents.strip() and cellcontents or None
+
+    def magicwebsocketconnect(self, apargs, percentstringargs, cellcontents):
+        if apargs.password is None and not apargs.raw:
+            self.sres(apparser("%websocketconnect").format_help())
+            return None
+        self.selectsession(apargs.session)
+        tconnect = time.monotonic()
+        self.dc.websocketconnect(apargs.websocketurl)
+        if self.dc.workingwebsocket: 
+            self.sresSYS("** WebSocket connected **\n", 32)
+            if not apargs.raw:
+                res, bloggedin = self.dc.websocketlogin(apargs.password)
+                self.sres(res)
+                if bloggedin:
+                    if not apargs.raw:
+                        if self.dc.enterpastemode(apargs.verbose):
+                            self.dc.rememberconnection(apargs.password)
+                            self.sresSYS("Ready in {:.0f} ms.\n".format((time.monotonic() - tconnect)*1000))
+                        else:
+                            self.sres("Disconnecting [paste mode not working]\n", 31)
+                            self.dc.disconnect(verbose=apargs.verbose)
+                            self.sres("  (You may need to reset the device)")
+                            cellcontents = ""
+        else:
+            cellcontents = ""
+        return cellcontents.strip() and cellcontents or None
+
+    # this is the direct socket kind, not attached to a webrepl
+    def magicsocketconnect(self, apargs, percentstringargs, cellcontents):
+        self.selectsession(apargs.session)
+        self.dc.socketconnect(apargs.ipnumber, apargs.portnumber)
+        if self.dc.workingsocket:
+            self.sres("\n ** Socket connected **\n\n", 32)
+            if apargs.verbose:
+                self.sres(str(self.dc.workingsocket))
+            self.sres("\n")
+            #if not apargs.raw:
+            #    self.dc.enterpastemode()
+        return cellcontents.strip() and cellcontents or None
+
+    def magicports(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            portinfos = deviceconnector.portregistry.ports(apargs.rescan)
+            sessionports = dict((dc.workingserial.port, name)  for name, dc in self.sessions.items()  if dc.workingserial)
+            self.sresSYS("{} serial ports, enumerated {} times\n".format(len(portinfos), deviceconnector.portregistry.nscans))
+            for i, x in enumerate(portinfos):
+                usbid = "{:04x}:{:04x}".format(x.vid, x.pid)  if x.vid is not None  else "-"
+                self.sres("{:3d} {:16} {:9} {:20} {:10} {}".format(i, x.device, usbid, x.serial_number or "-", x.location or "-", x.description))
+                if x.device in sessionports:
+                    self.sres("  [session {}]".format(sessionports[x.device]), 32)
+                self.sres("\n")
+        else:
+            self.sres(apparser("%ports").format_help())
+        return cellcontents.strip() and cellcontents or None
+
+    def magicesptool(self, apargs, percentstringargs, cellcontents):
+        if apargs and (apargs.espcommand == "erase" or apargs.binfile):
+            self.dc.esptool(apargs.espcommand, apargs.port, apargs.binfile)
+        else:
+            self.sres(apparser("%esptool").format_help())
+            self.sres("Please download the bin file from https://micropython.org/download/#{}".format(apargs.espcommand if apargs else ""))
+        return cellcontents.strip() and cellcontents or None
+
+    def magicwritefilepc(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            if apargs.append:
+                self.sres("Appending to {}\n\n".format(apargs.destinationfilename), asciigraphicscode=32)
+                fout = open(apargs.destinationfilename, ("a"))
+                fout.write("\n")
             else:
-                self.sres(ap_mpycross.format_help())
-            return cellcontents.strip() and cellcontents or None
-            
-        if percentcommand == "%comment":
-            self.sres(" ".join(percentstringargs[1:]), asciigraphicscode=32)
-            return cellcontents.strip() and cellcontents or None
-            
-        if percentcommand == "%lsmagic":
-            self.sres(re.sub("usage: ", "", ap_capture.format_usage()))
-            self.sres("    records output to a file\n\n")
-            self.sres("%comment\n    print this into output\n\n")
-            self.sres(re.sub("usage: ", "", ap_disconnect.format_usage()))
-            self.sres("    disconnects from web/serial connection\n\n")
-            self.sres(re.sub("usage: ", "", ap_esptool.format_usage()))
-            self.sres("    commands for flashing your esp-device\n\n")
-            self.sres(re.sub("usage: ", "", ap_fetchfile.format_usage()))
-            self.sres("    fetch and save a file from the device\n\n")
-            self.sres(re.sub("usage: ", "", ap_ls.format_usage()))
-            self.sres("    list files on the device\n\n")
-            self.sres("%lsmagic\n    list magic commands\n\n")
-            self.sres(re.sub("usage: ", "", ap_mpycross.format_usage()))
-            self.sres("    cross-compile a .py file to a .mpy file\n\n")
-            self.sres(re.sub("usage: ", "", ap_readbytes.format_usage()))
-            self.sres("    does serial.read_all()\n\n")
-            self.sres("%rebootdevice\n    reboots device\n\n")
-            self.sres(re.sub("usage: ", "", ap_sendtofile.format_usage()))
-            self.sres("    send cell contents or file/direcectory to the device\n\n")
-            self.sres(re.sub("usage: ", "", ap_serialconnect.format_usage()))
-            self.sres("    connects to a device over USB wire\n\n")
-            self.sres(re.sub("usage: ", "", ap_socketconnect.format_usage()))
-            self.sres("    connects to a socket of a device over wifi\n\n")
-            self.sres("%suppressendcode\n    doesn't send x04 or wait to read after sending the contents of the cell\n")
-            self.sres("  (assists for debugging using %writebytes and %readbytes)\n\n")
-            self.sres(re.sub("usage: ", "", ap_websocketconnect.format_usage()))
-            self.sres("    connects to the webREPL websocket of an ESP8266 over wifi\n")
-            self.sres("    websocketurl defaults to ws://192.168.4.1:8266 but be sure to be connected\n\n")
-            self.sres(re.sub("usage: ", "", ap_writebytes.format_usage()))
-            self.sres("    does serial.write() of the python quoted string given\n\n")
-            self.sres(re.sub("usage: ", "", ap_writefilepc.format_usage()))
-            self.sres("    write contents of cell to a file\n\n")
-            
+                self.sres("Writing {}\n\n".format(apargs.destinationfilename), asciigraphicscode=32)
+                fout = open(apargs.destinationfilename, ("w"))
+                
+            fout.write(cellcontents)
+            fout.close()
+        else:
+            self.sres(apparser("%%writefile").format_help())
+        if not apargs.execute:
             return None
+        return cellcontents # should add in some blank lines at top to get errors right
 
-        if percentcommand == ap_disconnect.prog:
-            apargs = parseap(ap_disconnect, percentstringargs[1:])
-            self.dc.disconnect(raw=apargs.raw, verbose=True)
-            return None
+    def magicmpycross(self, apargs, percentstringargs, cellcontents):
+        if apargs and (apargs.set_exe or apargs.set_flags is not None):
+            if apargs.set_exe:
+                self.mpycrossexe = apargs.set_exe
+            if apargs.set_flags is not None:
+                self.mpycrossflags = shlex.split(apargs.set_flags)
+            self.mpycrosscache = None
+        elif apargs and apargs.pyfile:
+            mpycrosscache = self.getmpycrosscache()
+            if mpycrosscache:
+                results = mpycrosscache.compile([ (pyfile, os.path.basename(pyfile))  for pyfile in apargs.pyfile ])
+                for pyfile, (mpy, error) in zip(apargs.pyfile, results):
+                    if mpy is not None:
+                        with open(os.path.splitext(pyfile)[0] + ".mpy", "wb") as fout:
+                            fout.write(mpy)
+                    else:
+                        self.sres("{}: {}\n".format(pyfile, error), 31)
+                self.sresSYS("{} compiled, {} from cache\n".format(mpycrosscache.ncompiled, mpycrosscache.nfromcache))
+        else:
+            self.sres(apparser("%mpy-cross").format_help())
+        return cellcontents.strip() and cellcontents or None
+
+    def magiccomment(self, apargs, percentstringargs, cellcontents):
+        self.sres(" ".join(percentstringargs[1:]), asciigraphicscode=32)
+        return cellcontents.strip() and cellcontents or None
+
+    def magiclsmagic(self, apargs, percentstringargs, cellcontents):
+        self.sres(re.sub("usage: ", "", apparser("%broadcast").format_usage()))
+        self.sres("    runs the rest of the cell on several sessions at once, labelling the output\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%capture").format_usage()))
+        self.sres("    records output to a file\n\n")
+        self.sres("%comment\n    print this into output\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%helper").format_usage()))
+        self.sres("    shows the helper that the file commands call on the device, installed once per connection\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%idle").format_usage()))
+        self.sres("    show output the device printed between cells\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%disconnect").format_usage()))
+        self.sres("    disconnects from web/serial connection\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%esptool").format_usage()))
+        self.sres("    commands for flashing your esp-device\n")
+        self.sres("    (--port can list several ports, or be a glob, to flash them all at once)\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%fetchfile").format_usage()))
+        self.sres("    fetch and save a file from the device\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%ls").format_usage()))
+        self.sres("    list files on the device\n\n")
+        self.sres("%lsmagic\n    list magic commands\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%mpy-cross").format_usage()))
+        self.sres("    cross-compile .py files to .mpy files (in parallel, and each only once, keeping them in a cache)\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%noisefilter").format_usage()))
+        self.sres("    lists or changes the rules for dropping log lines from the device output\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%plot").format_usage()))
+        self.sres("    plots the numbers in each line printed by the cell, or the records of a %stream, as they come\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%ports").format_usage()))
+        self.sres("    lists the serial ports, whose indexes stay with the same boards when they are plugged in again\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%readbytes").format_usage()))
+        self.sres("    does serial.read_all()\n\n")
+        self.sres("%rebootdevice\n    reboots device\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%reconnect").format_usage()))
+        self.sres("    makes the connection again, as is done by itself when the link breaks\n")
+        self.sres("    (a USB device is found by its VID:PID and serial number, whatever its port is called now)\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%sendtofile").format_usage()))
+        self.sres("    send cell contents or file/direcectory to the device\n")
+        self.sres("    (--sync only sends the files in a directory that have changed)\n")
+        self.sres("    (--mpy sends .mpy compiled from the .py files, use --sync --delete to remove the .py on the device)\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%serialconnect").format_usage()))
+        self.sres("    connects to a device over USB wire\n")
+        self.sres("    (--port can be an index in %ports or the USB serial number of the board)\n")
+        self.sres("    (--session keeps other connections open alongside this one)\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%session").format_usage()))
+        self.sres("    lists the device sessions or selects the active one\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%socketconnect").format_usage()))
+        self.sres("    connects to a socket of a device over wifi\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%stream").format_usage()))
+        self.sres("    runs the cell, in which streamwrite(struct.pack(...)) sends binary records to a .npy file\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%timing").format_usage()))
+        self.sres("    shows where the time went in the last cells (seconds per phase, bytes sent and received)\n\n")
+        self.sres("%suppressendcode\n    doesn't send x04 or wait to read after sending the contents of the cell\n")
+        self.sres("  (assists for debugging using %writebytes and %readbytes)\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%websocketconnect").format_usage()))
+        self.sres("    connects to the webREPL websocket of an ESP8266 over wifi\n")
+        self.sres("    websocketurl defaults to ws://192.168.4.1:8266 but be sure to be connected\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%writebytes").format_usage()))
+        self.sres("    does serial.write() of the python quoted string given\n\n")
+        self.sres(re.sub("usage: ", "", apparser("%%writefile").format_usage()))
+        self.sres("    write contents of cell to a file\n\n")
         
-        # remaining commands require a connection
-        if not self.dc.serialexists():
-            return cellcontents
-
-        if percentcommand == ap_capture.prog:
-            apargs = parseap(ap_capture, percentstringargs[1:])
-            if apargs:
-                self.sres("Writing output to file {}\n\n".format(apargs.outputfilename), asciigraphicscode=32)
-                self.srescapturedoutputfile = open(apargs.outputfilename, "w")
-                self.srescapturemode = (3 if apargs.QUIET else (2 if apargs.quiet else 1))
-                self.srescapturedlinecount = 0
-            else:
-                self.sres(ap_capture.format_help())
-            return cellcontents
-
-        if percentcommand == ap_writebytes.prog:
-            # (not effectively using the --binary setting)
-            apargs = parseap(ap_writebytes, percentstringargs[1:])
-            if apargs:
-                bytestosend = apargs.stringtosend.encode().decode("unicode_escape").encode()
-                res = self.dc.writebytes(bytestosend)
-                if apargs.verbose:
-                    self.sres(res, asciigraphicscode=34)
-            else:
-                self.sres(ap_writebytes.format_help())
-            return cellcontents.strip() and cellcontents or None
+        return None
 
-        if percentcommand == ap_readbytes.prog:
-            # (not effectively using the --binary setting)
-            apargs = parseap(ap_readbytes, percentstringargs[1:])
-            time.sleep(0.1)   # just give it a moment if running on from a series of values (could use an --expect keyword)
-            l = self.dc.workingserialreadall()
-            if apargs.binary:
-                self.sres(repr(l))
-            elif type(l) == bytes:
-                self.sres(l.decode(errors="ignore"))
-            else:
-                self.sres(l)   # strings come back from webrepl
-            return cellcontents.strip() and cellcontents or None
-            
-        if percentcommand == "%rebootdevice":
-            self.dc.sendrebootmessage()
-            self.dc.enterpastemode()
-            return cellcontents.strip() and cellcontents or None
-            
-        if percentcommand == "%reboot":
-            self.sres("Did you mean %rebootdevice?\n", 31)
-            return None
+    def magicidle(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            if self.dc.serialexists():
+                self.idlelines(self.dc.workingserialreadall())
+            if self.dc.workingreader:
+                self.sres("{} bytes received, {} dropped from the {} byte buffer\n".format(self.dc.workingreader.nreceived, self.dc.workingreader.ndropped, self.dc.workingreader.maxsize), asciigraphicscode=34)
+            for pbline in list(self.idleoutput)[-apargs.tail:]  if apargs.tail > 0  else [ ]:
+                self.sres(pbline)
+                self.sres("\n")
+            if apargs.clear:
+                self.idleoutput.clear()
+        else:
+            self.sres(apparser("%idle").format_help())
+        return cellcontents.strip() and cellcontents or None
+
+    def magicnoisefilter(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            try:
+                if apargs.add:
+                    self.noisefilter.add(apargs.add[0], apargs.add[1])
+                if apargs.tag:
+                    self.noisefilter.add(apargs.tag, "(\x1b\\[[\\d;]*m)?[EWIDV] \\(\\d+\\) {}: ".format(re.escape(apargs.tag)))
+            except re.error as e:
+                self.sres("Bad regex: {}\n".format(str(e)), 31)
+            if apargs.remove and not self.noisefilter.remove(apargs.remove):
+                self.sres("No rule named {}\n".format(apargs.remove), 31)
+            if apargs.off or apargs.on:
+                self.noisefilter.enabled = apargs.on
+            if apargs.reset:
+                self.noisefilter.counts = dict.fromkeys(self.noisefilter.counts, 0)
+            self.sresSYS("Noise filter is {}\n".format("on" if self.noisefilter.enabled else "off"))
+            for name, regex in self.noisefilter.rules:
+                self.sres("{:8d} dropped by {}: {}\n".format(self.noisefilter.counts[name], name, repr(regex)))
+        else:
+            self.sres(apparser("%noisefilter").format_help())
+        return cellcontents.strip() and cellcontents or None
+
+    def magictiming(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            if apargs.log:
+                self.celltiminglog = (apargs.log == "on")
+                self.sresSYS("Cell timings {} logged as JSON records\n".format("are" if self.celltiminglog else "are not"))
+            celltimings = list(self.celltimings)[-apargs.last:]  if apargs.last > 0  else [ ]
+            if celltimings:
+                self.sres(" cell    total " + " ".join("{:>8}".format(phase)  for phase in cellphases) + "     sent    recvd  transfer  link       code\n", asciigraphicscode=34)
+            for ct in celltimings:
+                self.sres("{:5d} {:8.3f} ".format(ct.execution_count, ct.total) + " ".join("{:8.3f}".format(ct.seconds[phase])  for phase in cellphases))
+                self.sres(" {:8d} {:8d} {:9d}  {:10} {}\n".format(ct.nbytes["upload"], ct.nbytes["execute"], ct.nbytes["transfer"], ct.link or "", ct.code))
+            if apargs.clear:
+                self.celltimings.clear()
+        else:
+            self.sres(apparser("%timing").format_help())
+        return cellcontents.strip() and cellcontents or None
+
+    def magicdisconnect(self, apargs, percentstringargs, cellcontents):
+        self.dc.disconnect(raw=apargs.raw, verbose=True)
+        self.dc.reconnectinfo = None
+        return None
 
-        if percentcommand == "%%writetofile" or percentcommand == "%writefile":
-            self.sres("Did you mean %%writefile?\n", 31)
+    def magicreconnect(self, apargs, percentstringargs, cellcontents):
+        if not apargs:
+            self.sres(apparser("%reconnect").format_help())
+        elif apargs.timeout is not None or apargs.rerun is not None:
+            if apargs.timeout is not None:
+                self.reconnecttimeout = apargs.timeout
+            if apargs.rerun is not None:
+                self.reconnectreruns = apargs.rerun
+            self.sresSYS("Broken links {}, cells broken off are rerun up to {} times\n".format(("reconnected for up to {:g}s".format(self.reconnecttimeout) if self.reconnecttimeout > 0 else "not reconnected"), self.reconnectreruns))
+        elif self.dc.reconnectinfo is None:
+            self.sres("No connection to make again in this session\n", 31)
+        elif not self.relink(None):
             return None
+        return cellcontents.strip() and cellcontents or None
+
+    def magicsession(self, apargs, percentstringargs, cellcontents):
+        if not apargs:
+            self.sres(apparser("%session").format_help())
+        elif apargs.name is not None and apargs.name not in self.sessions:
+            self.sres("No session named {}\n".format(apargs.name), 31)
+        elif apargs.close:
+            name = apargs.name  if apargs.name is not None  else self.sessionname
+            self.sessions[name].disconnect(verbose=True)
+            if len(self.sessions) > 1:
+                del self.sessions[name]
+                if name == self.sessionname:
+                    self.selectsession(sorted(self.sessions)[0])
+            self.sresSYS("Active session is {}\n".format(self.sessionname))
+        else:
+            if apargs.name is not None:
+                self.selectsession(apargs.name)
+            for name in sorted(self.sessions):
+                self.sres("{} {}: {}\n".format(("*" if name == self.sessionname else " "), name, self.sessions[name].connectiondescription()), asciigraphicscode=(32 if name == self.sessionname else None))
+        return cellcontents.strip() and cellcontents or None
+
+    def magicbroadcast(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            unknownnames = [ name  for name in apargs.names  if name not in self.sessions ]
+            if unknownnames:
+                self.sres("No session named {}\n".format(", ".join(unknownnames)), 31)
+            elif cellcontents.strip():
+                self.broadcastcell(cellcontents, apargs.names or sorted(self.sessions))
+        else:
+            self.sres(apparser("%broadcast").format_help())
+        return None
 
-        if percentcommand == "%serialdisconnect":
-            self.sres("Did you mean %disconnect?\n", 31)
+    # remaining commands require a connection
+    def magiccapture(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            self.sres("Writing output to file {}\n\n".format(apargs.outputfilename), asciigraphicscode=32)
+            self.srescapturemode = (3 if apargs.QUIET else (2 if apargs.quiet else 1))
+            self.srescapture = deviceconnector.CaptureWriter(apargs.outputfilename, apargs.binary, (self.srescapturemode == 1), apargs.maxbytes, apargs.maxlines)
+            if self.srescapturemode == 2:
+                self.srescapture.onlines = lambda nlines: self.sres("{} lines captured".format(nlines), clear_output=True)
+            self.dc.capturesink = self.srescapture
+            self.srescapturenoisefilter = self.noisefilter.enabled
+            if apargs.binary:
+                self.noisefilter.enabled = False   # every byte goes in
+        else:
+            self.sres(apparser("%capture").format_help())
+        return cellcontents
+
+    def magicplot(self, apargs, percentstringargs, cellcontents):
+        if not apargs:
+            self.sres(apparser("%plot").format_help())
             return None
+        self.plotdisplayid += 1
+        displayid = "micropythonplot{}-{}".format(os.getpid(), self.plotdisplayid)
+        def display(data, bupdate):
+            self.sresflush()
+            self.send_response(self.iopub_socket, ('update_display_data' if bupdate else 'display_data'), { "data": data, "metadata": { }, "transient": { "display_id": displayid } })
+        self.plot = LivePlot(apargs.points, apargs.rate, apargs.width, apargs.height, apargs.show, self.sres, display)
+        if self.streamsink:
+            self.streamsink.onrecords = self.plot.addrecords
+        else:
+            self.dc.plotsink = self.plot
+        return cellcontents
 
-        if percentcommand == "%sendbytes":
-            self.sres("Did you mean %writebytes?\n", 31)
+    def magicstream(self, apargs, percentstringargs, cellcontents):
+        if not apargs:
+            self.sres(apparser("%stream").format_help())
             return None
-            
-        if percentcommand == "%reboot":
-            self.sres("Did you mean %rebootdevice?\n", 31)
+        if not self.dc.streamprelude():
             return None
-
-        if percentcommand in ("%savetofile", "%savefile", "%sendfile"):
-            self.sres("Did you mean to write %sendtofile?\n", 31)
+        try:
+            self.streamsink = deviceconnector.StreamArray(apargs.outputfilename, apargs.format, apargs.records, apargs.mmap)
+        except ImportError:
+            self.sres("%stream needs numpy on the PC (pip install numpy)\n", 31)
             return None
-
-        if percentcommand in ("%readfile", "%fetchfromfile"):
-            self.sres("Did you mean to write %fetchfile?\n", 31)
+        except (ValueError, OSError) as e:
+            self.sres("{}\n".format(e), 31)
             return None
+        self.streamquiet = apargs.quiet
+        if self.plot:
+            self.streamsink.onrecords = self.plot.addrecords
+            self.dc.plotsink = None
+        self.dc.streamsink = self.streamsink
+        return cellcontents
 
-        if percentcommand == ap_fetchfile.prog:
-            apargs = parseap(ap_fetchfile, percentstringargs[1:])
-            if apargs:
-                fetchedcontents = self.dc.fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet)
-                if apargs.print:
-                    self.sres(fetchedcontents.decode() if type(fetchedcontents)==bytes else fetchedcontents, clear_output=True)
-                    
-                if (apargs.destinationfilename or (not apargs.print and not apargs.load)) and fetchedcontents:
-                    dstfile = apargs.destinationfilename or os.path.basename(apargs.sourcefilename)
+    def magicwritebytes(self, apargs, percentstringargs, cellcontents):
+        # (not effectively using the --binary setting)
+        if apargs:
+            bytestosend = apargs.stringtosend.encode().decode("unicode_escape").encode()
+            res = self.dc.writebytes(bytestosend)
+            if apargs.verbose:
+                self.sres(res, asciigraphicscode=34)
+        else:
+            self.sres(apparser("%writebytes").format_help())
+        return cellcontents.strip() and cellcontents or None
+
+    def magicreadbytes(self, apargs, percentstringargs, cellcontents):
+        # (not effectively using the --binary setting)
+        time.sleep(0.1)   # just give it a moment if running on from a series of values (could use an --expect keyword)
+        l = self.dc.workingserialreadall()
+        if apargs.binary:
+            self.sres(repr(l))
+        elif type(l) == bytes:
+            self.sres(l.decode(errors="ignore"))
+        else:
+            self.sres(l)   # strings come back from webrepl
+        return cellcontents.strip() and cellcontents or None
+
+    def magicrebootdevice(self, apargs, percentstringargs, cellcontents):
+        if self.dc.workingsocket:   # nothing is sent to reboot it, so there would be no banner to wait for
+            self.sres("Reboot not implemented for sockets\n", 31)
+            return cellcontents.strip() and cellcontents or None
+        treboot = time.monotonic()
+        self.dc.sendrebootmessage()
+        bbanner = self.dc.expect([deviceconnector.softreboot], deviceconnector.reboottimeout)[0] != -1
+        if bbanner:   # the banner is only waited for once the reboot has been seen to start
+            bbanner = self.dc.expect([deviceconnector.rebootbanner], deviceconnector.reboottimeout)[0] != -1
+        if not bbanner:
+            self.sres("Reboot banner not seen\n", 31)
+        if self.dc.enterpastemode():
+            self.sresSYS("Ready in {:.0f} ms.\n".format((time.monotonic() - treboot)*1000))
+        return cellcontents.strip() and cellcontents or None
+
+    def magicfetchfile(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            dstfile = None
+            if apargs.destinationfilename or (not apargs.print and not apargs.load):
+                dstfile = apargs.destinationfilename or os.path.basename(apargs.sourcefilename)
+
+            if apargs.print or apargs.load:
+                fcontentsio = io.BytesIO()
+                nfetched = self.dc.fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet, fcontentsio, apargs.compress)
+                self.countbytes("transfer", nfetched or 0)
+                fetchedcontents = fcontentsio.getvalue()
+                if dstfile and nfetched is not None:
                     self.sres("Saving file to {}".format(repr(dstfile)))
-                    fout = open(dstfile, "wb" if apargs.binary else "w")
+                    fout = open(dstfile, "wb")
                     fout.write(fetchedcontents)
                     fout.close()
-                    
-                if apargs.load:
-                    fcontents = fetchedcontents.decode() if type(fetchedcontents)==bytes else fetchedcontents
-                    if not apargs.quiet:
-                        fcontents = "#%s\n\n%s" % (" ".join(percentstringargs), fcontents)
-                    set_next_input_payload = { "source": "set_next_input", "text":fcontents, "replace": True }
-                    return set_next_input_payload
-                
-            else:
-                self.sres(ap_fetchfile.format_help())
-            return None
-            
-        if percentcommand == ap_ls.prog:
-            apargs = parseap(ap_ls, percentstringargs[1:])
-            if apargs:
-                self.dc.listdir(apargs.dirname or "", apargs.recurse)
             else:
-                self.sres(ap_ls.format_help())
-            return None
-
+                partfilename = dstfile + ".part"   # streamed straight to disk as it is decoded, and only put in place once it is whole
+                nfetched = None
+                try:
+                    with open(partfilename, "wb") as fout:
+                        nfetched = self.dc.fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet, fout, apargs.compress)
+                finally:
+                    if nfetched is None:
+                        os.remove(partfilename)
+                self.countbytes("transfer", nfetched or 0)
+                if nfetched is not None:
+                    os.replace(partfilename, dstfile)
+                    self.sres("Saved file to {}".format(repr(dstfile)))
+                return None
 
-        if percentcommand == ap_sendtofile.prog:
-            apargs = parseap(ap_sendtofile, percentstringargs[1:])
-            if apargs and not (apargs.source == "<<cellcontents>>" and not apargs.destinationfilename) and (apargs.source != None):
+            if apargs.print:
+                self.sres(fetchedcontents.decode(), clear_output=True)
 
-                destfn = apargs.destinationfilename
-                def sendtofile(filename, contents):
-                    self.dc.sendtofile(filename, apargs.mkdir, apargs.append, apargs.binary, apargs.quiet, contents)
+            if apargs.load:
+                fcontents = fetchedcontents.decode() if type(fetchedcontents)==bytes else fetchedcontents
+                if not apargs.quiet:
+                    fcontents = "#%s\n\n%s" % (" ".join(percentstringargs), fcontents)
+                set_next_input_payload = { "source": "set_next_input", "text":fcontents, "replace": True }
+                return set_next_input_payload
+            
+        else:
+            self.sres(apparser("%fetchfile").format_help())
+        return None
 
-                if apargs.source == "<<cellcontents>>":
-                    filecontents = cellcontents
-                    if not apargs.execute:
-                        cellcontents = None
-                    sendtofile(destfn, filecontents)
+    def magicls(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            self.dc.listdir(apargs.dirname or "", apargs.recurse, apargs.refresh)
+        else:
+            self.sres(apparser("%ls").format_help())
+        return None
 
-                else:
-                    mode = "rb" if apargs.binary else "r"
-                    if not destfn:
-                        destfn = os.path.basename(apargs.source)
-                    elif destfn[-1] == "/":
-                        destfn += os.path.basename(apargs.source)
+    def magichelper(self, apargs, percentstringargs, cellcontents):
+        if apargs:
+            if apargs.remove:
+                self.dc.removehelpermodule()
+            elif apargs.flash:
+                self.dc.helperflash = True
+            if self.dc.ensurehelper(binstall=apargs.flash):
+                self.sresSYS("Helper version {} is on the device{}\n".format(deviceconnector.devicehelperversion, 
+                             (" and saved as {}.py".format(deviceconnector.devicehelpermodule)  if self.dc.helperflash  else "")))
+        else:
+            self.sres(apparser("%helper").format_help())
+        return cellcontents.strip() and cellcontents or None
+
+    def magicsendtofile(self, apargs, percentstringargs, cellcontents):
+        if apargs and not (apargs.source == "<<cellcontents>>" and not apargs.destinationfilename) and (apargs.source != None):
+
+            destfn = apargs.destinationfilename
+            def sendtofile(filename, contents, bbinary=apargs.binary):
+                self.dc.sendtofile(filename, apargs.mkdir or apargs.sync, apargs.append, bbinary, apargs.quiet, contents, apargs.compress)
+                self.countbytes("transfer", len(contents))
+
+            mpycrosscache = None
+            if apargs.mpy and apargs.source != "<<cellcontents>>":
+                mpycrosscache = self.getmpycrosscache()
+                if not mpycrosscache:
+                    return None
+            def bcompile(fp):
+                return mpycrosscache and fp.endswith(".py") and os.path.basename(fp) not in deviceconnector.mpycrossnotcompiled
+
+            if apargs.source == "<<cellcontents>>":
+                filecontents = cellcontents
+                if not apargs.execute:
+                    cellcontents = None
+                sendtofile(destfn, filecontents)
 
-                    if os.path.isfile(apargs.source):
+            else:
+                mode = "rb" if apargs.binary else "r"
+                if not destfn:
+                    destfn = os.path.basename(apargs.source)
+                elif destfn[-1] == "/":
+                    destfn += os.path.basename(apargs.source)
+
+                if os.path.isfile(apargs.source):
+                    if apargs.execute:
+                        self.sres("Cannot excecute sourced file\n", 31)
+                    if bcompile(apargs.source):
+                        filecontents, error = mpycrosscache.compile([ (apargs.source, destfn) ])[0]
+                        destfn = os.path.splitext(destfn)[0] + ".mpy"
+                        if error is None:
+                            sendtofile(destfn, filecontents, True)
+                        else:
+                            self.sres("{}: {}\n".format(apargs.source, error), 31)
+                    else:
                         filecontents = open(apargs.source, mode).read()
-                        if apargs.execute:
-                            self.sres("Cannot excecute sourced file\n", 31)
                         sendtofile(destfn, filecontents)
 
-                    elif os.path.isdir(apargs.source):
-                        if apargs.execute:
-                            self.sres("Cannot excecute folder\n", 31)
-                        for root, dirs, files in os.walk(apargs.source):
-                            for fn in files:
-                                skip = False
-                                fp = os.path.join(root, fn)
-                                relpath = os.path.relpath(fp, apargs.source)
-                                if relpath.endswith('.py'):
-                                    # Check for compiled copy, skip py if exists
-                                    if os.path.exists(fp[:-3] + '.mpy'):
-                                        skip = True
-                                if not skip:
-                                    destpath = os.path.join(destfn, relpath).replace('\\', '/')
-                                    filecontents = open(os.path.join(root, fn), mode).read()
-                                    sendtofile(destpath, filecontents)
-            else:
-                self.sres(ap_sendtofile.format_help())
-            return cellcontents   # allows for repeat %sendtofile in same cell
-
-
-        self.sres("Unrecognized percentline {}\n".format([percentline]), 31)
-        return cellcontents
-        
-    def runnormalcell(self, cellcontents, bsuppressendcode):
+                elif os.path.isdir(apargs.source):
+                    if apargs.execute:
+                        self.sres("Cannot excecute folder\n", 31)
+                    destpaths = [ ]
+                    for root, dirs, files in os.walk(apargs.source):
+                        for fn in files:
+                            skip = False
+                            fp = os.path.join(root, fn)
+                            relpath = os.path.relpath(fp, apargs.source)
+                            if bcompile(fp):
+                                relpath = relpath[:-3] + '.mpy'
+                            elif mpycrosscache and relpath.endswith('.mpy') and os.path.exists(fp[:-4] + '.py'):
+                                skip = True   # replaced by the one compiled from the .py
+                            elif relpath.endswith('.py'):
+                                # Check for compiled copy, skip py if exists
+                                if os.path.exists(fp[:-3] + '.mpy'):
+                                    skip = True
+                            if not skip:
+                                destpaths.append((os.path.join(destfn, relpath).replace('\\', '/'), fp))
+
+                    # all the stale modules compiled at once, before anything is sent
+                    compiled = { }
+                    if mpycrosscache:
+                        tocompile = [ (fp, destpath[:-4] + ".py")  for destpath, fp in destpaths  if bcompile(fp) ]   # named as the source in tracebacks
+                        for (fp, destpath), (mpy, error) in zip(tocompile, mpycrosscache.compile(tocompile)):
+                            if error is None:
+                                compiled[fp] = mpy
+                            else:
+                                self.sres("{}: {}\n".format(fp, error), 31)
+                        destpaths = [ (destpath, fp)  for destpath, fp in destpaths  if fp in compiled or not bcompile(fp) ]
+                        self.sres("{} modules compiled, {} from cache\n".format(mpycrosscache.ncompiled, mpycrosscache.nfromcache))
+
+                    devicehashes = None
+                    if apargs.sync:
+                        devicehashes = self.dc.hashfiles(destfn)
+                        if devicehashes is None:
+                            self.sres("Could not hash files on device, sending everything\n", 31)
+                    nunchanged = 0
+                    for destpath, fp in destpaths:
+                        filecontents = compiled[fp]  if fp in compiled  else open(fp, mode).read()
+                        if devicehashes is not None:
+                            localhash = hashlib.sha256(filecontents if type(filecontents) == bytes else filecontents.encode()).hexdigest()
+                            if devicehashes.pop(destpath, None) == localhash:
+                                nunchanged += 1
+                                continue
+                        sendtofile(destpath, filecontents, apargs.binary or fp in compiled)
+                    if devicehashes is not None:
+                        self.sres("{} files unchanged, {} sent\n".format(nunchanged, len(destpaths) - nunchanged))
+                        if apargs.delete and devicehashes:
+                            self.sres("Removing {}\n".format(", ".join(sorted(devicehashes))))
+                            self.dc.removefiles(sorted(devicehashes))
+        else:
+            self.sres(apparser("%sendtofile").format_help())
+        return cellcontents   # allows for repeat %sendtofile in same cell
+
+    def runnormalcell(self, cellcontents, bsuppressendcode, dc=None):
+        dc = dc or self.dc   # another session's connector when broadcasting
+        dc.invalidatefscache()   # any code could change the files
         cmdlines = cellcontents.splitlines(True)
-        r = self.dc.workingserialreadall()
+        r = dc.workingserialreadall()
         if r:
-            self.sres('[priorstuff] ')
-            self.sres(str(r))
-            
+            dc.sres('[priorstuff] ')
+            dc.sres(str(r))
+
+        timing = dc.timing
+        if timing:
+            nreceived = dc.getdevicereader().nreceived
+            timing.enter("upload")
+            timing.count("upload", len(cellcontents))
+
+        # whole cell in one stream when the device does raw-paste mode
+        if not bsuppressendcode and dc.rawpastewrite(cellcontents.encode("utf8")):
+            if timing:
+                timing.enter("wait")
+            if dc.streamsink:
+                dc.receiveframes(dc.streamsink, False, self.streamquiet)
+            dc.receivestream(bseekokay=False)
+            if timing:
+                timing.count("execute", dc.getdevicereader().nreceived - nreceived)
+                timing.enter("other")
+            return
+
         for line in cmdlines:
             if line:
                 if line[-2:] == '\r\n':
                     line = line[:-2]
                 elif line[-1] == '\n':
                     line = line[:-1]
-                self.dc.writeline(line)
-                r = self.dc.workingserialreadall()
+                dc.writeline(line)
+                r = dc.workingserialreadall()
                 if r:
-                    self.sres('[duringwriting] ')
-                    self.sres(str(r))
+                    dc.sres('[duringwriting] ')
+                    dc.sres(str(r))
                     
         if not bsuppressendcode:
-            self.dc.writebytes(b'\r\x04')
-            self.dc.receivestream(bseekokay=True)
+            dc.writebytes(b'\r\x04')
+            if timing:
+                timing.enter("wait")
+            if dc.streamsink:
+                dc.receiveframes(dc.streamsink, True, self.streamquiet)
+                dc.receivestream(bseekokay=False)
+            else:
+                dc.receivestream(bseekokay=True)
+        if timing:
+            timing.count("execute", dc.getdevicereader().nreceived - nreceived)
+            timing.enter("other")
         
+    # runs the cell on each session from its own thread; the threads hand labelled lines back through 
+    # a queue so that only this thread sends output to the frontend
+    def broadcastcell(self, cellcontents, sessionnames):
+        for name in sessionnames:
+            if name in self.broadcastthreads and self.broadcastthreads[name].is_alive():
+                self.sres("[{}] still running the interrupted broadcast, left out\n".format(name), 31)
+        dcs = [ (name, self.sessions[name])  for name in sessionnames  if self.sessions[name].serialexists() and not (name in self.broadcastthreads and self.broadcastthreads[name].is_alive()) ]
+        if not dcs:
+            self.sres("No connected sessions to broadcast to\n", 31)
+            return
+        outqueue = queue.Queue()
+        for name, dc in dcs:
+            dc.timing = None   # the phases of one cell can't be split between threads
+
+        def runsession(name, dc):
+            lw = SessionLineWriter(name, outqueue)
+            savedsres = (dc.sres, dc.sresSYS, dc.sresidle)
+            dc.sres, dc.sresSYS, dc.sresidle = lw.sres, lw.sresSYS, (lambda: None)
+            t0 = time.time()
+            try:
+                self.runnormalcell(cellcontents, False, dc)
+            except Exception as e:
+                lw.sres("\n***{} {}\n".format(type(e).__name__, str(e)), 31)
+            finally:
+                lw.close()
+                dc.sres, dc.sresSYS, dc.sresidle = savedsres
+                outqueue.put((name, None, time.time() - t0, 0))
+
+        def runninglist():
+            return [ name  for (name, dc), thread in zip(dcs, threads)  if thread.is_alive() ]
+
+        def relayoutput():   # until every thread has finished
+            while runninglist() or not outqueue.empty():
+                try:
+                    name, output, asciigraphicscode, n04count = outqueue.get(timeout=sresflushtime)
+                except queue.Empty:
+                    self.sresflush()
+                    continue
+                if output is None:
+                    self.sresSYS("[{}] finished in {:.2f}s\n".format(name, asciigraphicscode))
+                else:
+                    self.sres(output, asciigraphicscode=asciigraphicscode, n04count=n04count)
+
+        t0 = time.time()
+        threads = [ threading.Thread(target=runsession, args=(name, dc), daemon=True)  for name, dc in dcs ]
+        for thread in threads:
+            thread.start()
+        try:
+            relayoutput()
+        except KeyboardInterrupt:
+            self.broadcastinterrupted = True   # the threads own the devices, so do_execute mustn't read from them as well
+            self.sresSYS("\n\n*** Sending Ctrl-C to {} sessions\n\n".format(len(dcs)))
+            for name, dc in dcs:
+                dc.writebytes(b'\r\x03')   # the threads see the KeyboardInterrupt from each device and finish
+            try:
+                relayoutput()
+            except KeyboardInterrupt:
+                self.sres("\n\nKeyboard interrupt while waiting for sessions {} to finish\n\n".format(", ".join(runninglist())), 31)
+                for (name, dc), thread in zip(dcs, threads):
+                    if thread.is_alive():
+                        self.broadcastthreads[name] = thread
+            raise
+        self.sresSYS("{} sessions in {:.2f}s\n".format(len(dcs), time.time() - t0))
+
+    def selectsession(self, name):   # makes the named session active, creating it if it is new
+        if name is not None and name != self.sessionname:
+            if name not in self.sessions:
+                self.sessions[name] = deviceconnector.DeviceConnector(self.sres, self.sresSYS, self.sresidle, self.noisefilter)
+            self.sessionname = name
+            self.sessions[name].timing, self.dc.timing = self.dc.timing, None
+            self.dc = self.sessions[name]
+
+    def getmpycrosscache(self):   # None (with the reason given) if there is no mpy-cross that works
+        mpycrossexe = self.mpycrossexe or shutil.which("mpy-cross")
+        if not mpycrossexe:
+            self.sres("Cross compiler executable not yet set\n", 31)
+            self.sres("try: %mpy-cross --set-exe /home/julian/extrepositories/micropython/mpy-cross/mpy-cross\n")
+            return None
+        if self.mpycrosscache is None or self.mpycrosscache.mpycrossexe != mpycrossexe:
+            self.mpycrosscache = deviceconnector.MpyCrossCache(mpycrossexe, self.mpycrossflags)
+        try:
+            self.mpycrosscache.getversion()
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.sres("Cannot run {}: {}\n".format(mpycrossexe, e), 31)
+            self.mpycrosscache = None
+            return None
+        self.mpycrosscache.nfromcache, self.mpycrosscache.ncompiled = 0, 0
+        return self.mpycrosscache
+
+    # makes the active session's connection again after it has broken (message says how), or on %reconnect
+    def relink(self, message):
+        if message:
+            self.sres("\n\n***{}\n".format(message), 31)
+        self.dc.disconnect(raw=True, verbose=True)
+        if self.dc.reconnectinfo is None or (message and self.reconnecttimeout <= 0):
+            self.sres("You may need to reconnect")
+            return False
+        timeout = self.reconnecttimeout  if self.reconnecttimeout > 0  else deviceconnector.reconnecttimeout
+        self.sresSYS("Reconnecting for up to {:g}s (interrupt to give up)\n".format(timeout))
+        self.sresflush()
+        t0 = time.monotonic()
+        try:
+            ntries = self.dc.reconnect(timeout)
+        except KeyboardInterrupt:
+            self.dc.disconnect(raw=True)
+            ntries = 0
+        if not ntries:
+            self.sres("Could not reconnect, you may need to reconnect by hand\n", 31)
+            return False
+        self.sresSYS("Reconnected to {} after {} tries in {:.1f}s\n".format(self.dc.connectiondescription(), ntries, time.monotonic() - t0))
+        return True
+
     def sendcommand(self, cellcontents):
         bsuppressendcode = False  # can't yet see how to get this signal through
         
-        if self.srescapturedoutputfile:
-            self.srescapturedoutputfile.close()   # shouldn't normally get here
-            self.sres("closing stuck open srescapturedoutputfile\n")
-            self.srescapturedoutputfile = None
+        if self.srescapture:
+            self.endcapture()   # shouldn't normally get here
+            self.sres("closing stuck open srescapture\n")
             
         # extract any %-commands we have here at the start (or ending?), tolerating pure comment lines and white space before the first % (if there's no %-command in there, then no lines at the front get dropped due to being comments)
         while True:
             mpercentline = re.match("(?:(?:\s*|(?:\s*#.*\n))*)(%.*)\n?(?:[ \r]*\n)?", cellcontents)
             if not mpercentline:
                 break
+            timing = self.celltiming  if mpercentline.group(1).split(None, 1)[0] in transfermagics  else None
+            if timing:
+                prevphase = timing.enter("transfer")
             cellcontents = self.interpretpercentline(mpercentline.group(1), cellcontents[mpercentline.end():])   # discards the %command and a single blank line (if there is one) from the cell contents
+            if timing:
+                timing.enter(prevphase)
             if isinstance(cellcontents, dict) and cellcontents.get("source") == "set_next_input":
                 return cellcontents # set_next_input_payload:
             if cellcontents is None:
@@ -520,27 +1270,129 @@ class MicroPythonKernel(Kernel):
         if self.silent:
             return
             
-        if self.srescapturedoutputfile and (n04count == 0) and not asciigraphicscode:
-            self.srescapturedoutputfile.write(output)
-            self.srescapturedlinecount += len(output.split("\n"))-1
-            if self.srescapturemode == 3:            # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
-                return
-                
-            # changes the printing out to a lines captured statement every 1second.  
-            if self.srescapturemode == 2:  # (allow stderrors to drop through to normal printing
-                srescapturedtime = time.time()
-                if srescapturedtime < self.srescapturedlasttime + 1:   # update no more frequently than once a second
-                    return
-                self.srescapturedlasttime = srescapturedtime
-                clear_output = True
-                output = "{} lines captured".format(self.srescapturedlinecount)
-
         if clear_output:  # used when updating lines printed
+            self.sresflush()
             self.send_response(self.iopub_socket, 'clear_output', {"wait":True})
         if asciigraphicscode:
             output = "\x1b[{}m{}\x1b[0m".format(asciigraphicscode, output)
-        stream_content = {'name': ("stdout" if n04count == 0 else "stderr"), 'text': output }
-        self.send_response(self.iopub_socket, 'stream', stream_content)
+        self.sresqueue(("stdout" if n04count == 0 else "stderr"), output)
+
+    # hold output back so that a stream of tokens from the device goes out in a few messages; it is
+    # flushed on a switch of stream, on size, on age, before a clear_output, when the device goes 
+    # quiet (through DeviceConnector.sresidle) and at the end of the cell
+    def sresqueue(self, name, output):
+        self.sresncalls += 1
+        if name != self.sresbufferedname:
+            self.sresflush()
+            self.sresbufferedname = name
+        if not self.sresbuffered:
+            self.sresbufferedtime = time.monotonic()
+        self.sresbuffered.append(output)
+        self.sresbufferedsize += len(output)
+        if self.sresbufferedsize >= sresflushsize or time.monotonic() - self.sresbufferedtime >= sresflushtime:
+            self.sresflush()
+
+    def sresflush(self):
+        if self.sresbuffered:
+            output = "".join(self.sresbuffered)
+            self.sresbuffered.clear()
+            self.sresbufferedsize = 0
+            self.sresnmessages += 1
+            self.sresnbytes += len(output)
+            stream_content = {'name': self.sresbufferedname, 'text': output }
+            if self.celltiming:
+                prevphase = self.celltiming.enter("frontend")
+                self.celltiming.count("frontend", len(output))
+            self.send_response(self.iopub_socket, 'stream', stream_content)
+            if self.celltiming:
+                self.celltiming.enter(prevphase)
+
+    # the device has gone quiet for a moment (called by the DeviceConnector before it waits), so let held 
+    # back output go, and flush a %capture (which updates its count of lines captured with --quiet)
+    def sresidle(self):
+        self.sresflush()
+        if self.plot:
+            if self.streamsink:
+                self.streamsink.flush()   # so the plot keeps up with records that would otherwise wait for a full block
+            self.plot.idle()
+        if self.srescapture:
+            self.srescapture.idle()
+
+    def endcapture(self):
+        for dc in self.sessions.values():
+            dc.capturesink = None
+        self.srescapture.close()
+        self.noisefilter.enabled = self.srescapturenoisefilter
+        if self.srescapturemode == 2 or self.srescapturemode == 3:   # finish off by updating with the correct number captured
+            nfiles = len(self.srescapture.filenames)
+            self.sres("{} lines captured{}.".format(self.srescapture.nlines, (" in {} files".format(nfiles) if nfiles > 1 else "")), clear_output=(self.srescapturemode == 2))
+        self.srescapture = None
+        self.srescapturemode = 0
+
+    def endplot(self):
+        for dc in self.sessions.values():
+            dc.plotsink = None
+        self.plot.close()
+        self.sresSYS("{} samples plotted in {} updates\n".format(self.plot.nsamples, self.plot.nupdates))
+        self.plot = None
+
+    def endstream(self):
+        nleftover = self.streamsink.close()
+        stats = self.dc.streamstats  if self.dc.streamsink is self.streamsink  else None
+        for dc in self.sessions.values():
+            dc.streamsink = None
+        self.sres("{} records written to {}\n".format(self.streamsink.n, self.streamsink.filename), 32)
+        if stats:
+            self.sres("{} frames in {:.1f}s, {} dropped, {} CRC errors\n".format(stats["frames"], stats["seconds"], stats["dropped"], stats["crcerrors"]))
+        if self.streamsink.noverflow:
+            self.sres("{} records beyond the {} made room for were lost\n".format(self.streamsink.noverflow, self.streamsink.n), 31)
+        if nleftover:
+            self.sres("{} bytes at the end did not make a whole record\n".format(nleftover), 31)
+        self.streamsink = None
+
+    # completes device file paths after %ls, %fetchfile and the destination of %sendtofile, only from the listings 
+    # already in the cache (eg from an %ls) as the device isn't to be talked to in the middle of a completion request
+    def do_complete(self, code, cursor_pos):
+        res = {'status': 'ok', 'matches': [], 'cursor_start': cursor_pos, 'cursor_end': cursor_pos, 'metadata': {}}
+        line = code[:cursor_pos].rsplit("\n", 1)[-1]
+        mline = re.match(r"\s*(%ls|%fetchfile|%sendtofile)\s.*?(\S*)$", line)
+        if not mline or not self.dc.serialexists() or self.dc.workingsocket:
+            return res
+        path = mline.group(2)
+        if path[:1] == "-":
+            return res
+        dirname, _, prefix = path.rpartition("/")
+        if not dirname and path[:1] == "/":
+            dirname = "/"
+        ll = self.dc.cachedlisting(dirname)
+        if ll:
+            res['matches'] = [ name + ("/" if size == -1 else "")  for name, size in ll  if name.startswith(prefix) ]
+            res['cursor_start'] = cursor_pos - len(prefix)
+        return res
+
+    def idlelines(self, priorbuffer):   # lines of output that arrived between cells, kept for %idle
+        if type(priorbuffer) == str:
+            priorbuffer = priorbuffer.encode()
+        pblines = [ pbline.decode(errors="replace")  for pbline in priorbuffer.splitlines()  if pbline and not self.noisefilter.match(pbline) ]   # filter out boring wifi status messages
+        self.idleoutput.extend(pblines)
+        return pblines
+
+    def sresflushstats(self):
+        self.sresflush()
+        if self.sresncalls:
+            logger.debug("output of %d sres calls sent in %d iopub messages, %d characters", self.sresncalls, self.sresnmessages, self.sresnbytes)
+
+    def countbytes(self, phase, nbytes):
+        if self.celltiming:
+            self.celltiming.count(phase, nbytes)
+
+    def finishcelltiming(self):
+        self.celltiming.finish(self.dc.connectiondescription().split(" ")[0])
+        self.dc.timing = None
+        self.celltimings.append(self.celltiming)
+        if self.celltiminglog:
+            logger.info(json.dumps(self.celltiming.record()))
+        self.celltiming = None
 
     def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
         self.silent = silent
@@ -548,69 +1400,71 @@ class MicroPythonKernel(Kernel):
             return {'status': 'ok', 'execution_count': self.execution_count, 'payload': [], 'user_expressions': {}}
 
         interrupted = False
+        self.broadcastinterrupted = False
+        self.sresncalls, self.sresnmessages, self.sresnbytes = 0, 0, 0
+        self.celltiming = CellTiming(self.execution_count, code)
+        self.dc.timing = self.celltiming
         
         # clear buffer out before executing any commands (except the readbytes one)
-        if self.dc.serialexists() and not re.match("\s*%readbytes|\s*%disconnect|\s*%serialconnect|\s*websocketconnect", code):
+        if self.dc.serialexists() and not re.match("\s*%readbytes|\s*%disconnect|\s*%serialconnect|\s*websocketconnect|\s*%idle", code):
             priorbuffer = None
+            self.celltiming.enter("preread")
             try:
                 priorbuffer = self.dc.workingserialreadall()
             except KeyboardInterrupt:
                 interrupted = True
             except OSError as e:
                 priorbuffer = []
-                self.sres("\n\n***Connection broken [%s]\n" % str(e.strerror), 31)
-                self.sres("You may need to reconnect")
-                self.dc.disconnect(raw=True, verbose=True)
+                self.relink("Connection broken [%s]" % str(e.strerror or e))   # the cell goes ahead if it reconnects
                 
-            except websocket.WebSocketConnectionClosedException as e:
+            except deviceconnector.websocketerrors as e:
                 priorbuffer = []
-                self.sres("\n\n***Websocket connection broken [%s]\n" % str(e.strerror), 31)
-                self.sres("You may need to reconnect")
-                self.dc.disconnect(raw=True, verbose=True)
+                self.relink("Websocket connection broken [%s]" % str(e))
+            self.celltiming.enter("other")
                 
             if priorbuffer:
-                if type(priorbuffer) == bytes:
-                    try:
-                        priorbuffer = priorbuffer.decode()
-                    except UnicodeDecodeError:
-                        priorbuffer = str(priorbuffer)
-                
-                for pbline in priorbuffer.splitlines():
-                    if deviceconnector.wifimessageignore.match(pbline):
-                        continue   # filter out boring wifi status messages
-                    if pbline:
-                        self.sres('[leftinbuffer] ')
-                        self.sres(str([pbline]))
-                        self.sres('\n')
+                pblines = self.idlelines(priorbuffer)
+                if len(pblines) > idleoutputshown:
+                    self.sres('[leftinbuffer] {} earlier lines, see %idle\n'.format(len(pblines) - idleoutputshown))
+                for pbline in pblines[-idleoutputshown:]:
+                    self.sres('[leftinbuffer] ')
+                    self.sres(str([pbline]))
+                    self.sres('\n')
 
         
         set_next_input_payload = None
-        try:
-            if not interrupted:
+        nreruns = 0
+        while not interrupted:
+            try:
                 set_next_input_payload = self.sendcommand(code)
-        except KeyboardInterrupt:
-            interrupted = True
-        except OSError as e:
-            self.sres("\n\n***OSError [%s]\n\n" % str(e.strerror))
+            except KeyboardInterrupt:
+                interrupted = True
+            except (OSError, ) + deviceconnector.websocketerrors as e:
+                if not (isinstance(e, deviceconnector.serialerrors + deviceconnector.websocketerrors) or self.dc.linkbroken()):
+                    self.sres("\n\n***OSError [%s]\n\n" % str(e.strerror))
+                elif self.relink("Connection broken during the cell [%s]" % str(e)) and nreruns < self.reconnectreruns:
+                    nreruns += 1
+                    self.sresSYS("Running the cell again ({} of {})\n".format(nreruns, self.reconnectreruns))
+                    continue
+                elif self.dc.serialexists():
+                    self.sres("The cell was broken off by the lost connection and has not been run again\n", 31)
+            break
         #except pexpect.EOF:
         #    self.sres(self.asyncmodule.before + 'Restarting Bash')
         #    self.startasyncmodule()
 
-        if self.srescapturedoutputfile:
-            if self.srescapturemode == 2:
-                self.send_response(self.iopub_socket, 'clear_output', {"wait":True})
-            if self.srescapturemode == 2 or self.srescapturemode == 3:
-                output = "{} lines captured.".format(self.srescapturedlinecount)  # finish off by updating with the correct number captured
-                stream_content = {'name': "stdout", 'text': output }
-                self.send_response(self.iopub_socket, 'stream', stream_content)
-                
-            self.srescapturedoutputfile.close()
-            self.srescapturedoutputfile = None
-            self.srescapturemode = 0
+        self.sresflush()
+        if self.srescapture:
+            self.endcapture()
+        if self.streamsink:
+            self.endstream()
+        if self.plot:
+            self.endplot()
             
         if interrupted:
-            self.sresSYS("\n\n*** Sending Ctrl-C\n\n")
-            if self.dc.serialexists():
+            if not self.broadcastinterrupted:   # else Ctrl-C has gone to each session from broadcastcell, whose threads have read the responses
+                self.sresSYS("\n\n*** Sending Ctrl-C\n\n")
+            if self.dc.serialexists() and not self.broadcastinterrupted:
                 self.dc.writebytes(b'\r\x03')
                 interrupted = True
                 try:
@@ -619,10 +1473,14 @@ class MicroPythonKernel(Kernel):
                     self.sres("\n\nKeyboard interrupt while waiting response on Ctrl-C\n\n")
                 except OSError as e:
                     self.sres("\n\n***OSError while issuing a Ctrl-C [%s]\n\n" % str(e.strerror))
+            self.sresflushstats()
+            self.finishcelltiming()
             return {'status': 'abort', 'execution_count': self.execution_count}
             
         # everything already gone out with send_response(), but could detect errors (text between the two \x04s
 
+        self.sresflushstats()
+        self.finishcelltiming()
         payload = [set_next_input_payload]  if set_next_input_payload else []   # {"source": "set_next_input", "text": "some cell content", "replace": False}
         return {'status': 'ok', 'execution_count': self.execution_count, 'payload': payload, 'user_expressions': {}}
                     